@@ -3,27 +3,246 @@
 This module contains all the API endpoints for device control.
 """
 
-from fastapi import APIRouter, Depends, HTTPException, status, Query
-from typing import List, Optional
+import base64
+import binascii
+import uuid
+from datetime import datetime
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, status, Query
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from typing import Any, Dict, List, Optional
 from loguru import logger
 
-from app.models.device import Device, DeviceCreate, DeviceUpdate, DeviceAction
+from app.models.device import (
+    Device,
+    DeviceCreate,
+    DeviceUpdate,
+    DeviceAction,
+    DeviceBatchOperation,
+    DeviceBatchResult,
+    DeviceActionRequest,
+    DeviceActionResult,
+)
 from app.services.device_service import DeviceService
+from app.services.action_queue import DeviceQueueFullError
+from app.services.serialization import dumps, join_array
 from app.core.bluetooth import BluetoothManager
+from app.core.mqtt_commands import MQTTCommandError, MQTTCommandTimeoutError
+from app.dependencies import get_device_service, get_bluetooth_manager, require_ready
+from config import settings
 
 router = APIRouter()
-device_service = DeviceService()
-bluetooth_manager = BluetoothManager()
+
+# Versions start from the clock at startup, which can step back across a restart
+# (e.g. a Raspberry Pi without a real-time clock before NTP syncs). A per-process
+# tag keeps a version reused by a later process from matching an old ETag.
+ETAG_EPOCH = uuid.uuid4().hex[:8]
+
+
+class DeviceStats(BaseModel):
+    """Device count statistics model"""
+
+    total: int
+    bluetooth: int
+    mqtt: int
+    virtual: int
+    other: int
+    online: int
+    offline: int
+    unknown: int
+    by_type: Dict[str, int]
+    by_status: Dict[str, int]
+
+
+class DeviceChanges(BaseModel):
+    """Device changes since a registry version"""
+
+    version: int
+    full: bool
+    devices: List[Device]
+    deleted: List[str]
+
+
+class DeviceQueueStats(BaseModel):
+    """Device action queue statistics model"""
+
+    device_id: str
+    depth: int
+    max_depth: int
+    executed: int
+    rejected: int
+    last_wait: float
+    max_wait: float
+    avg_wait: float
+
+
+class DeviceHistoryEntry(BaseModel):
+    """One recorded status or property change of a device"""
+
+    timestamp: str
+    version: int
+    op: str
+    status: Optional[str]
+    properties: Optional[Dict[str, Any]]
+
+
+class TelemetryPoint(BaseModel):
+    """A raw reading or a rollup of the readings in one time bucket"""
+
+    timestamp: str
+    min: float
+    max: float
+    mean: float
+    count: int
+
+
+class TelemetrySeries(BaseModel):
+    """Readings of one numeric property of a device"""
+
+    property: str
+    resolution: str
+    points: List[TelemetryPoint]
+
+
+class PersistenceStats(BaseModel):
+    """Device persistence statistics model"""
+
+    engine: str
+    mode: str
+    pending_changes: int
+    flush_lag: float
+    writes: int
+    changes_written: int
+    bytes_written: int
+    errors: int
+    last_flush_at: Optional[str]
+    last_flush_duration: float
+    journal_records: Optional[int] = None
+    journal_bytes: Optional[int] = None
+
+
+def _encode_cursor(device_id: str) -> str:
+    """Encode the ID to continue after as an opaque cursor"""
+    return base64.urlsafe_b64encode(device_id.encode("utf-8")).decode("ascii")
+
+
+def _decode_cursor(cursor: str) -> str:
+    """Decode a cursor back to the ID to continue after"""
+    try:
+        return base64.b64decode(cursor, altchars=b"-_", validate=True).decode("utf-8")
+    except (binascii.Error, UnicodeError, ValueError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor",
+        )
+
+
+def _etag(version: int) -> str:
+    """Build the ETag for a registry or device version"""
+    return f'"{ETAG_EPOCH}-{version}"'
+
+
+def _not_modified(request: Request, etag: str) -> Optional[Response]:
+    """Return a 304 response if the request's If-None-Match matches the ETag"""
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return None
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    if etag in tags or "*" in tags:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    return None
+
+
+def _local_time(value: Optional[datetime]) -> Optional[datetime]:
+    """Convert a time with an offset to naive local time, like the stored last_seen times"""
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone().replace(tzinfo=None)
+
+
+def _parse_fields(fields: Optional[str]) -> Optional[set]:
+    """Parse and validate a comma separated field projection"""
+    if not fields:
+        return None
+    selected = {field.strip() for field in fields.split(",") if field.strip()}
+    unknown = selected - set(Device.__fields__)
+    if unknown:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown fields: {', '.join(sorted(unknown))}",
+        )
+    return selected
 
 
 @router.get("/", response_model=List[Device])
 async def get_devices(
-    device_type: Optional[str] = Query(None, description="Filter by device type")
+    request: Request,
+    device_type: Optional[str] = Query(None, description="Filter by device type"),
+    device_status: Optional[str] = Query(
+        None, alias="status", description="Filter by device status"
+    ),
+    last_seen_from: Optional[datetime] = Query(
+        None, description="Only devices last seen at or after this ISO 8601 time"
+    ),
+    last_seen_to: Optional[datetime] = Query(
+        None, description="Only devices last seen at or before this ISO 8601 time"
+    ),
+    limit: int = Query(
+        settings.API_PAGE_SIZE,
+        ge=1,
+        le=settings.API_MAX_PAGE_SIZE,
+        description="Maximum number of devices per page",
+    ),
+    cursor: Optional[str] = Query(
+        None, description="Cursor from the X-Next-Cursor header of the previous page"
+    ),
+    fields: Optional[str] = Query(
+        None, description="Comma separated fields to return, e.g. id,status"
+    ),
+    device_service: DeviceService = Depends(get_device_service),
 ):
-    """Get all devices or filter by type"""
+    """Get one page of devices ordered by ID, optionally filtered and projected
+
+    The cursor for the next page is returned in the X-Next-Cursor and Link
+    headers, and is absent on the last page. The ETag is the registry version,
+    so an unchanged registry answers If-None-Match with 304.
+    """
+    selected_fields = _parse_fields(fields)
+    after = _decode_cursor(cursor) if cursor else None
+    etag = _etag(device_service.get_version())
+    not_modified = _not_modified(request, etag)
+    if not_modified:
+        return not_modified
     try:
-        devices = await device_service.get_devices(device_type=device_type)
-        return devices
+        devices, next_id = await device_service.get_devices_page(
+            limit,
+            after=after,
+            device_type=device_type,
+            status=device_status,
+            last_seen_from=_local_time(last_seen_from),
+            last_seen_to=_local_time(last_seen_to),
+        )
+
+        headers = {
+            "ETag": etag,
+            "Cache-Control": "no-cache",
+            # Starting point for /changes
+            "X-Registry-Version": str(device_service.get_version()),
+        }
+        if next_id is not None:
+            next_cursor = _encode_cursor(next_id)
+            next_url = request.url.include_query_params(cursor=next_cursor)
+            headers["X-Next-Cursor"] = next_cursor
+            headers["Link"] = f'<{next_url}>; rel="next"'
+
+        if selected_fields:
+            content = [device.dict(include=selected_fields) for device in devices]
+            return JSONResponse(content=jsonable_encoder(content), headers=headers)
+
+        # Full devices are joined from their cached encodings
+        body = join_array(device_service.get_device_json(device) for device in devices)
+        return Response(content=body, media_type="application/json", headers=headers)
     except Exception as e:
         logger.error(f"Error getting devices: {e}")
         raise HTTPException(
@@ -33,11 +252,13 @@ async def get_devices(
 
 
 @router.get("/discover", response_model=List[Device])
-async def discover_devices():
+async def discover_devices(
+    bluetooth_manager: BluetoothManager = Depends(get_bluetooth_manager),
+):
     """Discover new Bluetooth devices"""
     try:
         devices = await bluetooth_manager.discover_devices()
-        return devices
+        return [device.to_model() for device in devices]
     except Exception as e:
         logger.error(f"Error discovering devices: {e}")
         raise HTTPException(
@@ -46,17 +267,105 @@ async def discover_devices():
         )
 
 
+@router.get("/stats", response_model=DeviceStats)
+async def get_device_stats(
+    request: Request,
+    response: Response,
+    device_service: DeviceService = Depends(get_device_service),
+):
+    """Get device counts by type and status"""
+    etag = _etag(device_service.get_version())
+    not_modified = _not_modified(request, etag)
+    if not_modified:
+        return not_modified
+    try:
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = "no-cache"
+        return DeviceStats(**device_service.get_stats())
+    except Exception as e:
+        logger.error(f"Error getting device stats: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error getting device stats: {str(e)}",
+        )
+
+
+@router.get("/persistence", response_model=PersistenceStats)
+async def get_persistence_stats(
+    device_service: DeviceService = Depends(get_device_service),
+):
+    """Get write counts and flush lag for device persistence"""
+    try:
+        return PersistenceStats(**device_service.get_persistence_stats())
+    except Exception as e:
+        logger.error(f"Error getting persistence stats: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error getting persistence stats: {str(e)}",
+        )
+
+
+@router.get("/changes", response_model=DeviceChanges)
+async def get_device_changes(
+    since: int = Query(..., description="Registry version the client last synced"),
+    device_service: DeviceService = Depends(get_device_service),
+):
+    """Get the devices created, updated or deleted since a registry version
+
+    If those changes are no longer known, the response has full set to
+    true and no devices, so its size stays bounded however many devices
+    are registered. The client should then drop its list, walk the
+    cursor-paginated device listing again, and keep syncing from the
+    version in this response. Changes made during the walk are returned
+    again by the next call, which is harmless.
+    """
+    try:
+        version = device_service.get_version()
+        changes = device_service.get_changes(since)
+        full = changes is None
+        devices, deleted = ([], []) if full else changes
+
+        # Same shape as DeviceChanges, built from the cached device encodings
+        body = b'{"version":%d,"full":%s,"devices":%s,"deleted":%s}' % (
+            version,
+            b"true" if full else b"false",
+            join_array(device_service.get_device_json(device) for device in devices),
+            dumps(deleted),
+        )
+        return Response(content=body, media_type="application/json")
+    except Exception as e:
+        logger.error(f"Error getting device changes: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error getting device changes: {str(e)}",
+        )
+
+
 @router.get("/{device_id}", response_model=Device)
-async def get_device(device_id: str):
-    """Get a specific device by ID"""
+async def get_device(
+    device_id: str,
+    request: Request,
+    device_service: DeviceService = Depends(get_device_service),
+):
+    """Get a specific device by ID, answering If-None-Match with 304 if unchanged"""
     try:
-        device = await device_service.get_device(device_id)
-        if not device:
+        version = device_service.get_version(device_id)
+        if version is None:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail=f"Device with ID {device_id} not found",
             )
-        return device
+        etag = _etag(version)
+        not_modified = _not_modified(request, etag)
+        if not_modified:
+            return not_modified
+
+        device = await device_service.get_device(device_id)
+        return Response(
+            content=device_service.get_device_json(device),
+            media_type="application/json",
+            headers={"ETag": etag, "Cache-Control": "no-cache"},
+        )
     except HTTPException:
         raise
     except Exception as e:
@@ -67,12 +376,19 @@ async def get_device(device_id: str):
         )
 
 
-@router.post("/", response_model=Device, status_code=status.HTTP_201_CREATED)
-async def create_device(device: DeviceCreate):
+@router.post(
+    "/",
+    response_model=Device,
+    status_code=status.HTTP_201_CREATED,
+    dependencies=[Depends(require_ready)],
+)
+async def create_device(
+    device: DeviceCreate, device_service: DeviceService = Depends(get_device_service)
+):
     """Add a new device manually"""
     try:
         new_device = await device_service.create_device(device)
-        return new_device
+        return new_device.to_model()
     except Exception as e:
         logger.error(f"Error creating device: {e}")
         raise HTTPException(
@@ -81,8 +397,75 @@ async def create_device(device: DeviceCreate):
         )
 
 
-@router.put("/{device_id}", response_model=Device)
-async def update_device(device_id: str, device: DeviceUpdate):
+@router.post(
+    "/batch", response_model=List[DeviceBatchResult], dependencies=[Depends(require_ready)]
+)
+async def batch_devices(
+    operations: List[DeviceBatchOperation],
+    device_service: DeviceService = Depends(get_device_service),
+):
+    """Create, update and delete many devices at once
+
+    The batch is applied only if every operation is valid, and is persisted
+    with a single write. Otherwise nothing changes and the response lists
+    what was wrong with each operation.
+    """
+    if len(operations) > settings.API_MAX_BATCH_SIZE:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Batch has more than {settings.API_MAX_BATCH_SIZE} operations",
+        )
+    try:
+        applied, results = await device_service.apply_batch(operations)
+    except Exception as e:
+        logger.error(f"Error applying device batch: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error applying device batch: {str(e)}",
+        )
+    if not applied:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=jsonable_encoder(results),
+        )
+    return results
+
+
+@router.post(
+    "/actions", response_model=List[DeviceActionResult], dependencies=[Depends(require_ready)]
+)
+async def execute_actions(
+    request: DeviceActionRequest,
+    device_service: DeviceService = Depends(get_device_service),
+):
+    """Execute an action on a list of devices, or on every device matching a selector"""
+    if request.device_ids is None and not request.device_type and not request.status:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Provide device_ids or a device_type/status selector",
+        )
+    try:
+        device_ids = request.device_ids
+        if device_ids is None:
+            devices = await device_service.get_devices(
+                device_type=request.device_type, status=request.status
+            )
+            device_ids = [device.id for device in devices]
+        return await device_service.execute_actions(device_ids, request.action)
+    except Exception as e:
+        logger.error(f"Error executing actions: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error executing actions: {str(e)}",
+        )
+
+
+@router.put("/{device_id}", response_model=Device, dependencies=[Depends(require_ready)])
+async def update_device(
+    device_id: str,
+    device: DeviceUpdate,
+    device_service: DeviceService = Depends(get_device_service),
+):
     """Update an existing device"""
     try:
         updated_device = await device_service.update_device(device_id, device)
@@ -91,7 +474,7 @@ async def update_device(device_id: str, device: DeviceUpdate):
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail=f"Device with ID {device_id} not found",
             )
-        return updated_device
+        return updated_device.to_model()
     except HTTPException:
         raise
     except Exception as e:
@@ -102,8 +485,14 @@ async def update_device(device_id: str, device: DeviceUpdate):
         )
 
 
-@router.delete("/{device_id}", status_code=status.HTTP_204_NO_CONTENT)
-async def delete_device(device_id: str):
+@router.delete(
+    "/{device_id}",
+    status_code=status.HTTP_204_NO_CONTENT,
+    dependencies=[Depends(require_ready)],
+)
+async def delete_device(
+    device_id: str, device_service: DeviceService = Depends(get_device_service)
+):
     """Delete a device"""
     try:
         success = await device_service.delete_device(device_id)
@@ -123,8 +512,14 @@ async def delete_device(device_id: str):
         )
 
 
-@router.post("/{device_id}/action", response_model=Device)
-async def execute_device_action(device_id: str, action: DeviceAction):
+@router.post(
+    "/{device_id}/action", response_model=Device, dependencies=[Depends(require_ready)]
+)
+async def execute_device_action(
+    device_id: str,
+    action: DeviceAction,
+    device_service: DeviceService = Depends(get_device_service),
+):
     """Execute an action on a device"""
     try:
         device = await device_service.execute_action(device_id, action)
@@ -133,12 +528,160 @@ async def execute_device_action(device_id: str, action: DeviceAction):
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail=f"Device with ID {device_id} not found",
             )
-        return device
+        return device.to_model()
     except HTTPException:
         raise
+    except DeviceQueueFullError as e:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=str(e),
+        )
+    except MQTTCommandTimeoutError as e:
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail=str(e),
+        )
+    except MQTTCommandError as e:
+        raise HTTPException(
+            status_code=status.HTTP_502_BAD_GATEWAY,
+            detail=str(e),
+        )
     except Exception as e:
         logger.error(f"Error executing action on device {device_id}: {e}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Error executing action: {str(e)}",
-        )
\ No newline at end of file
+        )
+
+
+@router.get("/{device_id}/queue", response_model=DeviceQueueStats)
+async def get_device_queue(
+    device_id: str, device_service: DeviceService = Depends(get_device_service)
+):
+    """Get the action queue depth and wait times of a device"""
+    device = await device_service.get_device(device_id)
+    if not device:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Device with ID {device_id} not found",
+        )
+    return DeviceQueueStats(**device_service.action_queues.get_stats(device_id))
+
+
+@router.get("/{device_id}/history", response_model=List[DeviceHistoryEntry])
+async def get_device_history(
+    device_id: str,
+    start: Optional[datetime] = Query(
+        None, alias="from", description="Only changes at or after this ISO 8601 time"
+    ),
+    end: Optional[datetime] = Query(
+        None, alias="to", description="Only changes at or before this ISO 8601 time"
+    ),
+    limit: int = Query(
+        settings.API_PAGE_SIZE,
+        ge=1,
+        le=settings.API_MAX_PAGE_SIZE,
+        description="Maximum number of changes to return",
+    ),
+    device_service: DeviceService = Depends(get_device_service),
+):
+    """Get a device's status and property changes, newest first
+
+    Recent changes are served from memory; older ones are read from the
+    history files when HISTORY_PERSIST is enabled.
+    """
+    try:
+        entries = await device_service.get_history(
+            device_id,
+            start.timestamp() if start else 0.0,
+            end.timestamp() if end else float("inf"),
+            limit,
+        )
+    except Exception as e:
+        logger.error(f"Error getting history of device {device_id}: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error getting device history: {str(e)}",
+        )
+    if entries is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Device with ID {device_id} not found",
+        )
+    return [
+        DeviceHistoryEntry(
+            timestamp=datetime.fromtimestamp(entry.timestamp).isoformat(),
+            version=entry.version,
+            op=entry.op,
+            status=entry.status,
+            properties=entry.properties,
+        )
+        for entry in entries
+    ]
+
+
+@router.get("/{device_id}/telemetry", response_model=List[TelemetrySeries])
+async def get_device_telemetry(
+    device_id: str,
+    name: Optional[str] = Query(
+        None, alias="property", description="Only this property, e.g. temperature"
+    ),
+    resolution: str = Query(
+        "1m", regex="^(raw|1m|1h|1d)$", description="raw, 1m, 1h or 1d"
+    ),
+    start: Optional[datetime] = Query(
+        None, alias="from", description="Only readings at or after this ISO 8601 time"
+    ),
+    end: Optional[datetime] = Query(
+        None, alias="to", description="Only readings at or before this ISO 8601 time"
+    ),
+    limit: int = Query(
+        settings.API_PAGE_SIZE,
+        ge=1,
+        le=settings.API_MAX_PAGE_SIZE,
+        description="Maximum number of points per property",
+    ),
+    device_service: DeviceService = Depends(get_device_service),
+):
+    """Get the numeric property readings of a device, oldest first
+
+    Rollups give the min, max, mean and count of the readings in each bucket;
+    raw readings have a count of 1.
+    """
+    try:
+        series = await device_service.get_telemetry(
+            device_id,
+            name,
+            resolution,
+            start.timestamp() if start else 0.0,
+            end.timestamp() if end else float("inf"),
+            limit,
+        )
+    except Exception as e:
+        logger.error(f"Error getting telemetry of device {device_id}: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error getting device telemetry: {str(e)}",
+        )
+    if series is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Device with ID {device_id} not found",
+        )
+    return [
+        TelemetrySeries(
+            property=property_name,
+            resolution=resolution,
+            points=[
+                TelemetryPoint(
+                    timestamp=datetime.fromtimestamp(timestamp).isoformat(),
+                    min=low,
+                    max=high,
+                    mean=mean,
+                    count=count,
+                )
+                for timestamp, low, high, mean, count in points
+            ],
+        )
+        for property_name, points in series.items()
+    ]
@@ -0,0 +1,73 @@
+"""Event Stream Endpoints
+
+This module contains the Server-Sent Events endpoint that pushes device
+changes and system metrics to the dashboard.
+"""
+
+import json
+from typing import Any, AsyncIterator
+from fastapi import APIRouter, Depends, Request
+from fastapi.responses import StreamingResponse
+from pydantic.json import pydantic_encoder
+
+from app.models.record import DeviceRecord
+from app.services.device_service import DeviceService
+from app.services.event_stream import EventBroker, EventSubscriber
+from app.dependencies import get_device_service, get_event_broker
+from config import settings
+
+router = APIRouter()
+
+
+def _encode(obj: Any) -> Any:
+    """Encode device records and pydantic types that json cannot encode"""
+    if isinstance(obj, DeviceRecord):
+        return obj.dict()
+    return pydantic_encoder(obj)
+
+
+def format_event(event: str, data: Any) -> str:
+    """Format one Server-Sent Event"""
+    payload = json.dumps(data, default=_encode, separators=(",", ":"))
+    return f"event: {event}\ndata: {payload}\n\n"
+
+
+async def _event_stream(
+    request: Request, event_broker: EventBroker, subscriber: EventSubscriber, version: int
+) -> AsyncIterator[str]:
+    """Send the client's events until it disconnects"""
+    try:
+        yield format_event("ready", {"version": version})
+        while not await request.is_disconnected():
+            events = await subscriber.get(timeout=settings.EVENT_KEEPALIVE_INTERVAL)
+            if not events:
+                # Comment line, keeps proxies from closing an idle connection
+                yield ": keepalive\n\n"
+                continue
+            yield "".join(
+                format_event(event, data() if callable(data) else data)
+                for event, data in events
+            )
+    finally:
+        event_broker.unsubscribe(subscriber)
+
+
+@router.get("/")
+async def stream_events(
+    request: Request,
+    device_service: DeviceService = Depends(get_device_service),
+    event_broker: EventBroker = Depends(get_event_broker),
+):
+    """Stream device changes and system metrics as Server-Sent Events
+
+    Events are "device" (one changed or deleted device), "stats" (device
+    counts), "system" (usage samples) and "resync", sent when the client
+    fell too far behind and should reload everything.
+    """
+    # Subscribe before reading the version, so no change falls in between
+    subscriber = event_broker.subscribe()
+    return StreamingResponse(
+        _event_stream(request, event_broker, subscriber, device_service.get_version()),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -0,0 +1,70 @@
+"""Metrics Endpoint
+
+This module contains the Prometheus /metrics endpoint and the middleware
+that records the latency of every request by route.
+"""
+
+import time
+from typing import Dict, Optional
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from fastapi.routing import APIRoute
+
+from app.services.metrics import HTTP_REQUEST_DURATION, REGISTRY
+
+router = APIRouter()
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording the time until the response headers are sent
+
+    Requests are labelled with the route's path template, so /api/devices/{device_id}
+    is one series however many devices there are. Requests that match no
+    route are not recorded.
+    """
+
+    def __init__(self, app):
+        """Initialize the middleware"""
+        self.app = app
+        self._routes: Optional[Dict[object, str]] = None
+
+    async def __call__(self, scope, receive, send):
+        """Time the request"""
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        started = False
+
+        async def send_timed(message):
+            nonlocal started
+            if message["type"] == "http.response.start":
+                started = True
+                self._observe(scope, message["status"], time.perf_counter() - start)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_timed)
+        except Exception:
+            if not started:
+                self._observe(scope, 500, time.perf_counter() - start)
+            raise
+
+    def _observe(self, scope, status_code: int, duration: float) -> None:
+        """Record a request against its route"""
+        if self._routes is None:
+            self._routes = {
+                route.endpoint: route.path
+                for route in scope["app"].routes
+                if isinstance(route, APIRoute)
+            }
+        route = self._routes.get(scope.get("endpoint"))
+        if route is not None:
+            HTTP_REQUEST_DURATION.labels(scope["method"], route, str(status_code)).observe(duration)
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Get the hub's metrics in the Prometheus text format"""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
@@ -3,14 +3,19 @@
 This module contains all the API endpoints for system control.
 """
 
-from fastapi import APIRouter, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
+from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional
 from loguru import logger
 import platform
 import psutil
 import os
 
+from app.services.device_service import DeviceService
+from app.core.mqtt import MQTTClient
+from app.services.profiling import Profiler, ProfilerBusyError
+from app.dependencies import get_device_service, get_mqtt_client, get_profiler, require_api_key
 from config import settings
 
 router = APIRouter()
@@ -35,6 +40,104 @@ class SystemSettings(BaseModel):
     settings: Dict[str, Any]
 
 
+class LoadProgress(BaseModel):
+    """Device loading progress model"""
+
+    ready: bool
+    loaded: int
+    progress: float
+    elapsed: float
+    replayed: int
+    error: Optional[str] = None
+
+
+class MQTTIngestStats(BaseModel):
+    """MQTT ingest queue statistics model"""
+
+    policy: str
+    depth: int
+    max_size: int
+    received: int
+    dispatched: int
+    dropped: int
+    coalesced: int
+    errors: int
+    max_depth: int
+    last_latency: float
+    max_latency: float
+
+
+class MQTTPublisherStats(BaseModel):
+    """MQTT state publisher statistics model"""
+
+    mode: str
+    pending: int
+    submitted: int
+    published: int
+    coalesced: int
+    deferred: int
+    unchanged: int
+    errors: int
+
+
+class MQTTStateStats(BaseModel):
+    """MQTT device state report statistics model"""
+
+    pending: int
+    received: int
+    coalesced: int
+    applied: int
+    unchanged: int
+    unknown: int
+    echoes: int
+    dropped: int
+    batches: int
+
+
+class MQTTCommandStats(BaseModel):
+    """MQTT device action acknowledgement statistics model"""
+
+    window: int
+    timeout: float
+    in_flight: int
+    sent: int
+    acknowledged: int
+    rejected: int
+    timeouts: int
+    unmatched: int
+    last_latency: float
+    max_latency: float
+
+
+class MemoryProfileStatus(BaseModel):
+    """Memory profiling status model"""
+
+    tracing: bool
+    has_baseline: bool
+    traced_current: int
+    traced_peak: int
+
+
+class MemoryDifference(BaseModel):
+    """Allocation growth at one location since the baseline snapshot"""
+
+    location: str
+    size: int
+    size_diff: int
+    count: int
+    count_diff: int
+
+
+def collect_system_metrics() -> Dict[str, Any]:
+    """Sample system usage without blocking, for the event stream"""
+    return {
+        "cpu_usage": psutil.cpu_percent(interval=None),
+        "memory_usage": psutil.virtual_memory().percent,
+        "disk_usage": psutil.disk_usage("/").percent,
+        "uptime": psutil.boot_time(),
+    }
+
+
 @router.get("/info", response_model=SystemInfo)
 async def get_system_info():
     """Get system information"""
@@ -69,6 +172,42 @@ async def get_system_info():
         )
 
 
+@router.get("/ready", response_model=LoadProgress)
+async def get_readiness(
+    response: Response, device_service: DeviceService = Depends(get_device_service)
+):
+    """Get whether stored devices have finished loading, with 503 until they have"""
+    progress = device_service.get_load_progress()
+    if not progress["ready"]:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        response.headers["Retry-After"] = "1"
+    return progress
+
+
+@router.get("/mqtt/ingest", response_model=MQTTIngestStats)
+async def get_mqtt_ingest_stats(mqtt_client: MQTTClient = Depends(get_mqtt_client)):
+    """Get the depth, drops and latency of the queue of received MQTT messages"""
+    return mqtt_client.ingest.get_stats()
+
+
+@router.get("/mqtt/publisher", response_model=MQTTPublisherStats)
+async def get_mqtt_publisher_stats(mqtt_client: MQTTClient = Depends(get_mqtt_client)):
+    """Get the publishes made, saved by coalescing and held back by rate limits"""
+    return mqtt_client.publisher.get_stats()
+
+
+@router.get("/mqtt/commands", response_model=MQTTCommandStats)
+async def get_mqtt_command_stats(mqtt_client: MQTTClient = Depends(get_mqtt_client)):
+    """Get the device actions in flight, acknowledged, rejected and timed out"""
+    return mqtt_client.commands.get_stats()
+
+
+@router.get("/mqtt/state", response_model=MQTTStateStats)
+async def get_mqtt_state_stats(device_service: DeviceService = Depends(get_device_service)):
+    """Get the state reports received from MQTT devices, merged, applied and skipped"""
+    return device_service.get_mqtt_state_stats()
+
+
 @router.get("/settings", response_model=SystemSettings)
 async def get_system_settings():
     """Get system settings"""
@@ -91,17 +230,111 @@ async def get_system_settings():
 
 
 @router.post("/restart", status_code=status.HTTP_202_ACCEPTED)
-async def restart_system():
+async def restart_system(device_service: DeviceService = Depends(get_device_service)):
     """Restart the application (not the device)"""
     try:
         # This is a simple implementation that just exits the process
         # In a production environment, you would want to use a process manager
         # like systemd or supervisor to restart the application
         logger.info("Restarting application...")
+        # os._exit skips the shutdown handler, so flush pending device changes first
+        await device_service.stop()
         os._exit(0)
     except Exception as e:
         logger.error(f"Error restarting system: {e}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Error restarting system: {str(e)}",
-        )
\ No newline at end of file
+        )
+
+@router.post(
+    "/profile/cpu",
+    response_class=PlainTextResponse,
+    dependencies=[Depends(require_api_key)],
+)
+async def profile_cpu(
+    seconds: float = Query(10.0, gt=0, le=settings.PROFILE_MAX_SECONDS),
+    output: str = Query(
+        "collapsed",
+        regex="^(collapsed|pstats)$",
+        description="collapsed stacks of every thread, or pstats of the event loop thread",
+    ),
+    limit: int = Query(50, ge=1, le=1000, description="Functions listed in pstats output"),
+    profiler: Profiler = Depends(get_profiler),
+):
+    """Profile the CPU for a number of seconds and return the result as text"""
+    try:
+        return PlainTextResponse(await profiler.profile_cpu(seconds, output, limit))
+    except ProfilerBusyError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error profiling CPU: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error profiling CPU: {str(e)}",
+        )
+
+
+@router.get(
+    "/profile/memory",
+    response_model=MemoryProfileStatus,
+    dependencies=[Depends(require_api_key)],
+)
+async def get_memory_profile_status(profiler: Profiler = Depends(get_profiler)):
+    """Get whether allocations are being traced"""
+    return profiler.memory_status()
+
+
+@router.post(
+    "/profile/memory/snapshot",
+    response_model=MemoryProfileStatus,
+    dependencies=[Depends(require_api_key)],
+)
+async def take_memory_snapshot(profiler: Profiler = Depends(get_profiler)):
+    """Start tracing allocations if needed and take the baseline snapshot"""
+    try:
+        return await profiler.take_memory_baseline()
+    except Exception as e:
+        logger.error(f"Error taking memory snapshot: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error taking memory snapshot: {str(e)}",
+        )
+
+
+@router.get(
+    "/profile/memory/diff",
+    response_model=List[MemoryDifference],
+    dependencies=[Depends(require_api_key)],
+)
+async def diff_memory_snapshot(
+    group_by: str = Query("lineno", regex="^(lineno|filename|traceback)$"),
+    limit: int = Query(20, ge=1, le=1000),
+    profiler: Profiler = Depends(get_profiler),
+):
+    """Compare a new snapshot to the baseline, largest growth first"""
+    try:
+        differences = await profiler.diff_memory(group_by, limit)
+    except Exception as e:
+        logger.error(f"Error diffing memory snapshots: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error diffing memory snapshots: {str(e)}",
+        )
+    if differences is None:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Take a snapshot first",
+        )
+    return differences
+
+
+@router.delete(
+    "/profile/memory",
+    status_code=status.HTTP_204_NO_CONTENT,
+    dependencies=[Depends(require_api_key)],
+)
+async def stop_memory_profile(profiler: Profiler = Depends(get_profiler)):
+    """Stop tracing allocations and drop the baseline snapshot"""
+    profiler.stop_memory()
+    return None
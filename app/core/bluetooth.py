@@ -7,12 +7,15 @@ It tries to use PyBluez if available, otherwise falls back to bluetoothctl.
 import asyncio
 import subprocess
 import re
+import time
 import uuid
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Callable, Awaitable
 from loguru import logger
 import platform
 
-from app.models.device import Device, DeviceType
+from app.models.device import DeviceType
+from app.models.record import DeviceRecord
+from app.services.metrics import BLUETOOTH_SCAN_DEVICES, BLUETOOTH_SCAN_DURATION
 from config import settings
 
 # Try to import PyBluez, but don't fail if it's not available
@@ -29,9 +32,19 @@ class BluetoothManager:
 
     def __init__(self):
         """Initialize the Bluetooth manager"""
-        self.devices: Dict[str, Device] = {}
+        self.devices: Dict[str, DeviceRecord] = {}
         self.discovery_running = False
         self.discovery_task = None
+        self.discovery_callbacks: List[Callable[[List[DeviceRecord]], Awaitable[None]]] = []
+        # Resolves devices that are registered but were not found by a scan
+        self.device_lookup: Optional[Callable[[str], Optional[DeviceRecord]]] = None
+
+    def register_discovery_callback(
+        self, callback: Callable[[List[DeviceRecord]], Awaitable[None]]
+    ) -> None:
+        """Register a callback that receives the results of every scan"""
+        self.discovery_callbacks.append(callback)
+        logger.debug("Registered Bluetooth discovery callback")
 
     async def start_discovery(self) -> None:
         """Start periodic Bluetooth device discovery"""
@@ -72,14 +85,64 @@ class BluetoothManager:
             # Wait for the next scan interval
             await asyncio.sleep(settings.BLUETOOTH_SCAN_INTERVAL)
 
-    async def discover_devices(self) -> List[Device]:
+    async def discover_devices(self) -> List[DeviceRecord]:
         """Discover Bluetooth devices"""
+        start = time.perf_counter()
         if PYBLUEZ_AVAILABLE:
-            return await self._discover_with_pybluez()
+            devices = await self._discover_with_pybluez()
         else:
-            return await self._discover_with_bluetoothctl()
+            devices = await self._discover_with_bluetoothctl()
+        BLUETOOTH_SCAN_DURATION.observe(time.perf_counter() - start)
+        BLUETOOTH_SCAN_DEVICES.set(len(devices))
+
+        # Hand the results to everyone interested in them
+        for callback in self.discovery_callbacks:
+            try:
+                await callback(devices)
+            except Exception as e:
+                logger.error(f"Error in Bluetooth discovery callback: {e}")
+
+        return devices
+
+    def _find_device(self, device_id: str) -> Optional[DeviceRecord]:
+        """Find a discovered or registered device by ID"""
+        device = self.devices.get(device_id)
+        if not device and self.device_lookup:
+            device = self.device_lookup(device_id)
+        return device
+
+    def _record_scan_result(
+        self, addr: str, name: Optional[str], device_class: Any
+    ) -> DeviceRecord:
+        """Create or refresh the record of a device seen in a scan
 
-    async def _discover_with_pybluez(self) -> List[Device]:
+        Scan results come from the Bluetooth stack, so records are built
+        directly without validation, and reused across scans.
+        """
+        device_id = addr.replace(":", "").lower()
+        name = name or f"Unknown Device ({addr})"
+        device = self.devices.get(device_id)
+        if device:
+            device.name = name
+            device.status = "online"
+            device.properties["class"] = device_class
+            return device
+
+        device = DeviceRecord(
+            id=device_id,
+            name=name,
+            type=DeviceType.BLUETOOTH,
+            address=addr,
+            status="online",
+            properties={
+                "class": device_class,
+                "services": [],
+            },
+        )
+        self.devices[device_id] = device
+        return device
+
+    async def _discover_with_pybluez(self) -> List[DeviceRecord]:
         """Discover Bluetooth devices using PyBluez"""
         logger.info("Discovering Bluetooth devices with PyBluez")
         
@@ -89,27 +152,15 @@ class BluetoothManager:
             None, bluetooth.discover_devices, True, 10, True
         )
         
-        devices = []
-        for addr, name, device_class in nearby_devices:
-            device_id = addr.replace(":", "").lower()
-            device = Device(
-                id=device_id,
-                name=name or f"Unknown Device ({addr})",
-                type=DeviceType.BLUETOOTH,
-                address=addr,
-                status="online",
-                properties={
-                    "class": device_class,
-                    "services": [],
-                },
-            )
-            self.devices[device_id] = device
-            devices.append(device)
+        devices = [
+            self._record_scan_result(addr, name, device_class)
+            for addr, name, device_class in nearby_devices
+        ]
             
         logger.info(f"Discovered {len(devices)} devices with PyBluez")
         return devices
 
-    async def _discover_with_bluetoothctl(self) -> List[Device]:
+    async def _discover_with_bluetoothctl(self) -> List[DeviceRecord]:
         """Discover Bluetooth devices using bluetoothctl"""
         logger.info("Discovering Bluetooth devices with bluetoothctl")
         
@@ -160,21 +211,7 @@ class BluetoothManager:
                 if match:
                     addr = match.group(1)
                     name = match.group(2)
-                    
-                    device_id = addr.replace(":", "").lower()
-                    device = Device(
-                        id=device_id,
-                        name=name or f"Unknown Device ({addr})",
-                        type=DeviceType.BLUETOOTH,
-                        address=addr,
-                        status="online",
-                        properties={
-                            "class": "unknown",
-                            "services": [],
-                        },
-                    )
-                    self.devices[device_id] = device
-                    devices.append(device)
+                    devices.append(self._record_scan_result(addr, name, "unknown"))
             
             logger.info(f"Discovered {len(devices)} devices with bluetoothctl")
             return devices
@@ -185,7 +222,7 @@ class BluetoothManager:
 
     async def connect_device(self, device_id: str) -> bool:
         """Connect to a Bluetooth device"""
-        device = self.devices.get(device_id)
+        device = self._find_device(device_id)
         if not device:
             logger.error(f"Device {device_id} not found")
             return False
@@ -197,7 +234,7 @@ class BluetoothManager:
         else:
             return await self._connect_with_bluetoothctl(device)
 
-    async def _connect_with_pybluez(self, device: Device) -> bool:
+    async def _connect_with_pybluez(self, device: DeviceRecord) -> bool:
         """Connect to a Bluetooth device using PyBluez"""
         try:
             # This is a simplified example. In a real application, you would
@@ -212,7 +249,7 @@ class BluetoothManager:
             logger.error(f"Error connecting to device with PyBluez: {e}")
             return False
 
-    async def _connect_with_bluetoothctl(self, device: Device) -> bool:
+    async def _connect_with_bluetoothctl(self, device: DeviceRecord) -> bool:
         """Connect to a Bluetooth device using bluetoothctl"""
         try:
             process = await asyncio.create_subprocess_exec(
@@ -243,7 +280,7 @@ class BluetoothManager:
 
     async def disconnect_device(self, device_id: str) -> bool:
         """Disconnect from a Bluetooth device"""
-        device = self.devices.get(device_id)
+        device = self._find_device(device_id)
         if not device:
             logger.error(f"Device {device_id} not found")
             return False
@@ -255,14 +292,14 @@ class BluetoothManager:
         else:
             return await self._disconnect_with_bluetoothctl(device)
 
-    async def _disconnect_with_pybluez(self, device: Device) -> bool:
+    async def _disconnect_with_pybluez(self, device: DeviceRecord) -> bool:
         """Disconnect from a Bluetooth device using PyBluez"""
         # In a real application, you would need to keep track of open connections
         # For this example, we'll just update the status
         device.status = "disconnected"
         return True
 
-    async def _disconnect_with_bluetoothctl(self, device: Device) -> bool:
+    async def _disconnect_with_bluetoothctl(self, device: DeviceRecord) -> bool:
         """Disconnect from a Bluetooth device using bluetoothctl"""
         try:
             process = await asyncio.create_subprocess_exec(
@@ -6,7 +6,7 @@ It is optional and only enabled if MQTT_ENABLED is set to True in the settings.
 
 import asyncio
 import json
-from typing import Dict, Any, Callable, Optional
+from typing import Dict, Any, Awaitable, Callable, List, Optional, Tuple
 from loguru import logger
 
 # Try to import paho-mqtt, but don't fail if it's not available
@@ -18,7 +18,12 @@ except ImportError:
     logger.warning("paho-mqtt not available, MQTT functionality will be disabled")
 
 from config import settings
+from app.core.mqtt_commands import MQTTCommandTracker
+from app.core.mqtt_ingest import MQTTIngestQueue
+from app.core.mqtt_publisher import MQTTStatePublisher
+from app.core.topic_router import TopicRouter
 from app.models.device import Device, DeviceAction
+from app.services.metrics import MQTT_MESSAGES_IN, MQTT_MESSAGES_OUT
 
 
 class MQTTClient:
@@ -28,7 +33,36 @@ class MQTTClient:
         """Initialize the MQTT client"""
         self.client = None
         self.connected = False
-        self.message_callbacks: Dict[str, Callable] = {}
+        # Callbacks by topic pattern, as (callback, level of the device ID or None)
+        self.router = TopicRouter()
+        # Patterns whose messages must each be delivered, never coalesced in the ingest queue
+        self.uncoalesced = TopicRouter()
+        self.subscriptions: List[str] = []
+        # Set by the device service to share its cached device JSON
+        self.state_encoder: Optional[Callable[[Device], bytes]] = None
+        # Tags the state this hub publishes, devices report their own state on the same topic
+        self.source = settings.MQTT_CLIENT_ID
+        self._source_field = b'{"source":' + json.dumps(self.source).encode("utf-8") + b","
+        # Hands received messages from paho's network thread to the event loop
+        self.ingest = MQTTIngestQueue(
+            settings.MQTT_INGEST_QUEUE_SIZE,
+            settings.MQTT_INGEST_OVERFLOW,
+            settings.MQTT_INGEST_BATCH_SIZE,
+        )
+        # Coalesces device state changes and publishes them at a bounded rate
+        self.publisher = MQTTStatePublisher(
+            self._publish,
+            self._encode_state,
+            settings.MQTT_TOPIC_PREFIX,
+            settings.MQTT_STATE_PUBLISH_WINDOW,
+            settings.MQTT_STATE_PUBLISH_MODE,
+            settings.MQTT_STATE_PUBLISH_RATE,
+            settings.MQTT_STATE_PUBLISH_DEVICE_RATE,
+        )
+        # Device actions waiting for the device to acknowledge them on prefix/<device_id>/ack
+        self.commands = MQTTCommandTracker(settings.MQTT_ACTION_WINDOW, settings.MQTT_ACTION_TIMEOUT)
+        # Acks of pipelined commands share a topic, so every one of them must be delivered
+        self.register_callback("ack", self.commands.handle_ack, coalesce=False)
 
     async def start(self) -> bool:
         """Start the MQTT client"""
@@ -45,6 +79,9 @@ class MQTTClient:
             return True
 
         try:
+            # Handle received messages on this event loop
+            self.ingest.start(self._handle_message)
+
             # Create a new client instance
             self.client = mqtt.Client(client_id=settings.MQTT_CLIENT_ID)
 
@@ -74,21 +111,30 @@ class MQTTClient:
             if not self.connected:
                 logger.error("Failed to connect to MQTT broker")
                 self.client.loop_stop()
+                await self.ingest.stop()
                 return False
 
+            self.publisher.start()
             logger.info(f"Connected to MQTT broker at {settings.MQTT_BROKER}:{settings.MQTT_PORT}")
             return True
 
         except Exception as e:
             logger.error(f"Error starting MQTT client: {e}")
+            await self.ingest.stop()
             return False
 
     async def stop(self) -> None:
         """Stop the MQTT client"""
         if not self.client or not self.connected:
+            await self.ingest.stop()
+            await self.publisher.stop()
             return
 
         try:
+            # Stop the queue first, so the network thread is never left waiting for room
+            await self.ingest.stop()
+            # Publish the state changes still pending before disconnecting
+            await self.publisher.stop()
             self.client.disconnect()
             self.client.loop_stop()
             self.connected = False
@@ -102,10 +148,10 @@ class MQTTClient:
             self.connected = True
             logger.info("Connected to MQTT broker")
 
-            # Subscribe to topics
-            topic = f"{settings.MQTT_TOPIC_PREFIX}/+/+"
-            client.subscribe(topic)
-            logger.info(f"Subscribed to topic: {topic}")
+            # Subscribe to the device topics, and to patterns outside them
+            topics = [self._device_topics()] + self.subscriptions
+            client.subscribe([(topic, 0) for topic in topics])
+            logger.info(f"Subscribed to topics: {', '.join(topics)}")
         else:
             logger.error(f"Failed to connect to MQTT broker with code {rc}")
 
@@ -118,79 +164,176 @@ class MQTTClient:
             logger.info("Disconnected from MQTT broker")
 
     def _on_message(self, client, userdata, msg):
-        """Callback for when a message is received from the broker"""
+        """Callback for when a message is received, runs on paho's network thread"""
+        MQTT_MESSAGES_IN.inc()
+        coalesce = self.ingest.policy != "coalesce" or not self.uncoalesced.match(msg.topic)
+        self.ingest.put(msg.topic, msg.payload, coalesce)
+
+    async def _handle_message(self, topic: str, payload_bytes: bytes) -> None:
+        """Dispatch a received message to the callbacks of every matching pattern"""
         try:
-            topic = msg.topic
-            payload = msg.payload.decode("utf-8")
-            logger.debug(f"Received message on topic {topic}: {payload}")
-
-            # Parse the topic to get device ID and action
-            # Format: smarthomelite/device_id/action
-            parts = topic.split("/")
-            if len(parts) != 3:
-                logger.warning(f"Invalid topic format: {topic}")
+            callbacks = self.router.match(topic)
+            if not callbacks:
+                logger.debug(f"No callback for topic {topic}")
                 return
 
-            device_id = parts[1]
-            action_type = parts[2]
+            payload = payload_bytes.decode("utf-8")
+            try:
+                payload_data = json.loads(payload)
+            except json.JSONDecodeError:
+                payload_data = {"value": payload}
 
-            # Call the appropriate callback if registered
-            if action_type in self.message_callbacks:
+            levels = topic.split("/")
+            for callback, device_level in callbacks:
                 try:
-                    payload_data = json.loads(payload)
-                except json.JSONDecodeError:
-                    payload_data = {"value": payload}
-
-                asyncio.create_task(
-                    self.message_callbacks[action_type](device_id, payload_data)
-                )
+                    if device_level is None:
+                        await callback(topic, payload_data)
+                    else:
+                        await callback(levels[device_level], payload_data)
+                except Exception as e:
+                    logger.error(f"Error in MQTT callback for {topic}: {e}")
 
         except Exception as e:
             logger.error(f"Error processing MQTT message: {e}")
 
+    def _device_topics(self) -> str:
+        """Get the pattern of the per-device topics, prefix/<device_id>/<action_type>"""
+        return f"{settings.MQTT_TOPIC_PREFIX}/+/+"
+
+    def _route(self, action_type: str, device_id: str) -> Tuple[str, Optional[int]]:
+        """Get the pattern and device ID level of an action type or topic pattern"""
+        if "/" in action_type or "+" in action_type or "#" in action_type:
+            return action_type, None
+        return (
+            f"{settings.MQTT_TOPIC_PREFIX}/{device_id}/{action_type}",
+            len(settings.MQTT_TOPIC_PREFIX.split("/")),
+        )
+
     def register_callback(
-        self, action_type: str, callback: Callable[[str, Dict[str, Any]], None]
+        self,
+        action_type: str,
+        callback: Callable[[str, Any], Awaitable[None]],
+        device_id: str = "+",
+        coalesce: bool = True,
     ) -> None:
-        """Register a callback for a specific action type"""
-        self.message_callbacks[action_type] = callback
-        logger.debug(f"Registered callback for action type: {action_type}")
+        """Register a callback for an action type or a topic pattern
+
+        An action type such as "state" matches prefix/<device_id>/state, for
+        every device unless device_id is given, and the callback receives the
+        device ID and payload. A topic pattern (containing /, + or #) is
+        matched as is, and the callback receives the topic and payload. Any
+        number of callbacks can share a pattern. With coalesce=False every
+        message on the pattern reaches the callback, even when the ingest
+        queue coalesces messages by topic.
+        """
+        pattern, device_level = self._route(action_type, device_id)
+        self.router.add(pattern, (callback, device_level))
+        if not coalesce:
+            self.uncoalesced.add(pattern, (callback, device_level))
+
+        # Patterns outside the device topics need their own subscription
+        if device_level is None and pattern not in self.subscriptions:
+            self.subscriptions.append(pattern)
+            if self.client and self.connected:
+                self.client.subscribe(pattern)
+        logger.debug(f"Registered callback for topic pattern: {pattern}")
+
+    def unregister_callback(
+        self,
+        action_type: str,
+        callback: Callable[[str, Any], Awaitable[None]],
+        device_id: str = "+",
+    ) -> bool:
+        """Unregister a callback, returns False if it was not registered"""
+        pattern, device_level = self._route(action_type, device_id)
+        self.uncoalesced.remove(pattern, (callback, device_level))
+        return self.router.remove(pattern, (callback, device_level))
+
+    def _encode_state(self, device: Device) -> bytes:
+        """Encode a device's state tagged with this hub as its source
+
+        Uses the device service's cached JSON if set.
+        """
+        if self.state_encoder:
+            payload = self.state_encoder(device)
+        else:
+            payload = json.dumps(device.dict(), default=str).encode("utf-8")
+        return self._source_field + payload[1:]
 
-    async def publish_device_state(self, device: Device) -> bool:
-        """Publish device state to MQTT"""
+    def is_own_state(self, payload: Any) -> bool:
+        """Check whether a received state payload is one this hub published"""
+        return isinstance(payload, dict) and payload.get("source") == self.source
+
+    def _publish(self, topic: str, payload: bytes, retain: bool = False) -> bool:
+        """Publish a payload at QoS 1, returns False if it could not be sent"""
         if not self.client or not self.connected:
             return False
 
-        try:
-            topic = f"{settings.MQTT_TOPIC_PREFIX}/{device.id}/state"
-            payload = json.dumps(device.dict())
-            result = self.client.publish(topic, payload, qos=1, retain=True)
-            if result.rc != mqtt.MQTT_ERR_SUCCESS:
-                logger.error(f"Failed to publish device state: {result}")
-                return False
+        result = self.client.publish(topic, payload, qos=1, retain=retain)
+        MQTT_MESSAGES_OUT.inc()
+        if result.rc != mqtt.MQTT_ERR_SUCCESS:
+            logger.error(f"Failed to publish to {topic}: {result}")
+            return False
 
-            logger.debug(f"Published device state to {topic}")
-            return True
+        logger.debug(f"Published to {topic}")
+        return True
+
+    def queue_device_state(self, device_id: str, device: Optional[Device]) -> bool:
+        """Queue a device's state for the coalescing publisher, or its deletion if device is None
+
+        Returns False if the publisher is not running.
+        """
+        return self.publisher.submit(device_id, device)
+
+    async def publish_device_state(self, device: Device) -> bool:
+        """Publish device state to MQTT right away"""
+        try:
+            return self._publish(
+                f"{settings.MQTT_TOPIC_PREFIX}/{device.id}/state",
+                self._encode_state(device),
+                retain=True,
+            )
 
         except Exception as e:
             logger.error(f"Error publishing device state: {e}")
             return False
 
-    async def publish_device_action(self, device_id: str, action: DeviceAction) -> bool:
-        """Publish device action to MQTT"""
-        if not self.client or not self.connected:
-            return False
+    async def publish_device_action(
+        self, device_id: str, action: DeviceAction, correlation_id: Optional[str] = None
+    ) -> bool:
+        """Publish device action to MQTT
 
+        With a correlation ID, the device is asked to acknowledge the action
+        on prefix/<device_id>/ack.
+        """
         try:
-            topic = f"{settings.MQTT_TOPIC_PREFIX}/{device_id}/{action.action_type}"
-            payload = json.dumps({"value": action.value})
-            result = self.client.publish(topic, payload, qos=1)
-            if result.rc != mqtt.MQTT_ERR_SUCCESS:
-                logger.error(f"Failed to publish device action: {result}")
-                return False
-
-            logger.debug(f"Published device action to {topic}")
-            return True
+            message: Dict[str, Any] = {"value": action.value}
+            if correlation_id:
+                message["correlation_id"] = correlation_id
+                message["reply_to"] = f"{settings.MQTT_TOPIC_PREFIX}/{device_id}/ack"
+            return self._publish(
+                f"{settings.MQTT_TOPIC_PREFIX}/{device_id}/{action.action_type}",
+                json.dumps(message).encode("utf-8"),
+            )
 
         except Exception as e:
             logger.error(f"Error publishing device action: {e}")
-            return False
\ No newline at end of file
+            return False
+
+    async def send_device_action(self, device_id: str, action: DeviceAction) -> str:
+        """Send an action to be acknowledged, returns its correlation ID
+
+        Waits while the device has a full window of actions in flight.
+        Raises MQTTCommandError if the action could not be sent.
+        """
+        return await self.commands.send(
+            device_id,
+            lambda correlation_id: self.publish_device_action(device_id, action, correlation_id),
+        )
+
+    async def wait_for_ack(self, correlation_id: str) -> Dict[str, Any]:
+        """Wait for a device to acknowledge an action sent with send_device_action
+
+        Raises MQTTCommandTimeoutError if it does not in time.
+        """
+        return await self.commands.wait(correlation_id)
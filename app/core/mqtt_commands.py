@@ -0,0 +1,136 @@
+"""MQTT Commands
+
+This module tracks commands sent to MQTT devices until the devices
+acknowledge them. Every command carries a correlation ID, which the device
+echoes on prefix/<device_id>/ack. Each device can have a window of commands
+waiting for their acknowledgements at once, so commands are pipelined
+instead of each one waiting for the reply to the previous one.
+"""
+
+import asyncio
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+
+class MQTTCommandError(Exception):
+    """Raised when a command cannot be sent or the device rejects it"""
+
+
+class MQTTCommandTimeoutError(MQTTCommandError):
+    """Raised when a device does not acknowledge a command in time"""
+
+
+class MQTTCommandTracker:
+    """In-flight commands per device, matched to acknowledgements by correlation ID"""
+
+    def __init__(self, window: int, timeout: float):
+        """Initialize the tracker"""
+        self.window = window
+        self.timeout = timeout
+        # Only devices with commands in flight or waiting for room have a window
+        self._windows: Dict[str, asyncio.Semaphore] = {}
+        self._users: Dict[str, int] = {}
+        # Correlation ID to (device ID, future resolved with the acknowledgement, time sent)
+        self._pending: Dict[str, Tuple[str, asyncio.Future, float]] = {}
+
+        self.stats: Dict[str, Any] = {
+            "sent": 0,
+            "acknowledged": 0,
+            "rejected": 0,
+            "timeouts": 0,
+            "unmatched": 0,
+            "last_latency": 0.0,
+            "max_latency": 0.0,
+        }
+
+    async def send(self, device_id: str, publish: Callable[[str], Awaitable[bool]]) -> str:
+        """Send a command with publish(correlation_id), returns the correlation ID
+
+        Waits while the device already has a full window of commands in
+        flight. Raises MQTTCommandError if publish fails.
+        """
+        window = self._windows.get(device_id)
+        if window is None:
+            window = self._windows[device_id] = asyncio.Semaphore(self.window)
+        self._users[device_id] = self._users.get(device_id, 0) + 1
+        try:
+            await window.acquire()
+        except BaseException:
+            self._leave(device_id)
+            raise
+
+        correlation_id = uuid.uuid4().hex
+        future = asyncio.get_running_loop().create_future()
+        self._pending[correlation_id] = (device_id, future, time.monotonic())
+        try:
+            sent = await publish(correlation_id)
+        except BaseException:
+            self._finish(correlation_id)
+            raise
+        if not sent:
+            self._finish(correlation_id)
+            raise MQTTCommandError(f"Could not send the command to device {device_id}")
+        self.stats["sent"] += 1
+        return correlation_id
+
+    async def wait(self, correlation_id: str) -> Dict[str, Any]:
+        """Wait for a command's acknowledgement, freeing its place in the window
+
+        Returns the acknowledgement, which may report that the device
+        rejected the command. Raises MQTTCommandTimeoutError if none arrives
+        in time.
+        """
+        device_id, future, sent_at = self._pending[correlation_id]
+        try:
+            acknowledgement = await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            raise MQTTCommandTimeoutError(
+                f"Device {device_id} did not acknowledge the command within {self.timeout} s"
+            )
+        finally:
+            self._finish(correlation_id)
+
+        latency = time.monotonic() - sent_at
+        self.stats["last_latency"] = latency
+        if latency > self.stats["max_latency"]:
+            self.stats["max_latency"] = latency
+        self.stats["acknowledged" if acknowledgement.get("success", True) else "rejected"] += 1
+        return acknowledgement
+
+    async def handle_ack(self, device_id: str, payload: Any) -> None:
+        """Resolve the command an acknowledgement received from a device refers to"""
+        correlation_id = payload.get("correlation_id") if isinstance(payload, dict) else None
+        entry = self._pending.get(correlation_id)
+        if entry is None or entry[0] != device_id or entry[1].done():
+            # Late, duplicated or for a command this hub did not send
+            self.stats["unmatched"] += 1
+            return
+        entry[1].set_result(payload)
+
+    def _finish(self, correlation_id: str) -> None:
+        """Forget a command and free its place in the device's window"""
+        device_id = self._pending.pop(correlation_id)[0]
+        self._windows[device_id].release()
+        self._leave(device_id)
+
+    def _leave(self, device_id: str) -> None:
+        """Drop the device's window once nothing uses it"""
+        self._users[device_id] -= 1
+        if not self._users[device_id]:
+            del self._users[device_id]
+            del self._windows[device_id]
+
+    def in_flight(self, device_id: str) -> int:
+        """Number of the device's commands waiting for an acknowledgement"""
+        return sum(1 for entry in self._pending.values() if entry[0] == device_id)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get command counts, timeouts and acknowledgement latency"""
+        return {
+            "window": self.window,
+            "timeout": self.timeout,
+            "in_flight": len(self._pending),
+            **self.stats,
+        }
@@ -0,0 +1,185 @@
+"""MQTT Ingest
+
+This module hands messages received on paho's network thread to the event
+loop. Messages wait in a bounded buffer shared by both threads, and the
+loop is woken with call_soon_threadsafe only when the buffer stops being
+empty. A consumer task drains the buffer in batches and dispatches them.
+"""
+
+import asyncio
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from loguru import logger
+
+from app.services.metrics import (
+    MQTT_INGEST_COALESCED,
+    MQTT_INGEST_DEPTH,
+    MQTT_INGEST_DROPPED,
+    MQTT_INGEST_LATENCY,
+)
+
+# What to do with a new message when the buffer is full
+OVERFLOW_POLICIES = ("drop_oldest", "block", "coalesce")
+
+# (topic, payload, time received)
+IngestMessage = Tuple[str, bytes, float]
+
+
+class MQTTIngestQueue:
+    """Bounded buffer from the MQTT network thread to a consumer task on the event loop
+
+    With "drop_oldest" a full buffer drops its oldest message, with "block"
+    the network thread waits for room, which slows down reading from the
+    broker. With "coalesce" a message replaces the pending one on the same
+    topic, and a full buffer drops its oldest topic. Coalescing only suits
+    topics where the latest value wins, so messages put with coalesce=False,
+    such as acknowledgements, always keep their own place.
+    """
+
+    def __init__(self, maxsize: int, policy: str = "drop_oldest", batch_size: int = 100):
+        """Initialize the queue"""
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {policy!r}, expected one of {OVERFLOW_POLICIES}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.batch_size = batch_size
+        self.running = False
+        self.task = None
+
+        self._lock = threading.Lock()
+        self._not_full = threading.Condition(self._lock)
+        # Keyed by topic when coalescing, by arrival otherwise
+        self._messages: "OrderedDict[Any, IngestMessage]" = OrderedDict()
+        self._sequence = itertools.count()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._wakeup_scheduled = False
+
+        self.stats: Dict[str, Any] = {
+            "received": 0,
+            "dispatched": 0,
+            "dropped": 0,
+            "coalesced": 0,
+            "errors": 0,
+            "max_depth": 0,
+            "last_latency": 0.0,
+            "max_latency": 0.0,
+        }
+
+    @property
+    def depth(self) -> int:
+        """Number of messages waiting"""
+        return len(self._messages)
+
+    def start(self, dispatch: Callable[[str, bytes], Awaitable[None]]) -> None:
+        """Start the consumer task, which awaits dispatch for every message"""
+        if self.running:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self.running = True
+        self.task = asyncio.create_task(self._consume(dispatch))
+
+    async def stop(self) -> None:
+        """Stop the consumer task, and release a network thread waiting for room"""
+        with self._lock:
+            self.running = False
+            self._not_full.notify_all()
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def put(self, topic: str, payload: bytes, coalesce: bool = True) -> bool:
+        """Add a message, called from the MQTT network thread
+
+        With coalesce=False the message never replaces a pending one, even
+        with the "coalesce" policy. Returns False if the message was not
+        queued because the queue is stopped.
+        """
+        received_at = time.monotonic()
+        with self._lock:
+            if not self.running:
+                return False
+            self.stats["received"] += 1
+
+            coalesce = coalesce and self.policy == "coalesce"
+            key: Any = topic
+            if coalesce and topic in self._messages:
+                # Keep the pending message's place in line, with the newer payload
+                self._messages[topic] = (topic, payload, received_at)
+                self.stats["coalesced"] += 1
+                MQTT_INGEST_COALESCED.inc()
+                return True
+            if not coalesce:
+                key = next(self._sequence)
+
+            if len(self._messages) >= self.maxsize:
+                if self.policy == "block":
+                    while len(self._messages) >= self.maxsize and self.running:
+                        self._not_full.wait(0.5)
+                    if not self.running:
+                        return False
+                else:
+                    self._messages.popitem(last=False)
+                    self.stats["dropped"] += 1
+                    MQTT_INGEST_DROPPED.inc()
+
+            self._messages[key] = (topic, payload, received_at)
+            if len(self._messages) > self.stats["max_depth"]:
+                self.stats["max_depth"] = len(self._messages)
+            wake = not self._wakeup_scheduled
+            self._wakeup_scheduled = True
+
+        if wake:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+        return True
+
+    def _take_batch(self) -> List[IngestMessage]:
+        """Take up to batch_size of the oldest messages"""
+        with self._lock:
+            count = min(self.batch_size, len(self._messages))
+            batch = [self._messages.popitem(last=False)[1] for _ in range(count)]
+            if self._messages:
+                # Come back for the rest after this batch
+                self._wakeup.set()
+            else:
+                self._wakeup_scheduled = False
+            self._not_full.notify_all()
+        return batch
+
+    async def _consume(self, dispatch: Callable[[str, bytes], Awaitable[None]]) -> None:
+        """Dispatch messages in batches as they arrive"""
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            batch = self._take_batch()
+            MQTT_INGEST_DEPTH.set(len(self._messages))
+
+            for topic, payload, received_at in batch:
+                try:
+                    await dispatch(topic, payload)
+                except Exception as e:
+                    self.stats["errors"] += 1
+                    logger.error(f"Error handling MQTT message on {topic}: {e}")
+                latency = time.monotonic() - received_at
+                MQTT_INGEST_LATENCY.observe(latency)
+                self.stats["last_latency"] = latency
+                if latency > self.stats["max_latency"]:
+                    self.stats["max_latency"] = latency
+            self.stats["dispatched"] += len(batch)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get the queue depth, drop and latency statistics"""
+        return {
+            "policy": self.policy,
+            "depth": len(self._messages),
+            "max_size": self.maxsize,
+            **self.stats,
+        }
@@ -0,0 +1,238 @@
+"""MQTT State Publisher
+
+This module publishes device state changes to the broker. Changes are
+coalesced per device for a short window, so a device changing many times
+a second is published once with its latest state. Publishing is limited
+to a rate for the whole hub and for each device, and changes held back by
+a limit keep coalescing until they are published.
+"""
+
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+from loguru import logger
+
+from app.models.record import DeviceRecord
+from app.services.metrics import (
+    MQTT_PUBLISH_COALESCED,
+    MQTT_PUBLISH_DEFERRED,
+    MQTT_PUBLISH_PENDING,
+)
+from app.services.serialization import dumps
+
+# Publish the full retained state, or only what changed on the delta topic
+PUBLISH_MODES = ("full", "delta")
+
+
+class MQTTStatePublisher:
+    """Coalescing, rate-limited publisher of device state
+
+    In "full" mode every publish is the whole device, retained on
+    prefix/<device_id>/state. In "delta" mode a device's first publish is
+    the retained state and later ones only carry the changed fields and
+    properties on prefix/<device_id>/delta. A deleted device has its
+    retained state cleared. A publish that fails stays pending and is tried
+    again.
+    """
+
+    def __init__(
+        self,
+        send: Callable[[str, bytes, bool], bool],
+        encode: Callable[[DeviceRecord], bytes],
+        topic_prefix: str,
+        window: float,
+        mode: str = "full",
+        rate_limit: float = 0.0,
+        device_rate_limit: float = 0.0,
+    ):
+        """Initialize the publisher
+
+        send publishes a payload to a topic, optionally retained, and returns
+        whether it succeeded. Rate limits are in publishes per second, 0 for
+        no limit.
+        """
+        if mode not in PUBLISH_MODES:
+            raise ValueError(f"Unknown publish mode {mode!r}, expected one of {PUBLISH_MODES}")
+        self.send = send
+        self.encode = encode
+        self.topic_prefix = topic_prefix
+        self.window = window
+        self.mode = mode
+        self.rate_limit = rate_limit
+        self.device_rate_limit = device_rate_limit
+        self.running = False
+        self.task = None
+
+        # Latest state waiting per device, None for a deleted device
+        self._pending: "OrderedDict[str, Optional[DeviceRecord]]" = OrderedDict()
+        self._wakeup = asyncio.Event()
+        # Allowed publishes left, refilled at rate_limit per second up to one second's worth
+        self._tokens = max(rate_limit, 1.0)
+        self._refilled_at = time.monotonic()
+        self._last_published: Dict[str, float] = {}
+        # Last published fields of each device, to build deltas from
+        self._published_state: Dict[str, Dict[str, Any]] = {}
+
+        self.stats: Dict[str, int] = {
+            "submitted": 0,
+            "published": 0,
+            "coalesced": 0,
+            "deferred": 0,
+            "unchanged": 0,
+            "errors": 0,
+        }
+
+    def start(self) -> None:
+        """Start the publishing task"""
+        if self.running:
+            return
+        self.running = True
+        self._wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop the publishing task and publish what is still pending, ignoring the limits"""
+        if not self.running:
+            return
+        self.running = False
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        self._publish_pending(time.monotonic(), limited=False)
+
+    def submit(self, device_id: str, device: Optional[DeviceRecord]) -> bool:
+        """Queue a device's state, or its deletion if device is None
+
+        Returns False if the publisher is not running.
+        """
+        if not self.running:
+            return False
+        self.stats["submitted"] += 1
+        if device_id in self._pending:
+            # Keep the pending change's place in line, with the newer state
+            self.stats["coalesced"] += 1
+            MQTT_PUBLISH_COALESCED.inc()
+        self._pending[device_id] = device
+        MQTT_PUBLISH_PENDING.set(len(self._pending))
+        self._wakeup.set()
+        return True
+
+    async def _run(self) -> None:
+        """Publish pending changes once per window while there are any"""
+        while True:
+            await self._wakeup.wait()
+            # Let changes coalesce for a window before publishing
+            await asyncio.sleep(self.window)
+            self._wakeup.clear()
+            self._publish_pending(time.monotonic())
+            if self._pending:
+                # Held back by a rate limit, try again after another window
+                self._wakeup.set()
+
+    def _publish_pending(self, now: float, limited: bool = True) -> None:
+        """Publish the pending changes the rate limits allow, oldest first"""
+        if limited and self.rate_limit:
+            self._tokens = min(
+                max(self.rate_limit, 1.0),
+                self._tokens + (now - self._refilled_at) * self.rate_limit,
+            )
+        self._refilled_at = now
+
+        device_interval = 1.0 / self.device_rate_limit if self.device_rate_limit else 0.0
+        failed = []
+        for device_id in list(self._pending):
+            if limited and self.rate_limit and self._tokens < 1.0:
+                self._defer(len(self._pending))
+                break
+            last = self._last_published.get(device_id)
+            if limited and last is not None and now - last < device_interval:
+                self._defer(1)
+                continue
+
+            device = self._pending.pop(device_id)
+            if limited and self.rate_limit:
+                self._tokens -= 1.0
+            try:
+                sent = self._publish(device_id, device, now)
+            except Exception as e:
+                sent = False
+                logger.error(f"Error publishing state of device {device_id}: {e}")
+            if not sent:
+                self.stats["errors"] += 1
+                failed.append((device_id, device))
+
+        # Try failed publishes again first next window, unless a newer change is waiting
+        for device_id, device in reversed(failed):
+            if device_id not in self._pending:
+                self._pending[device_id] = device
+                self._pending.move_to_end(device_id, last=False)
+        MQTT_PUBLISH_PENDING.set(len(self._pending))
+
+    def _defer(self, count: int) -> None:
+        """Count changes held back by a rate limit"""
+        self.stats["deferred"] += count
+        MQTT_PUBLISH_DEFERRED.inc(count)
+
+    def _publish(self, device_id: str, device: Optional[DeviceRecord], now: float) -> bool:
+        """Publish one device's state, delta or deletion, returns False if it was not sent"""
+        state_topic = f"{self.topic_prefix}/{device_id}/state"
+        if device is None:
+            # An empty retained message clears the retained state
+            self._last_published.pop(device_id, None)
+            self._published_state.pop(device_id, None)
+            sent = self.send(state_topic, b"", True)
+        elif self.mode == "delta" and device_id in self._published_state:
+            state = device.dict()
+            delta = self._delta(self._published_state[device_id], state)
+            if not delta:
+                self.stats["unchanged"] += 1
+                return True
+            sent = self.send(f"{self.topic_prefix}/{device_id}/delta", dumps(delta), False)
+            self._last_published[device_id] = now
+            if sent:
+                self._published_state[device_id] = state
+        else:
+            state = device.dict() if self.mode == "delta" else None
+            sent = self.send(state_topic, self.encode(device), True)
+            self._last_published[device_id] = now
+            # Deltas only start once the retained state they apply to is out
+            if sent and state is not None:
+                self._published_state[device_id] = state
+
+        if sent:
+            self.stats["published"] += 1
+        return sent
+
+    @staticmethod
+    def _delta(previous: Dict[str, Any], state: Dict[str, Any]) -> Dict[str, Any]:
+        """Get the fields that changed, with only the changed and removed properties"""
+        delta = {
+            field: value
+            for field, value in state.items()
+            if field != "properties" and previous.get(field) != value
+        }
+        old_properties, properties = previous["properties"], state["properties"]
+        changed = {
+            key: value
+            for key, value in properties.items()
+            if key not in old_properties or old_properties[key] != value
+        }
+        removed = [key for key in old_properties if key not in properties]
+        if changed:
+            delta["properties"] = changed
+        if removed:
+            delta["removed_properties"] = removed
+        return delta
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get publish counts, including publishes saved by coalescing"""
+        return {
+            "mode": self.mode,
+            "pending": len(self._pending),
+            **self.stats,
+        }
@@ -0,0 +1,124 @@
+"""MQTT Topic Router
+
+This module matches MQTT topics against subscription patterns with the +
+(one level) and # (any remaining levels) wildcards. Patterns are stored in
+a trie keyed by topic level, so a lookup follows the topic's levels and
+costs the same however many patterns are registered.
+"""
+
+from typing import Any, Dict, List
+
+
+class _Node:
+    """One topic level in the trie"""
+
+    __slots__ = ("children", "handlers", "multi_handlers")
+
+    def __init__(self):
+        """Initialize the node"""
+        self.children: Dict[str, "_Node"] = {}
+        # Handlers of patterns ending at this level, and of patterns ending in # here
+        self.handlers: List[Any] = []
+        self.multi_handlers: List[Any] = []
+
+    def is_empty(self) -> bool:
+        """Whether the node holds no handlers and has no children"""
+        return not (self.children or self.handlers or self.multi_handlers)
+
+
+def validate_pattern(pattern: str) -> List[str]:
+    """Split a subscription pattern into levels, raising ValueError if it is not valid MQTT"""
+    if not pattern:
+        raise ValueError("Topic pattern is empty")
+    levels = pattern.split("/")
+    for position, level in enumerate(levels):
+        if level == "#":
+            if position != len(levels) - 1:
+                raise ValueError(f"# must be the last level of {pattern!r}")
+        elif level != "+" and ("+" in level or "#" in level):
+            raise ValueError(f"Wildcards must take a whole level in {pattern!r}")
+    return levels
+
+
+class TopicRouter:
+    """Routes topics to the handlers of every matching pattern"""
+
+    def __init__(self):
+        """Initialize the router"""
+        self._root = _Node()
+        self._patterns: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        """Number of registered (pattern, handler) routes"""
+        return sum(self._patterns.values())
+
+    def patterns(self) -> List[str]:
+        """Get the distinct registered patterns"""
+        return list(self._patterns)
+
+    def add(self, pattern: str, handler: Any) -> None:
+        """Register a handler for a pattern, a pattern can have many handlers"""
+        levels = validate_pattern(pattern)
+        node = self._root
+        multi = levels[-1] == "#"
+        for level in levels[:-1] if multi else levels:
+            node = node.children.setdefault(level, _Node())
+        (node.multi_handlers if multi else node.handlers).append(handler)
+        self._patterns[pattern] = self._patterns.get(pattern, 0) + 1
+
+    def remove(self, pattern: str, handler: Any) -> bool:
+        """Unregister a handler from a pattern, returns False if it was not registered"""
+        levels = validate_pattern(pattern)
+        multi = levels[-1] == "#"
+        path = [self._root]
+        for level in levels[:-1] if multi else levels:
+            node = path[-1].children.get(level)
+            if node is None:
+                return False
+            path.append(node)
+
+        handlers = path[-1].multi_handlers if multi else path[-1].handlers
+        if handler not in handlers:
+            return False
+        handlers.remove(handler)
+        self._patterns[pattern] -= 1
+        if not self._patterns[pattern]:
+            del self._patterns[pattern]
+
+        # Prune the levels nothing is registered under anymore
+        for level, parent, node in zip(
+            reversed(levels[: len(path) - 1]), reversed(path[:-1]), reversed(path[1:])
+        ):
+            if not node.is_empty():
+                break
+            del parent.children[level]
+        return True
+
+    def match(self, topic: str) -> List[Any]:
+        """Get the handlers of every pattern matching a topic"""
+        levels = topic.split("/")
+        matched: List[Any] = []
+        # Wildcards at the first level do not match topics starting with $, like $SYS
+        system = topic.startswith("$")
+        nodes = [self._root]
+        for depth, level in enumerate(levels):
+            next_nodes = []
+            for node in nodes:
+                if node.multi_handlers and not (system and depth == 0):
+                    matched.extend(node.multi_handlers)
+                child = node.children.get(level)
+                if child is not None:
+                    next_nodes.append(child)
+                if not (system and depth == 0):
+                    wildcard = node.children.get("+")
+                    if wildcard is not None:
+                        next_nodes.append(wildcard)
+            if not next_nodes:
+                return matched
+            nodes = next_nodes
+
+        for node in nodes:
+            matched.extend(node.handlers)
+            # "a/#" also matches "a" itself
+            matched.extend(node.multi_handlers)
+        return matched
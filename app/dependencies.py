@@ -0,0 +1,68 @@
+"""Dependencies
+
+This module provides the application-scoped services to routes. The services
+are created once in the application lifespan and stored on the app state.
+"""
+
+import secrets
+from typing import Optional
+from fastapi import Header, HTTPException, Request, status
+
+from app.core.bluetooth import BluetoothManager
+from app.core.mqtt import MQTTClient
+from app.services.device_service import DeviceService
+from app.services.event_stream import EventBroker
+from app.services.profiling import Profiler
+from config import settings
+
+
+def get_device_service(request: Request) -> DeviceService:
+    """Get the shared device registry"""
+    return request.app.state.device_service
+
+
+def get_bluetooth_manager(request: Request) -> BluetoothManager:
+    """Get the shared Bluetooth manager"""
+    return request.app.state.bluetooth_manager
+
+
+def get_mqtt_client(request: Request) -> MQTTClient:
+    """Get the shared MQTT client"""
+    return request.app.state.mqtt_client
+
+
+def get_event_broker(request: Request) -> EventBroker:
+    """Get the shared event broker"""
+    return request.app.state.event_broker
+
+
+def get_profiler(request: Request) -> Profiler:
+    """Get the shared profiler"""
+    return request.app.state.profiler
+
+
+def require_api_key(x_api_key: Optional[str] = Header(None)) -> None:
+    """Allow admin endpoints only with the configured API key
+
+    Admin endpoints stay disabled while API_KEY is empty.
+    """
+    if not settings.API_KEY:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Set API_KEY to use admin endpoints",
+        )
+    if not x_api_key or not secrets.compare_digest(x_api_key, settings.API_KEY):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid or missing API key",
+        )
+
+
+def require_ready(request: Request) -> None:
+    """Reject changes to the registry while stored devices are still loading"""
+    if request.app.state.device_service.loading:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Devices are still loading",
+            headers={"Retry-After": "1"},
+        )
@@ -44,6 +44,43 @@ class DeviceUpdate(BaseModel):
     properties: Optional[Dict[str, Any]] = Field(None, description="Device properties")
 
 
+class DeviceActionRequest(BaseModel):
+    """Model for running one action on many devices"""
+
+    action: DeviceAction = Field(..., description="Action to perform")
+    device_ids: Optional[List[str]] = Field(None, description="Devices to target")
+    device_type: Optional[DeviceType] = Field(None, description="Target all devices of this type")
+    status: Optional[str] = Field(None, description="Target all devices with this status")
+
+
+class DeviceActionResult(BaseModel):
+    """Model for the outcome of an action on one device"""
+
+    device_id: str = Field(..., description="Device ID")
+    success: bool = Field(..., description="Whether the action ran without errors")
+    error: Optional[str] = Field(None, description="Why the action failed")
+    status: Optional[str] = Field(None, description="Device status after the action")
+    duration: float = Field(..., description="Time spent on the device in seconds")
+
+
+class DeviceBatchOp(str, Enum):
+    """Batch operation types"""
+
+    CREATE = "create"
+    UPDATE = "update"
+    DELETE = "delete"
+
+
+class DeviceBatchOperation(BaseModel):
+    """Model for one operation in a batch request"""
+
+    op: DeviceBatchOp = Field(..., description="Operation to perform")
+    device_id: Optional[str] = Field(None, description="ID of the device to update or delete")
+    data: Optional[Dict[str, Any]] = Field(
+        None, description="Device fields, as for a single create or update"
+    )
+
+
 class Device(BaseModel):
     """Device model"""
 
@@ -70,4 +107,15 @@ class Device(BaseModel):
                 "last_seen": "2023-04-01T12:00:00Z",
                 "actions": ["connect", "disconnect", "play", "pause"],
             }
-        }
\ No newline at end of file
+        }
+
+
+class DeviceBatchResult(BaseModel):
+    """Model for the result of one batch operation"""
+
+    index: int = Field(..., description="Position of the operation in the batch")
+    op: DeviceBatchOp = Field(..., description="Operation performed")
+    device_id: Optional[str] = Field(None, description="ID of the affected device")
+    success: bool = Field(..., description="Whether the operation was valid and applied")
+    error: Optional[str] = Field(None, description="Why the operation was rejected")
+    device: Optional[Device] = Field(None, description="The device after the operation")
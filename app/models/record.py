@@ -0,0 +1,147 @@
+"""Device Records
+
+This module contains the compact representation the device registry keeps
+in memory. Pydantic models are only built from records at the API edge.
+"""
+
+import sys
+from datetime import datetime
+from typing import Any, Dict, Iterable, Optional, Set, Tuple
+
+from app.models.device import Device, DeviceType
+
+# Default actions per device type, shared by every record of that type
+DEFAULT_ACTIONS: Dict[DeviceType, Tuple[str, ...]] = {
+    DeviceType.BLUETOOTH: ("connect", "disconnect"),
+    DeviceType.MQTT: ("publish", "subscribe"),
+    DeviceType.VIRTUAL: ("on", "off"),
+    DeviceType.OTHER: (),
+}
+
+# Shared by records loaded with the default actions of their type
+_SHARED_ACTIONS = {actions: actions for actions in DEFAULT_ACTIONS.values()}
+
+
+def intern_actions(actions: Iterable[str]) -> Tuple[str, ...]:
+    """Convert actions to a tuple, shared with other records where possible"""
+    actions = tuple(sys.intern(action) for action in actions)
+    return _SHARED_ACTIONS.get(actions, actions)
+
+
+class DeviceRecord:
+    """A registered device, with the same fields as the Device model"""
+
+    __slots__ = (
+        "id", "name", "type", "address", "status", "properties", "_last_seen", "last_seen_at", "actions"
+    )
+
+    def __init__(
+        self,
+        id: str,
+        name: str,
+        type: DeviceType,
+        address: Optional[str] = None,
+        status: str = "unknown",
+        properties: Optional[Dict[str, Any]] = None,
+        last_seen: Optional[str] = None,
+        actions: Iterable[str] = (),
+    ):
+        """Initialize the record"""
+        self.id = id
+        self.name = name
+        self.type = DeviceType(type)
+        self.address = address
+        self.status = sys.intern(status)
+        self.properties = properties if properties is not None else {}
+        self.last_seen = last_seen
+        self.actions = intern_actions(actions)
+
+    @property
+    def last_seen(self) -> Optional[str]:
+        """When the device was last seen, as stored (ISO 8601)"""
+        return self._last_seen
+
+    @last_seen.setter
+    def last_seen(self, value: Optional[str]) -> None:
+        """Set when the device was last seen, parsed once into last_seen_at for filtering
+
+        last_seen_at is a POSIX timestamp, naive times being local time, or
+        None if the value is missing or not ISO 8601.
+        """
+        self._last_seen = value
+        self.last_seen_at = None
+        if value:
+            try:
+                self.last_seen_at = datetime.fromisoformat(value).timestamp()
+            except (TypeError, ValueError):
+                pass
+
+    @classmethod
+    def from_model(cls, device: Device) -> "DeviceRecord":
+        """Create a record from a validated Device model"""
+        return cls(
+            id=device.id,
+            name=device.name,
+            type=device.type,
+            address=device.address,
+            status=device.status,
+            properties=device.properties,
+            last_seen=device.last_seen,
+            actions=device.actions,
+        )
+
+    @classmethod
+    def from_trusted(cls, data: Dict[str, Any]) -> "DeviceRecord":
+        """Create a record from data the hub wrote itself, skipping pydantic validation
+
+        Only the field types are checked. Raises ValueError if the data does
+        not look like a stored device, so callers can fall back to validation.
+        """
+        try:
+            id, name, device_type = data["id"], data["name"], data["type"]
+            address = data.get("address")
+            status = data.get("status", "unknown")
+            properties = data.get("properties", {})
+            last_seen = data.get("last_seen")
+            actions = data.get("actions", ())
+        except (KeyError, TypeError, AttributeError):
+            raise ValueError("Not a stored device")
+
+        if not (
+            isinstance(id, str)
+            and isinstance(name, str)
+            and isinstance(status, str)
+            and isinstance(properties, dict)
+            and isinstance(actions, (list, tuple))
+            and (address is None or isinstance(address, str))
+            and (last_seen is None or isinstance(last_seen, str))
+        ):
+            raise ValueError(f"Stored device {id!r} has fields of the wrong type")
+        try:
+            return cls(id, name, device_type, address, status, properties, last_seen, actions)
+        except TypeError as e:
+            raise ValueError(str(e))
+
+    def dict(self, include: Optional[Set[str]] = None) -> Dict[str, Any]:
+        """Get the fields as a dictionary, in the same shape as Device.dict()"""
+        data = {
+            "id": self.id,
+            "name": self.name,
+            "type": self.type,
+            "address": self.address,
+            "status": self.status,
+            "properties": dict(self.properties),
+            "last_seen": self.last_seen,
+            "actions": list(self.actions),
+        }
+        if include is not None:
+            return {field: value for field, value in data.items() if field in include}
+        return data
+
+    def to_model(self) -> Device:
+        """Build the API model, skipping validation since records are already valid"""
+        return Device.construct(**self.dict())
+
+    def __repr__(self) -> str:
+        """Show the record like the Device model does"""
+        return f"DeviceRecord(id={self.id!r}, name={self.name!r}, type={self.type.value!r}, status={self.status!r})"
@@ -0,0 +1,76 @@
+"""Device Action Queues
+
+This module serializes actions per device. Actions for one device run one at
+a time in arrival order, while actions for different devices run in parallel.
+"""
+
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Any
+
+
+class DeviceQueueFullError(Exception):
+    """Raised when a device already has the maximum number of queued actions"""
+
+
+class DeviceActionQueues:
+    """Per-device FIFO queues with bounded depth"""
+
+    def __init__(self, max_depth: int):
+        """Initialize the action queues"""
+        self.max_depth = max_depth
+        # Only devices with queued or running actions have a lock
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._depths: Dict[str, int] = {}
+        self.stats: Dict[str, Dict[str, Any]] = {}
+
+    @asynccontextmanager
+    async def slot(self, device_id: str):
+        """Wait for the device's turn, rejecting the action if the queue is full"""
+        stats = self.stats.setdefault(
+            device_id,
+            {"executed": 0, "rejected": 0, "total_wait": 0.0, "max_wait": 0.0, "last_wait": 0.0},
+        )
+        depth = self._depths.get(device_id, 0)
+        if depth >= self.max_depth:
+            stats["rejected"] += 1
+            raise DeviceQueueFullError(
+                f"Device {device_id} already has {depth} queued actions"
+            )
+
+        lock = self._locks.setdefault(device_id, asyncio.Lock())
+        self._depths[device_id] = depth + 1
+        enqueued = time.monotonic()
+        try:
+            async with lock:
+                wait = time.monotonic() - enqueued
+                stats["executed"] += 1
+                stats["total_wait"] += wait
+                stats["last_wait"] = wait
+                stats["max_wait"] = max(stats["max_wait"], wait)
+                yield
+        finally:
+            self._depths[device_id] -= 1
+            if not self._depths[device_id]:
+                del self._depths[device_id]
+                del self._locks[device_id]
+
+    def get_stats(self, device_id: str) -> Dict[str, Any]:
+        """Get queue depth and wait times for a device"""
+        stats = self.stats.get(device_id, {})
+        executed = stats.get("executed", 0)
+        return {
+            "device_id": device_id,
+            "depth": self._depths.get(device_id, 0),
+            "max_depth": self.max_depth,
+            "executed": executed,
+            "rejected": stats.get("rejected", 0),
+            "last_wait": stats.get("last_wait", 0.0),
+            "max_wait": stats.get("max_wait", 0.0),
+            "avg_wait": stats["total_wait"] / executed if executed else 0.0,
+        }
+
+    def forget(self, device_id: str) -> None:
+        """Drop the statistics of a deleted device"""
+        self.stats.pop(device_id, None)
@@ -3,15 +3,43 @@
 This module contains the business logic for device management.
 """
 
-import json
+import asyncio
+import bisect
+import itertools
 import os
+import sys
+import time
 import uuid
+from collections import deque
+from contextlib import contextmanager
 from datetime import datetime
-from typing import Dict, List, Optional, Any
+from typing import Deque, Dict, Iterator, List, Optional, Any, Set, Tuple
 from loguru import logger
+from pydantic import ValidationError
 
-from app.models.device import Device, DeviceCreate, DeviceUpdate, DeviceAction, DeviceType
+from app.models.device import (
+    Device,
+    DeviceCreate,
+    DeviceUpdate,
+    DeviceAction,
+    DeviceType,
+    DeviceBatchOp,
+    DeviceBatchOperation,
+    DeviceBatchResult,
+    DeviceActionResult,
+)
+from app.models.record import DEFAULT_ACTIONS, DeviceRecord
 from app.core.bluetooth import BluetoothManager
+from app.core.mqtt_commands import MQTTCommandError
+from app.services.action_queue import DeviceActionQueues
+from app.services.event_stream import EventBroker
+from app.services.history import DeviceHistory, HistoryEntry, HistorySegments
+from app.services.journal import DeviceJournal
+from app.services.metrics import DEVICE_ACTION_DURATION, STORE_WRITE_BYTES, STORE_WRITE_DURATION
+from app.services.serialization import DeviceJSONCache
+from app.services.storage import create_store
+from app.services.telemetry import Telemetry, TelemetryPoint
+from config import settings
 
 # Try to import the MQTT client, but don't fail if it's not available
 try:
@@ -20,36 +48,393 @@ try:
 except ImportError:
     MQTT_CLIENT_AVAILABLE = False
 
+# Directory where device data is stored
+DATA_DIR = os.path.join(os.path.dirname(__file__), "../../data")
+
+# Devices added to the registry at a time when loading in the background
+LOAD_BATCH_SIZE = 1000
+
+# Fields of a state report that are not properties
+STATE_REPORT_FIELDS = ("status", "properties", "value")
+
+# Statuses counted as online or offline on the dashboard
+ONLINE_STATUSES = ("online", "connected", "on")
+OFFLINE_STATUSES = ("offline", "disconnected", "off")
+
 
 class DeviceService:
     """Service for managing devices"""
 
-    def __init__(self):
-        """Initialize the device service"""
-        self.devices: Dict[str, Device] = {}
-        self.devices_file = os.path.join(os.path.dirname(__file__), "../../data/devices.json")
-        self.bluetooth_manager = BluetoothManager()
-        
-        # Load devices from file
-        self._load_devices()
+    def __init__(
+        self,
+        bluetooth_manager: Optional[BluetoothManager] = None,
+        mqtt_client: Optional["MQTTClient"] = None,
+        event_broker: Optional[EventBroker] = None,
+        background_load: bool = False,
+    ):
+        """Initialize the device service
+
+        With background_load, devices are loaded by start() while the
+        service already answers reads, instead of in the constructor.
+        """
+        self.devices: Dict[str, DeviceRecord] = {}
+        self.store = create_store(DATA_DIR)
+        self.mqtt_client = mqtt_client
+        # Pushes device changes to connected clients
+        self.event_broker = event_broker or EventBroker(settings.EVENT_BUFFER_SIZE)
+        # Encoded device JSON, shared by the API, MQTT publishing and persistence
+        self.json_cache = DeviceJSONCache()
+        if mqtt_client:
+            mqtt_client.state_encoder = self.get_device_json
+
+        # Secondary indexes, kept up to date on every change
+        self.type_index: Dict[str, Set[str]] = {}
+        self.status_index: Dict[str, Set[str]] = {}
+        self.address_index: Dict[str, str] = {}
+        self.sorted_ids: List[str] = []
+        self._indexed: Dict[str, Tuple[str, str, Optional[str]]] = {}
+
+        # Versions bumped on every change, for the registry and each device.
+        # Start from the clock so versions from a previous run are always older.
+        self.version = self.start_version = int(time.time() * 1000)
+        self.device_versions: Dict[str, int] = {}
+
+        # Recent (version, device ID) changes, for clients syncing deltas
+        self.change_log: Deque[Tuple[int, str]] = deque()
+        # Changes at or below this version are no longer in the log
+        self._change_log_floor = self.start_version
+
+        # Status and property changes of each device, optionally kept on disk
+        segments = None
+        if settings.HISTORY_PERSIST:
+            segments = HistorySegments(
+                os.path.join(DATA_DIR, "history"),
+                settings.HISTORY_SEGMENT_INTERVAL,
+                settings.HISTORY_RETENTION_DAYS * 86400,
+            )
+        self.history = DeviceHistory(
+            settings.HISTORY_BUFFER_SIZE, segments, settings.HISTORY_MAX_PENDING
+        )
+
+        # Numeric property readings, with rollups per minute, hour and day
+        self.telemetry = Telemetry(
+            settings.TELEMETRY_SAMPLES,
+            {
+                "1m": settings.TELEMETRY_MINUTES,
+                "1h": settings.TELEMETRY_HOURS,
+                "1d": settings.TELEMETRY_DAYS,
+            },
+            settings.TELEMETRY_MAX_SERIES,
+        )
+
+        # Share the registry with the Bluetooth manager and its discovery loop
+        self.bluetooth_manager = bluetooth_manager or BluetoothManager()
+        self.bluetooth_manager.device_lookup = self.devices.get
+        self.bluetooth_manager.register_discovery_callback(self._on_devices_discovered)
+
+        # Journal of changes since the last snapshot (journal mode only)
+        self.journal: Optional[DeviceJournal] = None
+        if settings.PERSISTENCE_MODE == "journal":
+            if self.store.incremental:
+                logger.warning(
+                    f"Journal mode is not used with the {self.store.name} engine, writing behind instead"
+                )
+            else:
+                self.journal = DeviceJournal(os.path.join(DATA_DIR, "devices.journal"))
+
+        # Write-behind persistence state
+        self.write_behind = settings.PERSISTENCE_MODE in ("write_behind", "journal")
+        self.flush_running = False
+        self.flush_task = None
+        self._flush_lock = asyncio.Lock()
+        self._dirty_event = asyncio.Event()
+        self._threshold_event = asyncio.Event()
+        self._pending_changes = 0
+        self._dirty_since: Optional[float] = None
+        # Changed devices not yet written (None marks a deletion)
+        self._changes: Dict[str, Optional[DeviceRecord]] = {}
+        self._batch_depth = 0
+
+        # Run actions for each device one at a time, in arrival order
+        self.action_queues = DeviceActionQueues(settings.ACTION_QUEUE_DEPTH)
+
+        # State reported by MQTT devices, merged per device until applied as one batch
+        self._state_reports: Dict[str, Tuple[Optional[str], Dict[str, Any]]] = {}
+        self._state_event = asyncio.Event()
+        self.state_task = None
+        self.state_stats: Dict[str, int] = {
+            "received": 0,
+            "coalesced": 0,
+            "applied": 0,
+            "unchanged": 0,
+            "unknown": 0,
+            "echoes": 0,
+            "dropped": 0,
+            "batches": 0,
+        }
+        if mqtt_client:
+            mqtt_client.register_callback("state", self._on_mqtt_state)
+
+        # Limit how many actions run at once on each backend
+        self._action_limits: Dict[DeviceType, asyncio.Semaphore] = {
+            DeviceType.BLUETOOTH: asyncio.Semaphore(settings.ACTION_CONCURRENCY_BLUETOOTH),
+            DeviceType.MQTT: asyncio.Semaphore(settings.ACTION_CONCURRENCY_MQTT),
+            DeviceType.VIRTUAL: asyncio.Semaphore(settings.ACTION_CONCURRENCY_VIRTUAL),
+            DeviceType.OTHER: asyncio.Semaphore(settings.ACTION_CONCURRENCY_OTHER),
+        }
+        # Created here, they are recorded from persistence worker threads
+        self._write_duration = STORE_WRITE_DURATION.labels(self.store.name)
+        self._write_bytes = STORE_WRITE_BYTES.labels(self.store.name)
+        self.persistence_stats: Dict[str, Any] = {
+            "writes": 0,
+            "changes_written": 0,
+            "bytes_written": 0,
+            "errors": 0,
+            "last_flush_at": None,
+            "last_flush_duration": 0.0,
+        }
+
+        # Loading state, reported by the readiness endpoint
+        self.loading = True
+        self._loaded = asyncio.Event()
+        self.load_task = None
+        self.background_load = background_load
+        self.load_stats: Dict[str, Any] = {
+            "started_at": None,
+            "duration": 0.0,
+            "replayed": 0,
+            "error": None,
+        }
+        if not background_load:
+            self._load_devices()
+
+    async def start(self) -> None:
+        """Start loading devices if needed, and the background flush or compaction task"""
+        if self.background_load and self.loading and not self.load_task:
+            self.load_task = asyncio.create_task(self._load_devices_in_background())
+        self.history.start(settings.HISTORY_FLUSH_INTERVAL)
+        if self.mqtt_client and not self.state_task:
+            self.state_task = asyncio.create_task(self._state_loop())
+
+        if not self.write_behind:
+            logger.info("Write-behind persistence disabled, saving on every change")
+            return
+
+        if self.flush_running:
+            logger.warning("Device flush task already running")
+            return
+
+        self.flush_running = True
+        self.flush_task = asyncio.create_task(self._flush_loop())
+        logger.info(f"Started {settings.PERSISTENCE_MODE} device persistence")
+
+    async def stop(self) -> None:
+        """Stop the background flush task and write any pending changes"""
+        if self.load_task and not self.load_task.done():
+            self.load_task.cancel()
+            try:
+                await self.load_task
+            except asyncio.CancelledError:
+                pass
+
+        if self.state_task:
+            self.state_task.cancel()
+            try:
+                await self.state_task
+            except asyncio.CancelledError:
+                pass
+            self.state_task = None
+            if not self.loading:
+                self._apply_state_reports()
+
+        if self.flush_running:
+            self.flush_running = False
+            if self.flush_task:
+                self.flush_task.cancel()
+                try:
+                    await self.flush_task
+                except asyncio.CancelledError:
+                    pass
+            logger.info(f"Stopped {settings.PERSISTENCE_MODE} device persistence")
+
+        # Final flush so no acknowledged change is lost on shutdown
+        await self.flush()
+        await self.history.stop()
+        if self.journal:
+            self.journal.close()
+        self.store.close()
+
+    async def get_devices(
+        self, device_type: Optional[str] = None, status: Optional[str] = None
+    ) -> List[DeviceRecord]:
+        """Get all devices or filter by type and status"""
+        if not device_type and not status:
+            return list(self.devices.values())
+        device_type = getattr(device_type, "value", device_type)
+
+        # Walk the smaller index and check the other one
+        candidates = [
+            index.get(key, set())
+            for index, key in ((self.type_index, device_type), (self.status_index, status))
+            if key
+        ]
+        candidates.sort(key=len)
+        device_ids = candidates[0]
+        if len(candidates) > 1:
+            device_ids = [d for d in device_ids if d in candidates[1]]
+        return [self.devices[device_id] for device_id in device_ids]
+
+    async def get_devices_page(
+        self,
+        limit: int,
+        after: Optional[str] = None,
+        device_type: Optional[str] = None,
+        status: Optional[str] = None,
+        last_seen_from: Optional[datetime] = None,
+        last_seen_to: Optional[datetime] = None,
+    ) -> Tuple[List[DeviceRecord], Optional[str]]:
+        """Get one page of devices ordered by ID, starting after the given ID
+
+        Returns the page and the ID to continue after, or None on the last page.
+        Only the page itself is held in memory, whatever the fleet size. Naive
+        last_seen bounds are local time.
+        """
+        device_type = getattr(device_type, "value", device_type)
+        filters = [
+            index.get(key, set())
+            for index, key in ((self.type_index, device_type), (self.status_index, status))
+            if key
+        ]
+        filters.sort(key=len)
+
+        # Walk a small filter set in order, otherwise walk all IDs and test membership
+        ordered_ids = self.sorted_ids
+        if filters and len(filters[0]) * 8 < len(self.sorted_ids):
+            ordered_ids = sorted(filters[0])
+            filters = filters[1:]
+
+        seen_from = last_seen_from.timestamp() if last_seen_from else None
+        seen_to = last_seen_to.timestamp() if last_seen_to else None
 
-    async def get_devices(self, device_type: Optional[str] = None) -> List[Device]:
-        """Get all devices or filter by type"""
-        if device_type:
-            return [d for d in self.devices.values() if d.type == device_type]
-        return list(self.devices.values())
+        page: List[DeviceRecord] = []
+        start = bisect.bisect_right(ordered_ids, after) if after else 0
+        for position in range(start, len(ordered_ids)):
+            device_id = ordered_ids[position]
+            if any(device_id not in ids for ids in filters):
+                continue
 
-    async def get_device(self, device_id: str) -> Optional[Device]:
+            device = self.devices[device_id]
+            if seen_from is not None or seen_to is not None:
+                seen = device.last_seen_at
+                if seen is None:
+                    continue
+                if seen_from is not None and seen < seen_from:
+                    continue
+                if seen_to is not None and seen > seen_to:
+                    continue
+
+            # Only hand out a cursor if another matching device follows the page
+            if len(page) == limit:
+                return page, page[-1].id
+            page.append(device)
+        return page, None
+
+    async def get_device_by_address(self, address: str) -> Optional[DeviceRecord]:
+        """Get a specific device by address"""
+        device_id = self.address_index.get(address)
+        return self.devices.get(device_id) if device_id else None
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get device counts by type and status"""
+        by_type = {key: len(ids) for key, ids in self.type_index.items() if ids}
+        by_status = {key: len(ids) for key, ids in self.status_index.items() if ids}
+        return {
+            "total": len(self.devices),
+            **{device_type.value: by_type.get(device_type.value, 0) for device_type in DeviceType},
+            "online": sum(by_status.get(s, 0) for s in ONLINE_STATUSES),
+            "offline": sum(by_status.get(s, 0) for s in OFFLINE_STATUSES),
+            "unknown": by_status.get("unknown", 0),
+            "by_type": by_type,
+            "by_status": by_status,
+        }
+
+    def get_version(self, device_id: Optional[str] = None) -> Optional[int]:
+        """Get the version of a device, or of the whole registry if no ID is given
+
+        Returns None for unknown devices. Devices loaded at startup are at the
+        start version.
+        """
+        if device_id is None:
+            return self.version
+        if device_id not in self.devices:
+            return None
+        return self.device_versions.get(device_id, self.start_version)
+
+    def get_device_json(self, device: DeviceRecord) -> bytes:
+        """Get the JSON encoding of a device, cached until it next changes"""
+        return self.json_cache.get(
+            device, self.device_versions.get(device.id, self.start_version)
+        )
+
+    def get_changes(self, since: int) -> Optional[Tuple[List[DeviceRecord], List[str]]]:
+        """Get devices changed and IDs of devices deleted after a registry version
+
+        Returns None if the changes are no longer in the change log and the
+        client has to resync everything.
+        """
+        if since < self._change_log_floor or since > self.version:
+            return None
+
+        # The log is ordered by version, so walk back from the newest change
+        changed: Dict[str, None] = {}
+        for version, device_id in reversed(self.change_log):
+            if version <= since:
+                break
+            changed[device_id] = None
+
+        devices = [self.devices[d] for d in changed if d in self.devices]
+        deleted = [d for d in changed if d not in self.devices]
+        return devices, deleted
+
+    async def get_history(
+        self, device_id: str, start: float, end: float, limit: int
+    ) -> Optional[List[HistoryEntry]]:
+        """Get a device's newest changes between two timestamps, newest first
+
+        Returns None if the device does not exist.
+        """
+        if device_id not in self.devices:
+            return None
+        return await self.history.query(device_id, start, end, limit)
+
+    async def get_telemetry(
+        self,
+        device_id: str,
+        name: Optional[str],
+        resolution: str,
+        start: float,
+        end: float,
+        limit: int,
+    ) -> Optional[Dict[str, List[TelemetryPoint]]]:
+        """Get the readings of one or every numeric property of a device
+
+        Returns None if the device does not exist.
+        """
+        if device_id not in self.devices:
+            return None
+        return self.telemetry.query(device_id, name, resolution, start, end, limit)
+
+    async def get_device(self, device_id: str) -> Optional[DeviceRecord]:
         """Get a specific device by ID"""
         return self.devices.get(device_id)
 
-    async def create_device(self, device_create: DeviceCreate) -> Device:
+    async def create_device(self, device_create: DeviceCreate) -> DeviceRecord:
         """Create a new device"""
         # Generate a new device ID
         device_id = str(uuid.uuid4())
         
-        # Create the device
-        device = Device(
+        # Create the device, with the default actions of its type
+        device = DeviceRecord(
             id=device_id,
             name=device_create.name,
             type=device_create.type,
@@ -57,26 +442,21 @@ class DeviceService:
             status="offline",
             properties=device_create.properties,
             last_seen=datetime.now().isoformat(),
+            actions=DEFAULT_ACTIONS[device_create.type],
         )
         
-        # Add default actions based on device type
-        if device.type == DeviceType.BLUETOOTH:
-            device.actions = ["connect", "disconnect"]
-        elif device.type == DeviceType.MQTT:
-            device.actions = ["publish", "subscribe"]
-        elif device.type == DeviceType.VIRTUAL:
-            device.actions = ["on", "off"]
-        
         # Add the device to the collection
         self.devices[device_id] = device
         
-        # Save devices to file
-        self._save_devices()
+        # Persist the change
+        self._mark_dirty("create", device)
         
         logger.info(f"Created device: {device.name} ({device.id})")
         return device
 
-    async def update_device(self, device_id: str, device_update: DeviceUpdate) -> Optional[Device]:
+    async def update_device(
+        self, device_id: str, device_update: DeviceUpdate
+    ) -> Optional[DeviceRecord]:
         """Update an existing device"""
         device = self.devices.get(device_id)
         if not device:
@@ -90,15 +470,16 @@ class DeviceService:
         if device_update.address is not None:
             device.address = device_update.address
         if device_update.status is not None:
-            device.status = device_update.status
+            device.status = sys.intern(device_update.status)
         if device_update.properties is not None:
             device.properties = device_update.properties
+            self.telemetry.record(device.id, device_update.properties)
         
         # Update last_seen timestamp
         device.last_seen = datetime.now().isoformat()
         
-        # Save devices to file
-        self._save_devices()
+        # Persist the change
+        self._mark_dirty("update", device)
         
         logger.info(f"Updated device: {device.name} ({device.id})")
         return device
@@ -110,40 +491,186 @@ class DeviceService:
         
         # Remove the device from the collection
         device = self.devices.pop(device_id)
+        self.action_queues.forget(device_id)
+        self.telemetry.forget(device_id)
         
-        # Save devices to file
-        self._save_devices()
+        # Persist the change
+        self._mark_dirty("delete", device)
         
         logger.info(f"Deleted device: {device.name} ({device.id})")
         return True
 
-    async def execute_action(self, device_id: str, action: DeviceAction) -> Optional[Device]:
+    async def apply_batch(
+        self, operations: List[DeviceBatchOperation]
+    ) -> Tuple[bool, List[DeviceBatchResult]]:
+        """Validate and apply create, update and delete operations as one unit
+
+        Nothing is applied unless every operation is valid, and all changes
+        are persisted together. Returns whether the batch was applied and the
+        result of each operation.
+        """
+        # Validate everything before touching the registry
+        parsed: List[Any] = []
+        errors: Dict[int, str] = {}
+        deleted: Set[str] = set()
+        for index, operation in enumerate(operations):
+            try:
+                if operation.op == DeviceBatchOp.CREATE:
+                    parsed.append(DeviceCreate(**(operation.data or {})))
+                    continue
+
+                if not operation.device_id:
+                    raise ValueError("device_id is required")
+                if operation.device_id not in self.devices or operation.device_id in deleted:
+                    raise ValueError(f"Device with ID {operation.device_id} not found")
+                if operation.op == DeviceBatchOp.UPDATE:
+                    parsed.append(DeviceUpdate(**(operation.data or {})))
+                else:
+                    deleted.add(operation.device_id)
+                    parsed.append(None)
+            except ValidationError as e:
+                errors[index] = "; ".join(
+                    f"{'.'.join(str(loc) for loc in error['loc'])}: {error['msg']}"
+                    for error in e.errors()
+                )
+                parsed.append(None)
+            except ValueError as e:
+                errors[index] = str(e)
+                parsed.append(None)
+
+        if errors:
+            return False, [
+                DeviceBatchResult(
+                    index=index,
+                    op=operation.op,
+                    device_id=operation.device_id,
+                    success=False,
+                    error=errors.get(index, "Not applied, another operation in the batch is invalid"),
+                )
+                for index, operation in enumerate(operations)
+            ]
+
+        # Apply all operations and persist them with a single write
+        results = []
+        with self._batch_changes():
+            for index, (operation, payload) in enumerate(zip(operations, parsed)):
+                device = None
+                device_id = operation.device_id
+                if operation.op == DeviceBatchOp.CREATE:
+                    device = await self.create_device(payload)
+                    device_id = device.id
+                elif operation.op == DeviceBatchOp.UPDATE:
+                    device = await self.update_device(device_id, payload)
+                else:
+                    await self.delete_device(device_id)
+                results.append(
+                    DeviceBatchResult(
+                        index=index,
+                        op=operation.op,
+                        device_id=device_id,
+                        success=True,
+                        device=device.to_model() if device else None,
+                    )
+                )
+        return True, results
+
+    async def execute_action(self, device_id: str, action: DeviceAction) -> Optional[DeviceRecord]:
         """Execute an action on a device"""
         device = self.devices.get(device_id)
         if not device:
             return None
         
-        logger.info(f"Executing action {action.action_type} on device {device.name} ({device.id})")
+        await self._run_action(device, action)
         
-        # Handle different device types
-        if device.type == DeviceType.BLUETOOTH:
-            await self._execute_bluetooth_action(device, action)
-        elif device.type == DeviceType.MQTT:
-            await self._execute_mqtt_action(device, action)
-        elif device.type == DeviceType.VIRTUAL:
-            await self._execute_virtual_action(device, action)
-        else:
-            logger.warning(f"Unsupported device type: {device.type}")
+        # Persist the change, unless the device was deleted meanwhile
+        if self.devices.get(device_id) is device:
+            self._mark_dirty("action", device)
         
+        return device
+
+    async def execute_actions(
+        self, device_ids: List[str], action: DeviceAction
+    ) -> List[DeviceActionResult]:
+        """Execute an action on many devices concurrently
+
+        Actions queue behind earlier actions for the same device, and each
+        backend runs at most its configured number of actions at once. All
+        resulting changes are persisted together once every action is done.
+        """
+
+        async def run(device_id: str) -> DeviceActionResult:
+            start = time.monotonic()
+            device = self.devices.get(device_id)
+            if not device:
+                return DeviceActionResult(
+                    device_id=device_id,
+                    success=False,
+                    error=f"Device with ID {device_id} not found",
+                    duration=0.0,
+                )
+            try:
+                await self._run_action(device, action)
+                error = None
+            except Exception as e:
+                logger.error(f"Error executing action on device {device.name} ({device.id}): {e}")
+                error = str(e)
+            return DeviceActionResult(
+                device_id=device_id,
+                success=error is None,
+                error=error,
+                status=device.status,
+                duration=time.monotonic() - start,
+            )
+
+        results = await asyncio.gather(*(run(device_id) for device_id in device_ids))
+
+        # Persist every change with a single write
+        with self._batch_changes():
+            for result in results:
+                device = self.devices.get(result.device_id)
+                if result.success and device:
+                    self._mark_dirty("action", device)
+        return list(results)
+
+    async def _run_action(self, device: DeviceRecord, action: DeviceAction) -> None:
+        """Run an action on the device's backend without persisting it
+
+        Raises DeviceQueueFullError if the device has too many queued actions,
+        and MQTTCommandError if an MQTT device fails or does not acknowledge it.
+        """
+        backend_limit = self._action_limits.get(device.type, self._action_limits[DeviceType.OTHER])
+        correlation_id = None
+        async with self.action_queues.slot(device.id), backend_limit:
+            logger.info(
+                f"Executing action {action.action_type} on device {device.name} ({device.id})"
+            )
+
+            # Handle different device types
+            start = time.perf_counter()
+            try:
+                if device.type == DeviceType.BLUETOOTH:
+                    await self._execute_bluetooth_action(device, action)
+                elif device.type == DeviceType.MQTT:
+                    correlation_id = await self._execute_mqtt_action(device, action)
+                elif device.type == DeviceType.VIRTUAL:
+                    await self._execute_virtual_action(device, action)
+                else:
+                    logger.warning(f"Unsupported device type: {device.type}")
+            finally:
+                if correlation_id is None:
+                    DEVICE_ACTION_DURATION.labels(device.type.value).observe(time.perf_counter() - start)
+
+        if correlation_id is not None:
+            # Wait outside the device's queue, so its next actions are sent meanwhile
+            try:
+                await self._await_mqtt_ack(device, correlation_id)
+            finally:
+                DEVICE_ACTION_DURATION.labels(device.type.value).observe(time.perf_counter() - start)
+
         # Update last_seen timestamp
         device.last_seen = datetime.now().isoformat()
-        
-        # Save devices to file
-        self._save_devices()
-        
-        return device
 
-    async def _execute_bluetooth_action(self, device: Device, action: DeviceAction) -> None:
+    async def _execute_bluetooth_action(self, device: DeviceRecord, action: DeviceAction) -> None:
         """Execute an action on a Bluetooth device"""
         if action.action_type == "connect":
             success = await self.bluetooth_manager.connect_device(device.id)
@@ -161,18 +688,28 @@ class DeviceService:
             # For other actions, just send the command to the device
             await self.bluetooth_manager.send_command(device.id, action.action_type)
 
-    async def _execute_mqtt_action(self, device: Device, action: DeviceAction) -> None:
-        """Execute an action on an MQTT device"""
-        if not MQTT_CLIENT_AVAILABLE:
-            logger.error("MQTT client not available")
-            return
-        
-        # This is a placeholder for MQTT actions
-        # In a real application, you would need to implement specific
-        # actions for MQTT devices
-        logger.info(f"MQTT action {action.action_type} not implemented yet")
+    async def _execute_mqtt_action(self, device: DeviceRecord, action: DeviceAction) -> str:
+        """Send an action to an MQTT device, returns the correlation ID of its acknowledgement"""
+        if not MQTT_CLIENT_AVAILABLE or not self.mqtt_client:
+            raise MQTTCommandError("MQTT client not available")
+        return await self.mqtt_client.send_device_action(device.id, action)
+
+    async def _await_mqtt_ack(self, device: DeviceRecord, correlation_id: str) -> None:
+        """Wait for an MQTT device to acknowledge an action and take the status it reports"""
+        acknowledgement = await self.mqtt_client.wait_for_ack(correlation_id)
+        status = acknowledgement.get("status")
+        if isinstance(status, str):
+            device.status = sys.intern(status)
+        if not acknowledgement.get("success", True):
+            # The action fails, but the status the device reported is still kept
+            if isinstance(status, str) and self.devices.get(device.id) is device:
+                self._mark_dirty("action", device)
+            raise MQTTCommandError(
+                f"Device {device.id} rejected the action: "
+                f"{acknowledgement.get('error') or 'no reason given'}"
+            )
 
-    async def _execute_virtual_action(self, device: Device, action: DeviceAction) -> None:
+    async def _execute_virtual_action(self, device: DeviceRecord, action: DeviceAction) -> None:
         """Execute an action on a virtual device"""
         if action.action_type == "on":
             device.status = "on"
@@ -183,34 +720,442 @@ class DeviceService:
         else:
             # For other actions, just update the properties
             device.properties[action.action_type] = action.value
+            self.telemetry.record(device.id, {action.action_type: action.value})
+
+    def get_load_progress(self) -> Dict[str, Any]:
+        """Get how far loading the stored devices has got"""
+        started_at = self.load_stats["started_at"]
+        elapsed = self.load_stats["duration"]
+        if self.loading and started_at is not None:
+            elapsed = time.monotonic() - started_at
+        return {
+            "ready": not self.loading,
+            "loaded": len(self.devices),
+            "progress": self.store.load_fraction if self.loading else 1.0,
+            "elapsed": elapsed,
+            "replayed": self.load_stats["replayed"],
+            "error": self.load_stats["error"],
+        }
+
+    def get_persistence_stats(self) -> Dict[str, Any]:
+        """Get write counts and flush lag for the device store"""
+        flush_lag = time.monotonic() - self._dirty_since if self._dirty_since else 0.0
+        stats = {
+            "engine": self.store.name,
+            "mode": settings.PERSISTENCE_MODE if self.write_behind else "sync",
+            "pending_changes": self._pending_changes,
+            "flush_lag": flush_lag,
+            **self.persistence_stats,
+        }
+        if self.journal:
+            stats["journal_records"] = self.journal.records
+            stats["journal_bytes"] = self.journal.size
+        return stats
+
+    async def _on_devices_discovered(self, discovered: List[DeviceRecord]) -> None:
+        """Update registered devices that were seen in a Bluetooth scan"""
+        if self.loading:
+            return
+
+        now = datetime.now().isoformat()
+        with self._batch_changes():
+            for found in discovered:
+                device_id = self.address_index.get(found.address)
+                device = self.devices.get(device_id) if device_id else None
+                if not device:
+                    continue
+
+                if device.status in ("offline", "unknown"):
+                    device.status = "online"
+                device.last_seen = now
+                self._mark_dirty("discovery", device)
+
+    async def _on_mqtt_state(self, device_id: str, payload: Any) -> None:
+        """Buffer a state report from an MQTT device, merged with the reports not yet applied
+
+        A report has a status and properties, either under "properties" or as
+        other top-level fields. A plain payload is taken as the status.
+        """
+        if self.mqtt_client.is_own_state(payload):
+            # The full device this hub publishes, retained, on the same topic
+            self.state_stats["echoes"] += 1
+            return
+        if not isinstance(payload, dict):
+            payload = {"value": payload}
+        if device_id not in self.devices:
+            if not self.loading:
+                self.state_stats["unknown"] += 1
+                return
+            if (
+                device_id not in self._state_reports
+                and len(self._state_reports) >= settings.MQTT_STATE_MAX_PENDING
+            ):
+                # Buffered for devices that may not be loaded yet, but not without limit
+                self.state_stats["dropped"] += 1
+                return
+        self.state_stats["received"] += 1
+
+        properties = payload.get("properties")
+        properties = dict(properties) if isinstance(properties, dict) else {}
+        for field, value in payload.items():
+            if field not in STATE_REPORT_FIELDS:
+                properties[field] = value
+        status = payload.get("status")
+        if "value" in payload:
+            if status is None and isinstance(payload["value"], str):
+                status = payload["value"]
+            else:
+                properties["value"] = payload["value"]
+        status = None if status is None else str(status)
+
+        pending = self._state_reports.get(device_id)
+        if pending is not None:
+            self.state_stats["coalesced"] += 1
+            pending[1].update(properties)
+            properties = pending[1]
+            if status is None:
+                status = pending[0]
+        self._state_reports[device_id] = (status, properties)
+        self._state_event.set()
+
+    async def _state_loop(self) -> None:
+        """Apply buffered state reports once per window while there are any"""
+        while True:
+            await self._state_event.wait()
+            # Let reports for the same device merge for a window
+            await asyncio.sleep(settings.MQTT_STATE_INGEST_WINDOW)
+            # Keep the reports until the devices they are for are loaded
+            await self._loaded.wait()
+            self._state_event.clear()
+            try:
+                self._apply_state_reports()
+            except Exception as e:
+                logger.error(f"Error applying MQTT state reports: {e}")
+
+    def _apply_state_reports(self) -> None:
+        """Apply the buffered state reports that change something, persisting them together"""
+        reports, self._state_reports = self._state_reports, {}
+        if not reports:
+            return
+
+        now = datetime.now().isoformat()
+        with self._batch_changes():
+            for device_id, (status, properties) in reports.items():
+                device = self.devices.get(device_id)
+                if not device:
+                    self.state_stats["unknown"] += 1
+                    continue
+
+                changed = {
+                    key: value
+                    for key, value in properties.items()
+                    if key not in device.properties or device.properties[key] != value
+                }
+                if (status is None or status == device.status) and not changed:
+                    self.state_stats["unchanged"] += 1
+                    continue
+
+                if status is not None:
+                    device.status = sys.intern(status)
+                if changed:
+                    device.properties = {**device.properties, **changed}
+                    self.telemetry.record(device.id, changed)
+                device.last_seen = now
+                self._mark_dirty("mqtt", device)
+                self.state_stats["applied"] += 1
+        self.state_stats["batches"] += 1
+
+    def get_mqtt_state_stats(self) -> Dict[str, Any]:
+        """Get counts of MQTT state reports received, merged, applied and skipped"""
+        return {"pending": len(self._state_reports), **self.state_stats}
+
+    @contextmanager
+    def _batch_changes(self):
+        """Group changes so that synchronous persistence writes them once"""
+        self._batch_depth += 1
+        try:
+            yield
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth and self._changes and not self.flush_running:
+                self._save_devices()
+
+    def _index_device(self, device: DeviceRecord) -> None:
+        """Add or move a device in the secondary indexes"""
+        key = (getattr(device.type, "value", device.type), device.status, device.address)
+        old_key = self._indexed.get(device.id)
+        if old_key == key:
+            return
+        if old_key:
+            self._remove_index_entries(device.id, old_key)
+        else:
+            bisect.insort(self.sorted_ids, device.id)
+
+        self.type_index.setdefault(key[0], set()).add(device.id)
+        self.status_index.setdefault(key[1], set()).add(device.id)
+        if key[2]:
+            self.address_index[key[2]] = device.id
+        self._indexed[device.id] = key
+
+    def _unindex_device(self, device_id: str) -> None:
+        """Remove a device from the secondary indexes"""
+        key = self._indexed.pop(device_id, None)
+        if not key:
+            return
+
+        self._remove_index_entries(device_id, key)
+        position = bisect.bisect_left(self.sorted_ids, device_id)
+        if position < len(self.sorted_ids) and self.sorted_ids[position] == device_id:
+            del self.sorted_ids[position]
+
+    def _remove_index_entries(self, device_id: str, key: Tuple[str, str, Optional[str]]) -> None:
+        """Remove a device from the type, status and address indexes"""
+        self.type_index[key[0]].discard(device_id)
+        self.status_index[key[1]].discard(device_id)
+        if key[2] and self.address_index.get(key[2]) == device_id:
+            del self.address_index[key[2]]
+
+    def _mark_dirty(self, op: str, device: DeviceRecord) -> None:
+        """Record a pending change and persist it according to the persistence mode"""
+        self.version += 1
+        while self.change_log and len(self.change_log) >= settings.CHANGE_LOG_SIZE:
+            self._change_log_floor = self.change_log.popleft()[0]
+        self.change_log.append((self.version, device.id))
+        if op == "delete":
+            self._unindex_device(device.id)
+            self.device_versions.pop(device.id, None)
+            self.json_cache.discard(device.id)
+        else:
+            self._index_device(device)
+            self.device_versions[device.id] = self.version
+        self.history.record(op, device, self.version)
+        if self.mqtt_client:
+            self.mqtt_client.queue_device_state(device.id, None if op == "delete" else device)
+
+        if self.event_broker.subscribers:
+            self.event_broker.publish(
+                ("device", device.id),
+                "device",
+                {
+                    "op": op,
+                    "id": device.id,
+                    "version": self.version,
+                    "device": None if op == "delete" else device,
+                },
+            )
+            # Counts are built when sent, so bursts of changes cost one computation
+            self.event_broker.publish("stats", "stats", self.get_stats)
+
+        if self.journal:
+            # Append the change itself, the snapshot is rewritten on compaction
+            data = None if op == "delete" else self.get_device_json(device)
+            self.persistence_stats["bytes_written"] += self.journal.append(op, device.id, data)
+            self.persistence_stats["changes_written"] += 1
+        else:
+            self._changes[device.id] = None if op == "delete" else device
+            if not self.flush_running:
+                # No background flusher, save synchronously unless batching
+                if not self._batch_depth:
+                    self._save_devices()
+                return
+
+        self._pending_changes += 1
+        if self._dirty_since is None:
+            self._dirty_since = time.monotonic()
+            self._dirty_event.set()
+        if self.journal:
+            if self.journal.size >= settings.JOURNAL_COMPACT_SIZE:
+                self._threshold_event.set()
+        elif self._pending_changes >= settings.PERSISTENCE_FLUSH_THRESHOLD:
+            self._threshold_event.set()
+
+    async def _flush_loop(self) -> None:
+        """Flush pending changes once the debounce window or change threshold is reached"""
+        interval = (
+            settings.JOURNAL_COMPACT_INTERVAL
+            if self.journal
+            else settings.PERSISTENCE_FLUSH_INTERVAL
+        )
+        while self.flush_running:
+            await self._dirty_event.wait()
+
+            # Coalesce changes until the window elapses or enough changes pile up
+            try:
+                await asyncio.wait_for(self._threshold_event.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+
+            # Shield the write so stopping never interrupts a flush halfway
+            await asyncio.shield(self.flush())
+
+    async def flush(self) -> None:
+        """Write all pending changes to the store in a worker thread
+
+        In journal mode this compacts the journal into a new snapshot.
+        """
+        async with self._flush_lock:
+            if not self._pending_changes:
+                return
+
+            pending_changes = self._pending_changes
+            self._pending_changes = 0
+            self._dirty_since = None
+            self._dirty_event.clear()
+            self._threshold_event.clear()
+
+            # Changes made while the snapshot is written go to a fresh journal
+            if self.journal:
+                self.journal.rotate()
+
+            # Snapshot on the event loop (only changed devices need encoding), write off it
+            changes = self._changes
+            self._changes = {}
+            changes_data, devices_data = self._serialize_changes(changes)
+            loop = asyncio.get_running_loop()
+            if await loop.run_in_executor(None, self._write_devices, changes_data, devices_data):
+                if self.journal:
+                    self.journal.discard_rotated()
+                else:
+                    self.persistence_stats["changes_written"] += pending_changes
+            else:
+                # Keep the changes pending so the next flush retries them
+                for device_id in changes:
+                    self._changes.setdefault(device_id, self.devices.get(device_id))
+                self._pending_changes += pending_changes
+                if self._dirty_since is None:
+                    self._dirty_since = time.monotonic()
+                self._dirty_event.set()
 
     def _load_devices(self) -> None:
-        """Load devices from file"""
+        """Load devices from the store, one at a time"""
+        self.load_stats["started_at"] = time.monotonic()
         try:
-            # Create data directory if it doesn't exist
-            os.makedirs(os.path.dirname(self.devices_file), exist_ok=True)
-            
-            # Load devices from file if it exists
-            if os.path.exists(self.devices_file):
-                with open(self.devices_file, "r") as f:
-                    devices_data = json.load(f)
-                    for device_data in devices_data:
-                        device = Device(**device_data)
-                        self.devices[device.id] = device
-                logger.info(f"Loaded {len(self.devices)} devices from file")
+            for device_data in self.store.iter_load():
+                self._add_loaded(self._load_record(device_data))
+            self._finish_load()
         except Exception as e:
-            logger.error(f"Error loading devices from file: {e}")
+            self._fail_load(e)
+
+    async def _load_devices_in_background(self) -> None:
+        """Load devices from the store in batches parsed in a worker thread"""
+        self.load_stats["started_at"] = time.monotonic()
+        loop = asyncio.get_running_loop()
+        try:
+            stored = self.store.iter_load()
+            while True:
+                batch = await loop.run_in_executor(None, self._read_batch, stored)
+                if not batch:
+                    break
+                for device in batch:
+                    self._add_loaded(device)
+                # The listing changes as devices appear
+                self.version += 1
+            self._finish_load()
+        except Exception as e:
+            self._fail_load(e)
+
+    def _read_batch(self, stored: Iterator[Dict[str, Any]]) -> List[DeviceRecord]:
+        """Read the next batch of stored devices as records"""
+        return [self._load_record(device_data) for device_data in itertools.islice(stored, LOAD_BATCH_SIZE)]
+
+    def _add_loaded(self, device: DeviceRecord) -> None:
+        """Add a loaded device to the registry"""
+        self.devices[device.id] = device
+        self._index_device(device)
+
+    def _apply_journal_record(
+        self, op: str, device_id: str, device_data: Optional[Dict[str, Any]]
+    ) -> None:
+        """Apply a replayed journal record to the registry"""
+        if op == "delete":
+            if self.devices.pop(device_id, None):
+                self._unindex_device(device_id)
+        else:
+            self._add_loaded(self._load_record(device_data))
+
+    def _finish_load(self) -> None:
+        """Replay changes recorded after the snapshot and mark the registry ready"""
+        if self.journal:
+            replayed = self.journal.replay(self._apply_journal_record)
+            if replayed:
+                self.load_stats["replayed"] = replayed
+                self._pending_changes = replayed
+                self._dirty_since = time.monotonic()
+                self._dirty_event.set()
+                logger.info(f"Replayed {replayed} journal records")
+
+        # Versions seen while loading are not covered by the change log
+        self.version += 1
+        self._change_log_floor = self.version
+        self.loading = False
+        self._loaded.set()
+        self.load_stats["duration"] = time.monotonic() - self.load_stats["started_at"]
+        logger.info(
+            f"Loaded {len(self.devices)} devices from {self.store.name} store "
+            f"in {self.load_stats['duration']:.2f}s"
+        )
+
+    def _fail_load(self, error: Exception) -> None:
+        """Record a failed load and carry on with the devices loaded so far"""
+        logger.error(f"Error loading devices from {self.store.name} store: {error}")
+        self.load_stats["error"] = str(error)
+        self.load_stats["duration"] = time.monotonic() - self.load_stats["started_at"]
+        self.loading = False
+        self._loaded.set()
+
+    @staticmethod
+    def _load_record(device_data: Dict[str, Any]) -> DeviceRecord:
+        """Build a record from stored data, validating it only if it looks wrong"""
+        try:
+            return DeviceRecord.from_trusted(device_data)
+        except ValueError:
+            # Hand-edited or foreign data, let pydantic fix it up or explain what is wrong
+            return DeviceRecord.from_model(Device(**device_data))
 
     def _save_devices(self) -> None:
-        """Save devices to file"""
+        """Save pending changes to the store"""
+        changes = self._changes
+        self._changes = {}
+        if self._write_devices(*self._serialize_changes(changes)):
+            self.persistence_stats["changes_written"] += len(changes)
+        else:
+            self._changes.update(changes)
+
+    def _serialize_changes(
+        self, changes: Dict[str, Optional[DeviceRecord]]
+    ) -> Tuple[Optional[Dict[str, Optional[Dict[str, Any]]]], Optional[List[bytes]]]:
+        """Serialize changed devices for incremental stores, or a full snapshot for the others"""
+        if self.store.incremental:
+            changes_data = {
+                device_id: device.dict() if device is not None else None
+                for device_id, device in changes.items()
+            }
+            return changes_data, None
+        return None, [self.get_device_json(device) for device in self.devices.values()]
+
+    def _write_devices(
+        self,
+        changes_data: Optional[Dict[str, Optional[Dict[str, Any]]]],
+        devices_json: Optional[List[bytes]],
+    ) -> bool:
+        """Write serialized devices to the store"""
+        start = time.monotonic()
         try:
-            # Create data directory if it doesn't exist
-            os.makedirs(os.path.dirname(self.devices_file), exist_ok=True)
-            
-            # Save devices to file
-            with open(self.devices_file, "w") as f:
-                devices_data = [device.dict() for device in self.devices.values()]
-                json.dump(devices_data, f, indent=2)
-            logger.debug(f"Saved {len(self.devices)} devices to file")
+            if self.store.incremental:
+                bytes_written = self.store.write_changes(changes_data)
+            else:
+                bytes_written = self.store.write_snapshot_json(devices_json)
+
+            duration = time.monotonic() - start
+            self.persistence_stats["writes"] += 1
+            self.persistence_stats["bytes_written"] += bytes_written
+            self.persistence_stats["last_flush_at"] = datetime.now().isoformat()
+            self.persistence_stats["last_flush_duration"] = duration
+            self._write_duration.observe(duration)
+            self._write_bytes.inc(bytes_written)
+            logger.debug(f"Saved devices to {self.store.name} store")
+            return True
         except Exception as e:
-            logger.error(f"Error saving devices to file: {e}")
\ No newline at end of file
+            self.persistence_stats["errors"] += 1
+            logger.error(f"Error saving devices to {self.store.name} store: {e}")
+            return False
\ No newline at end of file
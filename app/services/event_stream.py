@@ -0,0 +1,115 @@
+"""Event Stream
+
+This module fans out device changes and system metric samples to connected
+clients. Each client has a bounded buffer keyed by what the event is about,
+so a newer event for the same device or metric replaces the pending one and
+a slow client only ever receives the latest state.
+"""
+
+import asyncio
+from typing import Any, Callable, Dict, Hashable, List, Optional, Set, Tuple
+from loguru import logger
+
+
+class EventSubscriber:
+    """Bounded, coalescing buffer of events for one client"""
+
+    def __init__(self, buffer_size: int):
+        """Initialize the subscriber"""
+        self.buffer_size = buffer_size
+        # Pending events by key, in the order they were last updated
+        self.pending: Dict[Hashable, Tuple[str, Any]] = {}
+        self.overflowed = False
+        self.dropped = 0
+        self._ready = asyncio.Event()
+
+    def put(self, key: Hashable, event: str, data: Any) -> None:
+        """Queue an event, replacing any pending event with the same key
+
+        If the buffer is full the pending events are dropped and the client
+        is told to resync instead.
+        """
+        if key in self.pending:
+            del self.pending[key]
+        elif len(self.pending) >= self.buffer_size:
+            self.dropped += len(self.pending)
+            self.pending.clear()
+            self.overflowed = True
+        self.pending[key] = (event, data)
+        self._ready.set()
+
+    async def get(self, timeout: Optional[float] = None) -> List[Tuple[str, Any]]:
+        """Wait for pending events and take them all
+
+        Returns an empty list if nothing arrived within the timeout.
+        """
+        if not self.pending and not self.overflowed:
+            self._ready.clear()
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return []
+
+        events = list(self.pending.values())
+        if self.overflowed:
+            events.insert(0, ("resync", None))
+            self.overflowed = False
+        self.pending = {}
+        return events
+
+
+class EventBroker:
+    """Publishes events to every connected subscriber"""
+
+    def __init__(self, buffer_size: int):
+        """Initialize the event broker"""
+        self.buffer_size = buffer_size
+        self.subscribers: Set[EventSubscriber] = set()
+        self.metrics_task = None
+
+    def subscribe(self) -> EventSubscriber:
+        """Register a new client"""
+        subscriber = EventSubscriber(self.buffer_size)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: EventSubscriber) -> None:
+        """Remove a disconnected client"""
+        self.subscribers.discard(subscriber)
+
+    def publish(self, key: Hashable, event: str, data: Any) -> None:
+        """Queue an event for every subscriber
+
+        The data may be a callable, which is called when the event is sent,
+        so coalesced events are only ever built once per delivery.
+        """
+        for subscriber in self.subscribers:
+            subscriber.put(key, event, data)
+
+    async def start(self, sampler: Callable[[], Dict[str, Any]], interval: float) -> None:
+        """Start publishing system metric samples while clients are connected"""
+        if self.metrics_task:
+            logger.warning("System metrics task already running")
+            return
+        self.metrics_task = asyncio.create_task(self._metrics_loop(sampler, interval))
+
+    async def stop(self) -> None:
+        """Stop publishing system metric samples"""
+        if self.metrics_task:
+            self.metrics_task.cancel()
+            try:
+                await self.metrics_task
+            except asyncio.CancelledError:
+                pass
+            self.metrics_task = None
+
+    async def _metrics_loop(self, sampler: Callable[[], Dict[str, Any]], interval: float) -> None:
+        """Sample system metrics periodically, skipping samples nobody would receive"""
+        while True:
+            await asyncio.sleep(interval)
+            if not self.subscribers:
+                continue
+            try:
+                self.publish("system", "system", sampler())
+            except Exception as e:
+                logger.error(f"Error sampling system metrics: {e}")
@@ -0,0 +1,405 @@
+"""Device History
+
+This module records each device's status and property changes. Recent
+changes are kept in a bounded ring buffer per device, and can also be
+appended to hourly segment files on disk that are deleted after a
+retention period. Queries find entries by binary search over timestamps and
+read only the lines of the requested device from disk, using a per-segment
+index of line offsets.
+"""
+
+import asyncio
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+from loguru import logger
+
+from app.models.record import DeviceRecord
+
+
+class HistoryEntry(NamedTuple):
+    """One recorded change of a device"""
+
+    timestamp: float
+    version: int
+    op: str
+    status: Optional[str]
+    properties: Optional[Dict[str, Any]]
+
+
+class HistoryBuffer:
+    """Ring buffer of a device's latest entries, oldest first"""
+
+    __slots__ = ("entries", "start", "capacity")
+
+    def __init__(self, capacity: int):
+        """Initialize the buffer, it grows up to capacity before wrapping"""
+        self.entries: List[HistoryEntry] = []
+        self.start = 0
+        self.capacity = capacity
+
+    def append(self, entry: HistoryEntry) -> None:
+        """Add an entry, overwriting the oldest one when full"""
+        if len(self.entries) < self.capacity:
+            self.entries.append(entry)
+        else:
+            self.entries[self.start] = entry
+            self.start = (self.start + 1) % self.capacity
+
+    def __len__(self) -> int:
+        """Number of entries in the buffer"""
+        return len(self.entries)
+
+    def __getitem__(self, index: int) -> HistoryEntry:
+        """Get an entry by age, 0 being the oldest and -1 the newest"""
+        if index < 0:
+            index += len(self.entries)
+        return self.entries[(self.start + index) % len(self.entries)]
+
+    def bisect(self, timestamp: float) -> int:
+        """Get the position of the first entry newer than timestamp"""
+        low, high = 0, len(self.entries)
+        while low < high:
+            middle = (low + high) // 2
+            if self[middle].timestamp <= timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+
+class HistorySegments:
+    """Append-only segment files of history entries, one per time interval
+
+    Each segment has an index of the line offsets of every device, kept in
+    memory while the segment is written and saved next to it when the next
+    segment starts.
+    """
+
+    def __init__(self, path: str, interval: float, retention: float):
+        """Initialize the segment store"""
+        self.path = path
+        self.interval = interval
+        self.retention = retention
+        self._lock = threading.Lock()
+        # Segment start times, oldest first, and the indexes loaded so far
+        self.segments: List[int] = []
+        self._indexes: Dict[int, Dict[str, List[int]]] = {}
+        self._file = None
+        self._current: Optional[int] = None
+
+        os.makedirs(self.path, exist_ok=True)
+        self.segments = sorted(
+            int(name[:-4]) for name in os.listdir(self.path) if name.endswith(".log")
+        )
+
+    def _segment_path(self, start: int, suffix: str = ".log") -> str:
+        """Get the file path of a segment or its index"""
+        return os.path.join(self.path, f"{start}{suffix}")
+
+    def write(self, records: List[Tuple[str, HistoryEntry]]) -> int:
+        """Append (device ID, entry) records and return the number of bytes written
+
+        Records are removed from the list once they are on disk, so after an
+        error it holds the records left to write. The records of a segment
+        are written together and taken back out of the file if that fails,
+        so the segment and its index stay in step.
+        """
+        written = 0
+        with self._lock:
+            while records:
+                start = self._segment_start(records[0][1])
+                if start != self._current:
+                    self._open_segment(start)
+
+                # Encode the records up to the next segment
+                size = self._file.tell()
+                lines: List[bytes] = []
+                offsets: List[Tuple[str, int]] = []
+                position = size
+                for device_id, entry in records:
+                    if self._segment_start(entry) != start:
+                        break
+                    line = json.dumps(
+                        [device_id, entry.timestamp, entry.version, entry.op, entry.status, entry.properties],
+                        separators=(",", ":"),
+                        default=str,
+                    ).encode("utf-8") + b"\n"
+                    offsets.append((device_id, position))
+                    lines.append(line)
+                    position += len(line)
+
+                try:
+                    self._file.write(b"".join(lines))
+                    self._file.flush()
+                except BaseException:
+                    self._truncate_segment(size)
+                    raise
+
+                index = self._indexes[start]
+                for device_id, offset in offsets:
+                    index.setdefault(device_id, []).append(offset)
+                del records[:len(lines)]
+                written += position - size
+        return written
+
+    def _segment_start(self, entry: HistoryEntry) -> int:
+        """Get the start time of the segment an entry belongs to"""
+        return int(entry.timestamp // self.interval * self.interval)
+
+    def _open_segment(self, start: int) -> None:
+        """Switch writing to the segment starting at start"""
+        self._close_segment()
+        self._file = open(self._segment_path(start), "ab")
+        self._current = start
+        if start not in self.segments:
+            self.segments.append(start)
+            self.segments.sort()
+        self._indexes[start] = self._load_index(start)
+
+    def _truncate_segment(self, size: int) -> None:
+        """Close the segment being written, cutting off what was written after size"""
+        path = self._segment_path(self._current)
+        try:
+            self._file.close()
+        except OSError:
+            pass
+        self._file = None
+        self._current = None
+        try:
+            os.truncate(path, size)
+        except OSError as e:
+            logger.error(f"Error truncating history segment {path}: {e}")
+
+    def _close_segment(self) -> None:
+        """Close the segment being written and save its index"""
+        if not self._file:
+            return
+        self._file.close()
+        self._file = None
+        self._save_index(self._current)
+        self._current = None
+
+    def _save_index(self, start: int) -> None:
+        """Write a segment's index next to it"""
+        tmp_file = self._segment_path(start, ".idx.tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(self._indexes[start], f, separators=(",", ":"))
+        os.replace(tmp_file, self._segment_path(start, ".idx"))
+
+    def _load_index(self, start: int) -> Dict[str, List[int]]:
+        """Load a segment's index, rebuilding it if the segment was not closed cleanly"""
+        index = self._indexes.get(start)
+        if index is not None:
+            return index
+
+        log_path = self._segment_path(start)
+        index_path = self._segment_path(start, ".idx")
+        if os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(log_path):
+            with open(index_path) as f:
+                index = json.load(f)
+        else:
+            index = {}
+            if os.path.exists(log_path):
+                with open(log_path, "rb") as f:
+                    offset = 0
+                    for line in f:
+                        if line.endswith(b"\n"):
+                            index.setdefault(json.loads(line)[0], []).append(offset)
+                        offset += len(line)
+        self._indexes[start] = index
+        return index
+
+    def query(
+        self, device_id: str, start: float, end: float, limit: int, before_version: Optional[int]
+    ) -> List[HistoryEntry]:
+        """Get a device's newest entries between start and end, newest first
+
+        Entries at or above before_version are skipped, they are served from memory.
+        """
+        entries: List[HistoryEntry] = []
+        with self._lock:
+            segments = [
+                segment for segment in self.segments
+                if segment <= end and segment + self.interval > start
+            ]
+            offsets = {
+                segment: list(self._load_index(segment).get(device_id, ()))
+                for segment in segments
+            }
+
+        for segment in reversed(segments):
+            if not offsets[segment]:
+                continue
+            with open(self._segment_path(segment), "rb") as f:
+                for offset in reversed(offsets[segment]):
+                    f.seek(offset)
+                    _, timestamp, version, op, status, properties = json.loads(f.readline())
+                    if before_version is not None and version >= before_version:
+                        continue
+                    if timestamp > end:
+                        continue
+                    if timestamp < start:
+                        break
+                    entries.append(HistoryEntry(timestamp, version, op, status, properties))
+                    if len(entries) >= limit:
+                        return entries
+        return entries
+
+    def expire(self, now: float) -> int:
+        """Delete segments older than the retention period and return how many"""
+        expired = 0
+        with self._lock:
+            while self.segments and self.segments[0] + self.interval < now - self.retention:
+                segment = self.segments.pop(0)
+                if segment == self._current:
+                    self._close_segment()
+                self._indexes.pop(segment, None)
+                for suffix in (".log", ".idx"):
+                    if os.path.exists(self._segment_path(segment, suffix)):
+                        os.remove(self._segment_path(segment, suffix))
+                expired += 1
+        return expired
+
+    def close(self) -> None:
+        """Close the segment being written"""
+        with self._lock:
+            self._close_segment()
+
+
+class DeviceHistory:
+    """Recent changes per device, optionally written behind to segment files"""
+
+    def __init__(
+        self,
+        buffer_size: int,
+        segments: Optional[HistorySegments] = None,
+        max_pending: int = 100000,
+    ):
+        """Initialize the history
+
+        At most max_pending entries wait to be written, the oldest are
+        dropped if the segment files cannot be written for a while.
+        """
+        self.buffer_size = buffer_size
+        self.buffers: Dict[str, HistoryBuffer] = {}
+        self.segments = segments
+        self.max_pending = max_pending
+        # Entries not yet written to the segment files
+        self._pending: List[Tuple[str, HistoryEntry]] = []
+        self.flush_interval = 1.0
+        self.task = None
+        self.stats = {
+            "recorded": 0,
+            "bytes_written": 0,
+            "segments_expired": 0,
+            "errors": 0,
+            "dropped": 0,
+        }
+
+    def record(self, op: str, device: DeviceRecord, version: int) -> None:
+        """Record a device change, unless its status and properties are unchanged"""
+        buffer = self.buffers.get(device.id)
+        if op == "delete":
+            entry = HistoryEntry(time.time(), version, op, None, None)
+            self.buffers.pop(device.id, None)
+        else:
+            if buffer is None:
+                buffer = self.buffers[device.id] = HistoryBuffer(self.buffer_size)
+            elif op != "create" and len(buffer):
+                last = buffer[-1]
+                if last.status == device.status and last.properties == device.properties:
+                    return
+            # Keep timestamps ordered even if the clock steps back
+            timestamp = time.time()
+            if len(buffer) and buffer[-1].timestamp > timestamp:
+                timestamp = buffer[-1].timestamp
+            entry = HistoryEntry(timestamp, version, op, device.status, dict(device.properties))
+            buffer.append(entry)
+
+        self.stats["recorded"] += 1
+        if self.segments:
+            self._pending.append((device.id, entry))
+
+    async def query(
+        self, device_id: str, start: float, end: float, limit: int
+    ) -> List[HistoryEntry]:
+        """Get a device's newest entries between start and end, newest first"""
+        entries: List[HistoryEntry] = []
+        buffer = self.buffers.get(device_id)
+        if buffer:
+            position = buffer.bisect(end)
+            while position > 0 and len(entries) < limit:
+                position -= 1
+                entry = buffer[position]
+                if entry.timestamp < start:
+                    return entries
+                entries.append(entry)
+
+        if self.segments and len(entries) < limit:
+            # Older entries were evicted from memory, read them from disk
+            oldest = buffer[0] if buffer else None
+            if oldest is None or oldest.timestamp > start:
+                loop = asyncio.get_running_loop()
+                entries += await loop.run_in_executor(
+                    None,
+                    self.segments.query,
+                    device_id,
+                    start,
+                    min(end, oldest.timestamp) if oldest else end,
+                    limit - len(entries),
+                    oldest.version if oldest else None,
+                )
+        return entries
+
+    def start(self, flush_interval: float) -> None:
+        """Start writing recorded entries to the segment files"""
+        if not self.segments or self.task:
+            return
+        self.flush_interval = flush_interval
+        self.task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self) -> None:
+        """Stop the writer and write what is still pending"""
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        if self.segments:
+            await self.flush()
+            self.segments.close()
+
+    async def _flush_loop(self) -> None:
+        """Write pending entries to disk every flush interval"""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await asyncio.shield(self.flush())
+
+    async def flush(self) -> None:
+        """Write pending entries and expire old segments in a worker thread"""
+        pending, self._pending = self._pending, []
+        loop = asyncio.get_running_loop()
+        try:
+            if pending:
+                self.stats["bytes_written"] += await loop.run_in_executor(
+                    None, self.segments.write, pending
+                )
+            self.stats["segments_expired"] += await loop.run_in_executor(
+                None, self.segments.expire, time.time()
+            )
+        except Exception as e:
+            logger.error(f"Error writing device history: {e}")
+            self.stats["errors"] += 1
+
+        if pending:
+            # Write what is left with the next flush, ahead of newer entries
+            self._pending = pending + self._pending
+            excess = len(self._pending) - self.max_pending
+            if excess > 0:
+                del self._pending[:excess]
+                self.stats["dropped"] += excess
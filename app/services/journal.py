@@ -0,0 +1,135 @@
+"""Device Journal
+
+This module contains an append-only journal of device changes. Each change
+is written as one checksummed line, so the cost of recording a change
+depends on the size of the change rather than the number of devices.
+"""
+
+import json
+import os
+import shutil
+import zlib
+from typing import Callable, Dict, Any, Optional
+from loguru import logger
+
+
+class DeviceJournal:
+    """Append-only, checksummed log of device changes"""
+
+    def __init__(self, path: str):
+        """Initialize the journal"""
+        self.path = path
+        self.rotated_path = f"{path}.1"
+        self.file = None
+        self.size = 0
+        self.records = 0
+
+    def open(self) -> None:
+        """Open the journal for appending"""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.file = open(self.path, "ab")
+        self.size = self.file.tell()
+
+    def close(self) -> None:
+        """Close the journal"""
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def append(self, op: str, device_id: str, data: Optional[bytes] = None) -> int:
+        """Append a change record and return the number of bytes written
+
+        The device data is passed already JSON encoded.
+        """
+        if not self.file:
+            self.open()
+
+        payload = b'{"op":%s,"id":%s,"data":%s}' % (
+            json.dumps(op).encode("utf-8"),
+            json.dumps(device_id).encode("utf-8"),
+            data if data is not None else b"null",
+        )
+        record = b"%08x %s\n" % (zlib.crc32(payload), payload)
+        self.file.write(record)
+        self.file.flush()
+
+        self.size += len(record)
+        self.records += 1
+        return len(record)
+
+    def rotate(self) -> None:
+        """Move the current journal aside and start a new one
+
+        The rotated journal is kept until a snapshot covering it has been
+        written, so a crash during compaction can still replay it.
+        """
+        self.close()
+        if os.path.exists(self.rotated_path) and os.path.exists(self.path):
+            # A previous compaction failed, keep its records ahead of the new ones
+            with open(self.rotated_path, "ab") as dst, open(self.path, "rb") as src:
+                shutil.copyfileobj(src, dst)
+            os.remove(self.path)
+        elif os.path.exists(self.path):
+            os.replace(self.path, self.rotated_path)
+        self.open()
+        self.records = 0
+
+    def discard_rotated(self) -> None:
+        """Delete the rotated journal once a snapshot covers it"""
+        if os.path.exists(self.rotated_path):
+            os.remove(self.rotated_path)
+
+    def replay(self, apply: Callable[[str, str, Optional[Dict[str, Any]]], None]) -> int:
+        """Pass the records of the rotated and current journals to apply, oldest first
+
+        apply is called with the operation, device ID and device data (None
+        for deletions). Returns the number of records applied.
+        """
+        applied = self._replay_file(self.rotated_path, apply, truncate=False)
+        applied += self._replay_file(self.path, apply, truncate=True)
+        return applied
+
+    def _replay_file(
+        self, path: str, apply: Callable[[str, str, Optional[Dict[str, Any]]], None], truncate: bool
+    ) -> int:
+        """Apply the records of one journal file, stopping at the first bad record"""
+        if not os.path.exists(path):
+            return 0
+
+        applied = 0
+        good_offset = 0
+        with open(path, "rb") as f:
+            for line in f:
+                record = self._decode(line)
+                if record is None:
+                    logger.warning(
+                        f"Skipping torn or corrupt journal record at offset {good_offset} in {path}"
+                    )
+                    break
+
+                apply(record["op"], record["id"], record["data"])
+                applied += 1
+                good_offset += len(line)
+
+        # Cut off the bad tail so new records are not appended after garbage
+        if truncate and good_offset < os.path.getsize(path):
+            with open(path, "r+b") as f:
+                f.truncate(good_offset)
+
+        if path == self.path:
+            self.records = applied
+        return applied
+
+    @staticmethod
+    def _decode(line: bytes) -> Optional[Dict[str, Any]]:
+        """Decode a journal line, returning None if it is torn or corrupt"""
+        if not line.endswith(b"\n") or len(line) < 10 or line[8:9] != b" ":
+            return None
+
+        payload = line[9:-1]
+        try:
+            if int(line[:8], 16) != zlib.crc32(payload):
+                return None
+            return json.loads(payload)
+        except ValueError:
+            return None
@@ -0,0 +1,319 @@
+"""Metrics
+
+This module contains counters, gauges and histograms rendered in the
+Prometheus text format by the /metrics endpoint, and the metrics the hub
+records on its hot paths.
+
+Values are updated without locks. Each series is written by one thread at
+a time (the event loop, the MQTT network thread or a single persistence
+write), and histograms count into buckets allocated when the series is
+first used, so recording is a bisect and two additions.
+"""
+
+import asyncio
+import bisect
+import math
+from typing import Dict, List, Sequence, Tuple
+
+# Latency buckets in seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    """Format label pairs, escaped as the text format requires"""
+    if not names:
+        return ""
+    pairs = ",".join(
+        '%s="%s"' % (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+def _format_value(value: float) -> str:
+    """Format a sample value"""
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class CounterValue:
+    """One series of a counter"""
+
+    __slots__ = ("value",)
+
+    def __init__(self):
+        """Initialize the series"""
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        """Add to the counter"""
+        self.value += amount
+
+
+class GaugeValue:
+    """One series of a gauge"""
+
+    __slots__ = ("value",)
+
+    def __init__(self):
+        """Initialize the series"""
+        self.value = 0.0
+
+    def set(self, value: float) -> None:
+        """Set the gauge"""
+        self.value = value
+
+
+class HistogramValue:
+    """One series of a histogram, with a count per bucket"""
+
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        """Initialize the series"""
+        self.bounds = bounds
+        # The last count is for observations above the highest bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        """Count an observation in its bucket"""
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class Metric:
+    """A named metric with one series per combination of label values"""
+
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        """Initialize the metric"""
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.series: Dict[Tuple[str, ...], object] = {}
+
+    def _new_series(self):
+        """Create the value of a new series"""
+        raise NotImplementedError
+
+    def labels(self, *values: str):
+        """Get the series for these label values, creating it on first use"""
+        series = self.series.get(values)
+        if series is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            series = self.series[values] = self._new_series()
+        return series
+
+    def render(self) -> List[str]:
+        """Render the metric in the text format"""
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for values, series in list(self.series.items()):
+            labels = _format_labels(self.labelnames, values)
+            lines.append(f"{self.name}{labels} {_format_value(series.value)}")
+        return lines
+
+
+class Counter(Metric):
+    """A value that only goes up"""
+
+    type = "counter"
+
+    def _new_series(self) -> CounterValue:
+        """Create the value of a new series"""
+        return CounterValue()
+
+    def inc(self, amount: float = 1.0) -> None:
+        """Add to the counter of a metric without labels"""
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    """A value that goes up and down"""
+
+    type = "gauge"
+
+    def _new_series(self) -> GaugeValue:
+        """Create the value of a new series"""
+        return GaugeValue()
+
+    def set(self, value: float) -> None:
+        """Set the gauge of a metric without labels"""
+        self.labels().set(value)
+
+
+class Histogram(Metric):
+    """Observations counted into buckets"""
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        """Initialize the histogram"""
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_series(self) -> HistogramValue:
+        """Create the value of a new series"""
+        return HistogramValue(self.buckets)
+
+    def observe(self, value: float) -> None:
+        """Count an observation of a metric without labels"""
+        self.labels().observe(value)
+
+    def render(self) -> List[str]:
+        """Render the cumulative buckets, sum and count of every series"""
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        names = self.labelnames + ("le",)
+        for values, series in list(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), list(series.counts)):
+                cumulative += count
+                labels = _format_labels(names, values + (_format_value(bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(series.sum)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """The metrics exposed by the /metrics endpoint"""
+
+    def __init__(self):
+        """Initialize the registry"""
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        """Add a metric and return it"""
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """Render every metric in the Prometheus text format"""
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class EventLoopMonitor:
+    """Measures how late the event loop wakes up from a sleep"""
+
+    def __init__(self, histogram: Histogram):
+        """Initialize the monitor"""
+        self.histogram = histogram
+        self.task = None
+
+    def start(self, interval: float) -> None:
+        """Start measuring every interval seconds"""
+        if self.task is None:
+            self.task = asyncio.create_task(self._run(interval))
+
+    async def stop(self) -> None:
+        """Stop measuring"""
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def _run(self, interval: float) -> None:
+        """Sleep for interval and record how much longer it took"""
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            lag = loop.time() - start - interval
+            self.histogram.observe(max(lag, 0.0))
+
+
+REGISTRY = MetricsRegistry()
+
+HTTP_REQUEST_DURATION: Histogram = REGISTRY.register(Histogram(
+    "smarthomelite_http_request_duration_seconds",
+    "Time until the response headers were sent, per route",
+    ("method", "route", "status"),
+))
+DEVICE_ACTION_DURATION: Histogram = REGISTRY.register(Histogram(
+    "smarthomelite_device_action_duration_seconds",
+    "Time spent running device actions on their backend, per device type",
+    ("type",),
+))
+STORE_WRITE_DURATION: Histogram = REGISTRY.register(Histogram(
+    "smarthomelite_store_write_duration_seconds",
+    "Time spent writing devices to the store",
+    ("engine",),
+))
+STORE_WRITE_BYTES: Counter = REGISTRY.register(Counter(
+    "smarthomelite_store_written_bytes_total",
+    "Bytes of devices written to the store",
+    ("engine",),
+))
+BLUETOOTH_SCAN_DURATION: Histogram = REGISTRY.register(Histogram(
+    "smarthomelite_bluetooth_scan_duration_seconds",
+    "Time taken by Bluetooth scans",
+    buckets=(0.5, 1.0, 2.5, 5.0, 10.0, 15.0, 20.0, 30.0, 60.0),
+))
+BLUETOOTH_SCAN_DEVICES: Gauge = REGISTRY.register(Gauge(
+    "smarthomelite_bluetooth_scan_devices",
+    "Devices found by the last Bluetooth scan",
+))
+MQTT_MESSAGES: Counter = REGISTRY.register(Counter(
+    "smarthomelite_mqtt_messages_total",
+    "MQTT messages received (in) and published (out)",
+    ("direction",),
+))
+MQTT_INGEST_DEPTH: Gauge = REGISTRY.register(Gauge(
+    "smarthomelite_mqtt_ingest_queue_depth",
+    "MQTT messages waiting to be handled",
+))
+MQTT_INGEST_DROPPED: Counter = REGISTRY.register(Counter(
+    "smarthomelite_mqtt_ingest_dropped_total",
+    "MQTT messages dropped because the ingest queue was full",
+))
+MQTT_INGEST_COALESCED: Counter = REGISTRY.register(Counter(
+    "smarthomelite_mqtt_ingest_coalesced_total",
+    "MQTT messages replaced by a newer message on the same topic",
+))
+MQTT_INGEST_LATENCY: Histogram = REGISTRY.register(Histogram(
+    "smarthomelite_mqtt_ingest_latency_seconds",
+    "Time from receiving an MQTT message to having handled it",
+))
+MQTT_PUBLISH_PENDING: Gauge = REGISTRY.register(Gauge(
+    "smarthomelite_mqtt_publish_pending",
+    "Devices with a state change waiting to be published",
+))
+MQTT_PUBLISH_COALESCED: Counter = REGISTRY.register(Counter(
+    "smarthomelite_mqtt_publish_coalesced_total",
+    "State publishes saved by coalescing changes to the same device",
+))
+MQTT_PUBLISH_DEFERRED: Counter = REGISTRY.register(Counter(
+    "smarthomelite_mqtt_publish_deferred_total",
+    "State publishes held back for a window by a rate limit",
+))
+EVENT_LOOP_LAG: Histogram = REGISTRY.register(Histogram(
+    "smarthomelite_event_loop_lag_seconds",
+    "How late the event loop woke up from a sleep",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+))
+
+# The series recorded from other threads are created up front
+MQTT_MESSAGES_IN = MQTT_MESSAGES.labels("in")
+MQTT_MESSAGES_OUT = MQTT_MESSAGES.labels("out")
+MQTT_INGEST_DROPPED.labels()
+MQTT_INGEST_COALESCED.labels()
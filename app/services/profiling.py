@@ -0,0 +1,170 @@
+"""Profiling
+
+This module profiles the running hub on demand. The CPU profiler either
+samples the stacks of every thread from a background thread, reported as
+collapsed stacks for flame graphs, or runs cProfile on the event loop
+thread, reported as pstats. Memory is profiled by diffing tracemalloc
+snapshots. Nothing is hooked or traced while no profile is running.
+"""
+
+import asyncio
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import tracemalloc
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+
+class ProfilerBusyError(Exception):
+    """Raised when a CPU profile is requested while another one is running"""
+
+
+class StackSampler:
+    """Samples the stacks of all other threads at a fixed interval"""
+
+    def __init__(self, interval: float):
+        """Initialize the sampler"""
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """Start sampling in a daemon thread"""
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop sampling and wait for the thread to finish"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self) -> None:
+        """Take a sample every interval until stopped"""
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    name = getattr(code, "co_qualname", code.co_name)
+                    stack.append(f"{name} ({os.path.basename(code.co_filename)})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self) -> str:
+        """Format the samples as collapsed stacks, one "frame;frame count" line each"""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+class Profiler:
+    """On-demand CPU and memory profiling of the running process"""
+
+    def __init__(self, sample_interval: float, memory_frames: int):
+        """Initialize the profiler"""
+        self.sample_interval = sample_interval
+        self.memory_frames = memory_frames
+        self.cpu_running = False
+        self.baseline: Optional[tracemalloc.Snapshot] = None
+
+    async def profile_cpu(self, seconds: float, output: str, limit: int = 50) -> str:
+        """Profile for a number of seconds and return collapsed stacks or pstats text
+
+        Raises ProfilerBusyError if a CPU profile is already running.
+        """
+        if self.cpu_running:
+            raise ProfilerBusyError("A CPU profile is already running")
+        self.cpu_running = True
+        try:
+            if output == "pstats":
+                return await self._profile_event_loop(seconds, limit)
+            return await self._sample_stacks(seconds)
+        finally:
+            self.cpu_running = False
+
+    async def _sample_stacks(self, seconds: float) -> str:
+        """Sample every thread's stack for a number of seconds"""
+        sampler = StackSampler(self.sample_interval)
+        sampler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            await asyncio.get_running_loop().run_in_executor(None, sampler.stop)
+        return sampler.collapsed()
+
+    async def _profile_event_loop(self, seconds: float, limit: int) -> str:
+        """Run cProfile on the event loop thread for a number of seconds"""
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profile.disable()
+        output = io.StringIO()
+        pstats.Stats(profile, stream=output).sort_stats("cumulative").print_stats(limit)
+        return output.getvalue()
+
+    def memory_status(self) -> Dict[str, Any]:
+        """Get whether allocations are traced and how much memory is traced"""
+        current, peak = tracemalloc.get_traced_memory()
+        return {
+            "tracing": tracemalloc.is_tracing(),
+            "has_baseline": self.baseline is not None,
+            "traced_current": current,
+            "traced_peak": peak,
+        }
+
+    async def take_memory_baseline(self) -> Dict[str, Any]:
+        """Start tracing allocations if needed and take the snapshot later ones are compared to"""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.memory_frames)
+        loop = asyncio.get_running_loop()
+        self.baseline = await loop.run_in_executor(None, self._take_snapshot)
+        return self.memory_status()
+
+    async def diff_memory(self, group_by: str, limit: int) -> Optional[List[Dict[str, Any]]]:
+        """Compare a new snapshot to the baseline, largest growth first
+
+        Returns None if no baseline has been taken.
+        """
+        if self.baseline is None or not tracemalloc.is_tracing():
+            return None
+        loop = asyncio.get_running_loop()
+        snapshot = await loop.run_in_executor(None, self._take_snapshot)
+        differences = snapshot.compare_to(self.baseline, group_by)
+        return [
+            {
+                "location": "; ".join(
+                    f"{frame.filename}:{frame.lineno}" for frame in difference.traceback
+                ),
+                "size": difference.size,
+                "size_diff": difference.size_diff,
+                "count": difference.count,
+                "count_diff": difference.count_diff,
+            }
+            for difference in differences[:limit]
+        ]
+
+    def stop_memory(self) -> None:
+        """Stop tracing allocations and drop the baseline"""
+        self.baseline = None
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    @staticmethod
+    def _take_snapshot() -> tracemalloc.Snapshot:
+        """Take a snapshot without tracemalloc's own allocations"""
+        return tracemalloc.take_snapshot().filter_traces(
+            (tracemalloc.Filter(False, tracemalloc.__file__),)
+        )
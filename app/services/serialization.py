@@ -0,0 +1,62 @@
+"""Device Serialization
+
+This module encodes devices to JSON once per change. The encoded bytes are
+cached per device version and shared by the API, MQTT publishing and
+persistence, and list payloads are built by joining the cached fragments.
+"""
+
+import json
+from typing import Any, Dict, Iterable, Tuple
+from loguru import logger
+
+from app.models.record import DeviceRecord
+
+# Use orjson when it is installed, it encodes several times faster
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+    logger.info("orjson not available, using the standard json encoder")
+
+
+def dumps(data: Any) -> bytes:
+    """Encode data as compact JSON bytes"""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(data, default=str, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, default=str, separators=(",", ":")).encode("utf-8")
+
+
+def join_array(fragments: Iterable[bytes]) -> bytes:
+    """Build a JSON array from encoded elements"""
+    return b"[" + b",".join(fragments) + b"]"
+
+
+class DeviceJSONCache:
+    """Encoded device JSON keyed by device version"""
+
+    def __init__(self):
+        """Initialize the cache"""
+        self._entries: Dict[str, Tuple[int, bytes]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, device: DeviceRecord, version: int) -> bytes:
+        """Get the encoded device, encoding it if it changed since it was cached"""
+        entry = self._entries.get(device.id)
+        if entry and entry[0] == version:
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        encoded = dumps(device.dict())
+        self._entries[device.id] = (version, encoded)
+        return encoded
+
+    def discard(self, device_id: str) -> None:
+        """Drop the cached encoding of a deleted device"""
+        self._entries.pop(device_id, None)
+
+    def __len__(self) -> int:
+        """Number of cached devices"""
+        return len(self._entries)
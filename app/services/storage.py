@@ -0,0 +1,253 @@
+"""Device Storage
+
+This module contains the storage engines used to persist devices. The engine
+is selected with the STORAGE_ENGINE setting.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+from typing import Dict, Iterator, List, Optional, Any
+from loguru import logger
+
+from config import settings
+
+
+class DeviceStore:
+    """Base class for device storage engines"""
+
+    name = "base"
+
+    # Incremental engines persist individual changes, others need a full snapshot
+    incremental = False
+
+    # Share of the stored devices read by iter_load so far, from 0.0 to 1.0
+    load_fraction = 0.0
+
+    def iter_load(self) -> Iterator[Dict[str, Any]]:
+        """Read the stored devices one at a time"""
+        raise NotImplementedError
+
+    def load(self) -> Dict[str, Dict[str, Any]]:
+        """Load all stored devices keyed by ID"""
+        return {device_data["id"]: device_data for device_data in self.iter_load()}
+
+    def write_snapshot(self, devices_data: List[Dict[str, Any]]) -> int:
+        """Replace the stored devices and return the number of bytes written"""
+        raise NotImplementedError
+
+    def write_snapshot_json(self, devices_json: List[bytes]) -> int:
+        """Replace the stored devices from their JSON encodings"""
+        return self.write_snapshot([json.loads(device_json) for device_json in devices_json])
+
+    def write_changes(self, changes: Dict[str, Optional[Dict[str, Any]]]) -> int:
+        """Persist changed devices (None marks a deletion) and return the bytes written"""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """Release any resources held by the engine"""
+
+
+class JSONFileStore(DeviceStore):
+    """Stores all devices in a single JSON snapshot file
+
+    The file is a JSON array with one device per line, so it can be read one
+    device at a time while staying readable by any JSON tool.
+    """
+
+    name = "json"
+
+    def __init__(self, path: str):
+        """Initialize the JSON file store"""
+        self.path = path
+
+    def iter_load(self) -> Iterator[Dict[str, Any]]:
+        """Read the stored devices one line at a time"""
+        self.load_fraction = 0.0
+        if not os.path.exists(self.path):
+            self.load_fraction = 1.0
+            return
+
+        size = os.path.getsize(self.path) or 1
+        with open(self.path, "rb") as f:
+            if f.readline().strip() != b"[":
+                # Written by an older version or by hand, parse it in one go
+                f.seek(0)
+                yield from json.load(f)
+                self.load_fraction = 1.0
+                return
+
+            read = 2
+            for line in f:
+                read += len(line)
+                line = line.strip().rstrip(b",")
+                if line and line != b"]":
+                    yield json.loads(line)
+                    self.load_fraction = read / size
+        self.load_fraction = 1.0
+
+    def write_snapshot(self, devices_data: List[Dict[str, Any]]) -> int:
+        """Atomically replace the snapshot file"""
+        return self.write_snapshot_json(
+            [json.dumps(data, separators=(",", ":")).encode("utf-8") for data in devices_data]
+        )
+
+    def write_snapshot_json(self, devices_json: List[bytes]) -> int:
+        """Atomically replace the snapshot file, one encoded device per line"""
+        if not devices_json:
+            return self._write_file(b"[]\n")
+        return self._write_file(b"[\n" + b",\n".join(devices_json) + b"\n]\n")
+
+    def _write_file(self, data: bytes) -> int:
+        """Write the snapshot file and return the number of bytes written"""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        # Write to a temporary file and rename it over the old one, so a
+        # crash mid-write never leaves a truncated devices file behind
+        tmp_file = f"{self.path}.tmp"
+        with open(tmp_file, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.path)
+        return len(data)
+
+
+class SQLiteStore(DeviceStore):
+    """Stores devices in an indexed SQLite database running in WAL mode"""
+
+    name = "sqlite"
+    incremental = True
+
+    COLUMNS = ("id", "name", "type", "address", "status", "properties", "last_seen", "actions")
+
+    def __init__(self, path: str, migrate_from: Optional[str] = None):
+        """Initialize the SQLite store"""
+        self.path = path
+        self.migrate_from = migrate_from
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        # Writes may run in worker threads, so share the connection under a lock
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._create_schema()
+
+    def _create_schema(self) -> None:
+        """Create the devices table and its indexes"""
+        with self._lock, self.conn:
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS devices (
+                    id TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    type TEXT NOT NULL,
+                    address TEXT,
+                    status TEXT NOT NULL,
+                    properties TEXT NOT NULL,
+                    last_seen TEXT,
+                    actions TEXT NOT NULL
+                )
+                """
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_devices_type ON devices (type)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_devices_status ON devices (status)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_devices_address ON devices (address)")
+
+    def iter_load(self) -> Iterator[Dict[str, Any]]:
+        """Read the stored devices in batches, migrating the JSON file on first use"""
+        self.load_fraction = 0.0
+        with self._lock:
+            (count,) = self.conn.execute("SELECT COUNT(*) FROM devices").fetchone()
+        if count == 0 and self.migrate_from and os.path.exists(self.migrate_from):
+            self._migrate_json(self.migrate_from)
+            with self._lock:
+                (count,) = self.conn.execute("SELECT COUNT(*) FROM devices").fetchone()
+
+        read = 0
+        with self._lock:
+            cursor = self.conn.execute(f"SELECT {', '.join(self.COLUMNS)} FROM devices")
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(500)
+            if not rows:
+                break
+            for row in rows:
+                device_data = dict(zip(self.COLUMNS, row))
+                device_data["properties"] = json.loads(device_data["properties"])
+                device_data["actions"] = json.loads(device_data["actions"])
+                yield device_data
+            read += len(rows)
+            self.load_fraction = read / count
+        self.load_fraction = 1.0
+
+    def _migrate_json(self, json_path: str) -> None:
+        """Import devices from a JSON snapshot file and set the file aside"""
+        devices_data = list(JSONFileStore(json_path).load().values())
+        self.write_snapshot(devices_data)
+
+        # Keep the old file as a backup, but never import it twice
+        os.replace(json_path, f"{json_path}.migrated")
+        logger.info(f"Migrated {len(devices_data)} devices from {json_path} to SQLite")
+
+    def write_snapshot(self, devices_data: List[Dict[str, Any]]) -> int:
+        """Replace all stored devices in one transaction"""
+        rows = [self._encode(device_data) for device_data in devices_data]
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM devices")
+            self._insert(rows)
+        return sum(self._row_size(row) for row in rows)
+
+    def write_changes(self, changes: Dict[str, Optional[Dict[str, Any]]]) -> int:
+        """Upsert changed devices and delete removed ones in one transaction"""
+        rows = [self._encode(data) for data in changes.values() if data is not None]
+        deleted = [(device_id,) for device_id, data in changes.items() if data is None]
+        with self._lock, self.conn:
+            self._insert(rows)
+            self.conn.executemany("DELETE FROM devices WHERE id = ?", deleted)
+        return sum(self._row_size(row) for row in rows)
+
+    def close(self) -> None:
+        """Close the database connection"""
+        with self._lock:
+            self.conn.close()
+
+    def _insert(self, rows: List[tuple]) -> None:
+        """Insert or replace device rows"""
+        placeholders = ", ".join("?" for _ in self.COLUMNS)
+        self.conn.executemany(
+            f"INSERT OR REPLACE INTO devices ({', '.join(self.COLUMNS)}) VALUES ({placeholders})",
+            rows,
+        )
+
+    @staticmethod
+    def _encode(device_data: Dict[str, Any]) -> tuple:
+        """Convert serialized device data to a table row"""
+        device_type = device_data["type"]
+        return (
+            device_data["id"],
+            device_data["name"],
+            getattr(device_type, "value", device_type),
+            device_data.get("address"),
+            device_data.get("status", "unknown"),
+            json.dumps(device_data.get("properties", {}), separators=(",", ":")),
+            device_data.get("last_seen"),
+            json.dumps(device_data.get("actions", []), separators=(",", ":")),
+        )
+
+    @staticmethod
+    def _row_size(row: tuple) -> int:
+        """Approximate the number of bytes a row takes"""
+        return sum(len(value) for value in row if value is not None)
+
+
+def create_store(data_dir: str) -> DeviceStore:
+    """Create the storage engine selected in the settings"""
+    json_path = os.path.join(data_dir, "devices.json")
+    if settings.STORAGE_ENGINE == "sqlite":
+        return SQLiteStore(os.path.join(data_dir, "devices.db"), migrate_from=json_path)
+    if settings.STORAGE_ENGINE != "json":
+        logger.warning(f"Unknown storage engine {settings.STORAGE_ENGINE}, using json")
+    return JSONFileStore(json_path)
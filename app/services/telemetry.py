@@ -0,0 +1,241 @@
+"""Device Telemetry
+
+This module records numeric property readings, such as temperature or
+power, in fixed-size typed arrays. Each series keeps its latest raw samples
+and min/max/sum/count rollups at 1 minute, 1 hour and 1 day resolutions,
+updated as samples arrive, so memory per series is bounded whatever the
+ingest rate.
+"""
+
+import time
+from array import array
+from typing import Any, Dict, List, Optional, Tuple
+
+# Rollup resolutions in seconds, by the name used in the API
+RESOLUTIONS: Dict[str, int] = {"1m": 60, "1h": 3600, "1d": 86400}
+
+# (timestamp, min, max, mean, count) of a raw sample or rollup bucket
+TelemetryPoint = Tuple[float, float, float, float, int]
+
+
+class _ArrayRing:
+    """Ring of timestamped rows stored column-wise in typed arrays
+
+    The arrays grow up to capacity and are then overwritten oldest first.
+    """
+
+    __slots__ = ("capacity", "head", "times")
+
+    def __init__(self, capacity: int):
+        """Initialize the ring"""
+        self.capacity = capacity
+        # Position of the newest row, -1 while empty
+        self.head = -1
+        self.times = array("d")
+
+    def __len__(self) -> int:
+        """Number of rows in the ring"""
+        return len(self.times)
+
+    def _next_position(self) -> Tuple[int, bool]:
+        """Get the position for a new row and whether the arrays must grow"""
+        if len(self.times) < self.capacity:
+            return len(self.times), True
+        return (self.head + 1) % self.capacity, False
+
+    def _position(self, index: int) -> int:
+        """Get the array position of the index-th oldest row"""
+        size = len(self.times)
+        return (self.head + 1 + index) % size if size == self.capacity else index
+
+    def _bisect(self, timestamp: float, inclusive: bool) -> int:
+        """Get the index of the first row newer than timestamp, or as new if not inclusive"""
+        low, high = 0, len(self.times)
+        while low < high:
+            middle = (low + high) // 2
+            row_time = self.times[self._position(middle)]
+            if row_time < timestamp or (inclusive and row_time == timestamp):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _range(self, first: int, last: int, limit: int) -> List[int]:
+        """Get the positions of the newest rows from index first to last, oldest first"""
+        first = max(first, last - limit)
+        return [self._position(index) for index in range(first, last)]
+
+
+class SampleRing(_ArrayRing):
+    """Latest raw samples of a series"""
+
+    __slots__ = ("values",)
+
+    def __init__(self, capacity: int):
+        """Initialize the ring"""
+        super().__init__(capacity)
+        self.values = array("d")
+
+    def add(self, timestamp: float, value: float) -> None:
+        """Add a sample"""
+        position, grow = self._next_position()
+        if grow:
+            self.times.append(timestamp)
+            self.values.append(value)
+        else:
+            self.times[position] = timestamp
+            self.values[position] = value
+        self.head = position
+
+    def query(self, start: float, end: float, limit: int) -> List[TelemetryPoint]:
+        """Get the newest samples between start and end, oldest first"""
+        return [
+            (self.times[i], self.values[i], self.values[i], self.values[i], 1)
+            for i in self._range(self._bisect(start, False), self._bisect(end, True), limit)
+        ]
+
+
+class RollupRing(_ArrayRing):
+    """Min, max, sum and count of a series per fixed time bucket"""
+
+    __slots__ = ("resolution", "mins", "maxs", "sums", "counts")
+
+    def __init__(self, resolution: int, capacity: int):
+        """Initialize the ring"""
+        super().__init__(capacity)
+        self.resolution = resolution
+        self.mins = array("d")
+        self.maxs = array("d")
+        self.sums = array("d")
+        self.counts = array("L")
+
+    def add(self, timestamp: float, value: float) -> bool:
+        """Fold a sample into its bucket, returns False if a newer bucket has started"""
+        bucket = timestamp - timestamp % self.resolution
+        if self.head >= 0:
+            newest = self.times[self.head]
+            if bucket == newest:
+                head = self.head
+                if value < self.mins[head]:
+                    self.mins[head] = value
+                if value > self.maxs[head]:
+                    self.maxs[head] = value
+                self.sums[head] += value
+                self.counts[head] += 1
+                return True
+            if bucket < newest:
+                return False
+
+        position, grow = self._next_position()
+        if grow:
+            self.times.append(bucket)
+            self.mins.append(value)
+            self.maxs.append(value)
+            self.sums.append(value)
+            self.counts.append(1)
+        else:
+            self.times[position] = bucket
+            self.mins[position] = value
+            self.maxs[position] = value
+            self.sums[position] = value
+            self.counts[position] = 1
+        self.head = position
+        return True
+
+    def query(self, start: float, end: float, limit: int) -> List[TelemetryPoint]:
+        """Get the newest buckets overlapping start to end, oldest first"""
+        return [
+            (self.times[i], self.mins[i], self.maxs[i], self.sums[i] / self.counts[i], self.counts[i])
+            for i in self._range(
+                self._bisect(start - self.resolution, True), self._bisect(end, True), limit
+            )
+        ]
+
+
+class TelemetrySeries:
+    """Raw samples and rollups of one numeric property"""
+
+    __slots__ = ("samples", "rollups", "late")
+
+    def __init__(self, sample_size: int, rollup_sizes: Dict[str, int]):
+        """Initialize the series"""
+        self.samples = SampleRing(sample_size)
+        self.rollups = {
+            name: RollupRing(RESOLUTIONS[name], size) for name, size in rollup_sizes.items()
+        }
+        # Samples older than the newest one, which are dropped
+        self.late = 0
+
+    def add(self, timestamp: float, value: float) -> None:
+        """Record a sample"""
+        if len(self.samples) and timestamp < self.samples.times[self.samples.head]:
+            self.late += 1
+            return
+        self.samples.add(timestamp, value)
+        for rollup in self.rollups.values():
+            rollup.add(timestamp, value)
+
+
+class Telemetry:
+    """Numeric property series of every device"""
+
+    def __init__(self, sample_size: int, rollup_sizes: Dict[str, int], max_series: int):
+        """Initialize the telemetry store"""
+        self.sample_size = sample_size
+        self.rollup_sizes = rollup_sizes
+        self.max_series = max_series
+        self.series: Dict[str, Dict[str, TelemetrySeries]] = {}
+        self.stats = {"samples": 0, "late": 0, "rejected": 0}
+
+    def record(
+        self, device_id: str, properties: Dict[str, Any], timestamp: Optional[float] = None
+    ) -> int:
+        """Record the numeric values among properties and return how many were recorded"""
+        timestamp = time.time() if timestamp is None else timestamp
+        device_series = None
+        recorded = 0
+        for name, value in properties.items():
+            # bool is an int subclass, but not a reading
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            if device_series is None:
+                device_series = self.series.setdefault(device_id, {})
+            series = device_series.get(name)
+            if series is None:
+                if len(device_series) >= self.max_series:
+                    self.stats["rejected"] += 1
+                    continue
+                series = device_series[name] = TelemetrySeries(self.sample_size, self.rollup_sizes)
+            late = series.late
+            series.add(timestamp, float(value))
+            if series.late == late:
+                recorded += 1
+            else:
+                self.stats["late"] += 1
+        self.stats["samples"] += recorded
+        return recorded
+
+    def query(
+        self,
+        device_id: str,
+        name: Optional[str],
+        resolution: str,
+        start: float,
+        end: float,
+        limit: int,
+    ) -> Dict[str, List[TelemetryPoint]]:
+        """Get the points of one or every series of a device, by property name"""
+        device_series = self.series.get(device_id, {})
+        names = [name] if name else sorted(device_series)
+        points = {}
+        for series_name in names:
+            series = device_series.get(series_name)
+            if series is None:
+                continue
+            ring = series.samples if resolution == "raw" else series.rollups[resolution]
+            points[series_name] = ring.query(start, end, limit)
+        return points
+
+    def forget(self, device_id: str) -> None:
+        """Drop the series of a deleted device"""
+        self.series.pop(device_id, None)
@@ -10,7 +10,7 @@ from fastapi.templating import Jinja2Templates
 from loguru import logger
 
 from app.services.device_service import DeviceService
-from app.models.device import DeviceType
+from app.dependencies import get_device_service
 
 # Create router
 router = APIRouter()
@@ -19,43 +19,25 @@ router = APIRouter()
 templates_dir = os.path.join(os.path.dirname(__file__), "templates")
 templates = Jinja2Templates(directory=templates_dir)
 
-# Initialize services
-device_service = DeviceService()
-
 
 @router.get("/", response_class=HTMLResponse)
-async def index(request: Request):
+async def index(
+    request: Request, device_service: DeviceService = Depends(get_device_service)
+):
     """Render the dashboard page"""
     try:
         # Get all devices
         devices = await device_service.get_devices()
         
-        # Count devices by type
-        bluetooth_count = len([d for d in devices if d.type == DeviceType.BLUETOOTH])
-        mqtt_count = len([d for d in devices if d.type == DeviceType.MQTT])
-        virtual_count = len([d for d in devices if d.type == DeviceType.VIRTUAL])
-        other_count = len([d for d in devices if d.type == DeviceType.OTHER])
-        
-        # Count devices by status
-        online_count = len([d for d in devices if d.status in ["online", "connected", "on"]])
-        offline_count = len([d for d in devices if d.status in ["offline", "disconnected", "off"]])
-        unknown_count = len([d for d in devices if d.status == "unknown"])
+        # Device counts are kept up to date by the service, same as /api/devices/stats
+        device_counts = device_service.get_stats()
         
         return templates.TemplateResponse(
             "index.html",
             {
                 "request": request,
                 "devices": devices,
-                "device_counts": {
-                    "total": len(devices),
-                    "bluetooth": bluetooth_count,
-                    "mqtt": mqtt_count,
-                    "virtual": virtual_count,
-                    "other": other_count,
-                    "online": online_count,
-                    "offline": offline_count,
-                    "unknown": unknown_count,
-                },
+                "device_counts": device_counts,
             },
         )
     except Exception as e:
@@ -64,7 +46,9 @@ async def index(request: Request):
 
 
 @router.get("/devices", response_class=HTMLResponse)
-async def devices_page(request: Request):
+async def devices_page(
+    request: Request, device_service: DeviceService = Depends(get_device_service)
+):
     """Render the devices page"""
     try:
         # Get all devices
@@ -83,7 +67,11 @@ async def devices_page(request: Request):
 
 
 @router.get("/devices/{device_id}", response_class=HTMLResponse)
-async def device_detail(request: Request, device_id: str):
+async def device_detail(
+    request: Request,
+    device_id: str,
+    device_service: DeviceService = Depends(get_device_service),
+):
     """Render the device detail page"""
     try:
         # Get the device
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""Device Load Benchmark
+
+Compares building the registry from stored device data with full pydantic
+validation and with the trusted path used for data the hub wrote itself.
+
+Usage: python -m benchmarks.device_load [device_count]
+"""
+
+import json
+import sys
+import time
+
+from app.models.device import Device
+from app.models.record import DeviceRecord
+from benchmarks.device_memory import make_devices_json
+
+
+def timed(build, devices_json: bytes) -> float:
+    """Return the seconds build takes to turn decoded devices into records"""
+    devices_data = json.loads(devices_json)
+    start = time.perf_counter()
+    build(devices_data)
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    """Run the benchmark"""
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    devices_json = make_devices_json(count)
+
+    validated = timed(
+        lambda data: [DeviceRecord.from_model(Device(**d)) for d in data], devices_json
+    )
+    trusted = timed(lambda data: [DeviceRecord.from_trusted(d) for d in data], devices_json)
+
+    print(f"{count} devices")
+    print(f"  validated:  {validated:6.3f} s  {validated / count * 1e6:5.1f} us/device")
+    print(f"  trusted:    {trusted:6.3f} s  {trusted / count * 1e6:5.1f} us/device")
+    print(f"  speedup:    {validated / trusted:6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""Device Memory Benchmark
+
+Compares the memory taken by a registry of pydantic Device models with one
+of compact DeviceRecords. Devices are decoded from JSON first, as they are
+when loaded from the store, so no strings are shared by accident.
+
+Usage: python -m benchmarks.device_memory [device_count]
+"""
+
+import gc
+import json
+import sys
+import tracemalloc
+import uuid
+from datetime import datetime
+
+from app.models.device import Device, DeviceType
+from app.models.record import DEFAULT_ACTIONS, DeviceRecord
+
+
+def make_devices_json(count: int) -> bytes:
+    """Build a stored device list with a realistic mix of types and statuses"""
+    types = list(DeviceType)
+    statuses = ["online", "offline", "on", "off", "connected", "unknown"]
+    now = datetime.now().isoformat()
+    devices = []
+    for i in range(count):
+        device_type = types[i % len(types)]
+        devices.append(
+            {
+                "id": str(uuid.uuid4()),
+                "name": f"Device {i}",
+                "type": device_type.value,
+                "address": f"00:11:22:{i // 65536 % 256:02X}:{i // 256 % 256:02X}:{i % 256:02X}",
+                "status": statuses[i % len(statuses)],
+                "properties": {"class": 0x240404, "services": []},
+                "last_seen": now,
+                "actions": list(DEFAULT_ACTIONS[device_type]),
+            }
+        )
+    return json.dumps(devices).encode("utf-8")
+
+
+def measure(build, devices_json: bytes) -> int:
+    """Return the bytes held by the registry that build creates"""
+    gc.collect()
+    tracemalloc.start()
+    devices_data = json.loads(devices_json)
+    registry = build(devices_data)
+    del devices_data
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del registry
+    return size
+
+
+def build_models(devices_data):
+    """Registry of pydantic models, as before"""
+    return {data["id"]: Device(**data) for data in devices_data}
+
+
+def build_records(devices_data):
+    """Registry of compact records"""
+    return {data["id"]: DeviceRecord.from_model(Device(**data)) for data in devices_data}
+
+
+def main() -> None:
+    """Run the benchmark"""
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    devices_json = make_devices_json(count)
+
+    models = measure(build_models, devices_json)
+    records = measure(build_records, devices_json)
+
+    print(f"{count} devices")
+    print(f"  pydantic Device:  {models / 2**20:8.1f} MiB  {models / count:6.0f} B/device")
+    print(f"  DeviceRecord:     {records / 2**20:8.1f} MiB  {records / count:6.0f} B/device")
+    print(f"  saved:            {(models - records) / 2**20:8.1f} MiB  ({1 - records / models:.0%})")
+
+
+if __name__ == "__main__":
+    main()
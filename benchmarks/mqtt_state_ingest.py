@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""MQTT State Ingest Benchmark
+
+Measures how many device state reports per second the hub takes from MQTT
+dispatch to the registry, with reports applied in one batch per window.
+Reports cycle through the devices with changing readings, so every batch
+changes and persists every device.
+
+Usage: python -m benchmarks.mqtt_state_ingest [message_count] [device_count]
+"""
+
+import asyncio
+import sys
+import tempfile
+import time
+from unittest.mock import patch
+
+from app.core.mqtt import MQTTClient
+from app.models.device import DeviceCreate, DeviceType
+from app.services.device_service import DeviceService
+
+# Reports received per window, as if arriving at 10k per second for half a second
+REPORTS_PER_WINDOW = 5000
+
+
+async def run(service: DeviceService, message_count: int, device_ids) -> float:
+    """Return the seconds taken to dispatch and apply message_count reports"""
+    messages = [
+        (
+            f"smarthomelite/{device_ids[i % len(device_ids)]}/state",
+            b'{"status": "%s", "temperature": %d.5}' % (b"on" if i % 3 else b"off", i % 40),
+        )
+        for i in range(message_count)
+    ]
+    handle = service.mqtt_client._handle_message
+
+    start = time.perf_counter()
+    for position, (topic, payload) in enumerate(messages, 1):
+        await handle(topic, payload)
+        if position % REPORTS_PER_WINDOW == 0:
+            service._apply_state_reports()
+    service._apply_state_reports()
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    """Run the benchmark"""
+    message_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    device_count = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+    with tempfile.TemporaryDirectory() as data_dir, \
+            patch("app.services.device_service.DATA_DIR", data_dir):
+        service = DeviceService(mqtt_client=MQTTClient())
+
+        async def scenario():
+            with service._batch_changes():
+                device_ids = [
+                    (await service.create_device(
+                        DeviceCreate(name=f"Sensor {i}", type=DeviceType.MQTT)
+                    )).id
+                    for i in range(device_count)
+                ]
+            return await run(service, message_count, device_ids)
+
+        elapsed = asyncio.run(scenario())
+        stats = service.get_mqtt_state_stats()
+        service.store.close()
+
+    print(f"{message_count} reports for {device_count} devices")
+    print(f"  elapsed:    {elapsed:6.3f} s  {elapsed / message_count * 1e6:5.1f} us/report")
+    print(f"  rate:       {message_count / elapsed:8.0f} reports/s")
+    print(f"  applied:    {stats['applied']} changes in {stats['batches']} batches")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""Topic Router Benchmark
+
+Compares matching MQTT topics with the topic router's trie against testing
+every registered pattern in turn, with per-device routes plus a few
+wildcard patterns registered.
+
+Usage: python -m benchmarks.topic_router [route_count]
+"""
+
+import random
+import sys
+import time
+
+from app.core.topic_router import TopicRouter
+
+ACTION_TYPES = ["state", "power", "brightness", "temperature"]
+WILDCARDS = ["home/+/state", "home/#", "zigbee/+/availability", "#"]
+
+
+def pattern_matches(pattern: str, topic: str) -> bool:
+    """Match a topic against one pattern, level by level"""
+    pattern_levels = pattern.split("/")
+    topic_levels = topic.split("/")
+    for position, level in enumerate(pattern_levels):
+        if level == "#":
+            return True
+        if position >= len(topic_levels):
+            return False
+        if level != "+" and level != topic_levels[position]:
+            return False
+    return len(pattern_levels) == len(topic_levels)
+
+
+def timed(match, topics) -> float:
+    """Return the seconds match takes per topic"""
+    start = time.perf_counter()
+    for topic in topics:
+        match(topic)
+    return (time.perf_counter() - start) / len(topics)
+
+
+def main() -> None:
+    """Run the benchmark"""
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    patterns = WILDCARDS + [
+        f"home/device-{i}/{ACTION_TYPES[i % len(ACTION_TYPES)]}"
+        for i in range(count - len(WILDCARDS))
+    ]
+    router = TopicRouter()
+    for pattern in patterns:
+        router.add(pattern, pattern)
+
+    random.seed(0)
+    topics = [
+        f"home/device-{random.randrange(count)}/{random.choice(ACTION_TYPES)}"
+        for _ in range(10_000)
+    ]
+
+    trie = timed(router.match, topics)
+    # The scan is slow enough that a sample of the topics is plenty
+    linear = timed(lambda topic: [p for p in patterns if pattern_matches(p, topic)], topics[:200])
+
+    print(f"{len(router)} routes")
+    print(f"  trie:       {trie * 1e6:9.1f} us/lookup")
+    print(f"  linear:     {linear * 1e6:9.1f} us/lookup")
+    print(f"  speedup:    {linear / trie:9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
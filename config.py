@@ -38,6 +38,21 @@ class Settings(BaseSettings):
     MQTT_PASSWORD: str = os.getenv("MQTT_PASSWORD", "")
     MQTT_CLIENT_ID: str = os.getenv("MQTT_CLIENT_ID", "smarthomelite")
     MQTT_TOPIC_PREFIX: str = os.getenv("MQTT_TOPIC_PREFIX", "smarthomelite")
+    MQTT_INGEST_QUEUE_SIZE: int = int(os.getenv("MQTT_INGEST_QUEUE_SIZE", 1000))  # messages
+    MQTT_INGEST_OVERFLOW: str = os.getenv(
+        "MQTT_INGEST_OVERFLOW", "drop_oldest"
+    )  # 'drop_oldest', 'block' or 'coalesce'
+    MQTT_INGEST_BATCH_SIZE: int = int(os.getenv("MQTT_INGEST_BATCH_SIZE", 100))  # messages per dispatch
+    MQTT_STATE_PUBLISH_MODE: str = os.getenv("MQTT_STATE_PUBLISH_MODE", "full")  # 'full' or 'delta'
+    MQTT_STATE_PUBLISH_WINDOW: float = float(os.getenv("MQTT_STATE_PUBLISH_WINDOW", 0.25))  # seconds
+    MQTT_STATE_PUBLISH_RATE: float = float(os.getenv("MQTT_STATE_PUBLISH_RATE", 100))  # per second, 0 for no limit
+    MQTT_STATE_PUBLISH_DEVICE_RATE: float = float(
+        os.getenv("MQTT_STATE_PUBLISH_DEVICE_RATE", 2)
+    )  # per device per second, 0 for no limit
+    MQTT_ACTION_WINDOW: int = int(os.getenv("MQTT_ACTION_WINDOW", 4))  # unacknowledged actions per device
+    MQTT_ACTION_TIMEOUT: float = float(os.getenv("MQTT_ACTION_TIMEOUT", 5.0))  # seconds
+    MQTT_STATE_INGEST_WINDOW: float = float(os.getenv("MQTT_STATE_INGEST_WINDOW", 0.5))  # seconds
+    MQTT_STATE_MAX_PENDING: int = int(os.getenv("MQTT_STATE_MAX_PENDING", 10000))  # devices, while loading
 
     # Voice recognition settings (optional)
     VOICE_ENABLED: bool = os.getenv("VOICE_ENABLED", "False").lower() in (
@@ -47,6 +62,65 @@ class Settings(BaseSettings):
     )
     VOICE_ENGINE: str = os.getenv("VOICE_ENGINE", "vosk")  # 'vosk' or 'google'
 
+    # Persistence settings
+    STORAGE_ENGINE: str = os.getenv("STORAGE_ENGINE", "json")  # 'json' or 'sqlite'
+    PERSISTENCE_MODE: str = os.getenv(
+        "PERSISTENCE_MODE", "sync"
+    )  # 'sync', 'write_behind' or 'journal'
+    PERSISTENCE_FLUSH_INTERVAL: float = float(
+        os.getenv("PERSISTENCE_FLUSH_INTERVAL", 2.0)
+    )  # seconds
+    PERSISTENCE_FLUSH_THRESHOLD: int = int(
+        os.getenv("PERSISTENCE_FLUSH_THRESHOLD", 100)
+    )  # pending changes
+    JOURNAL_COMPACT_INTERVAL: float = float(
+        os.getenv("JOURNAL_COMPACT_INTERVAL", 300.0)
+    )  # seconds
+    JOURNAL_COMPACT_SIZE: int = int(
+        os.getenv("JOURNAL_COMPACT_SIZE", 1048576)
+    )  # bytes
+
+    # Action settings, maximum actions running at once per device type
+    ACTION_CONCURRENCY_BLUETOOTH: int = int(os.getenv("ACTION_CONCURRENCY_BLUETOOTH", 2))
+    ACTION_CONCURRENCY_MQTT: int = int(os.getenv("ACTION_CONCURRENCY_MQTT", 16))
+    ACTION_CONCURRENCY_VIRTUAL: int = int(os.getenv("ACTION_CONCURRENCY_VIRTUAL", 64))
+    ACTION_CONCURRENCY_OTHER: int = int(os.getenv("ACTION_CONCURRENCY_OTHER", 8))
+    ACTION_QUEUE_DEPTH: int = int(os.getenv("ACTION_QUEUE_DEPTH", 16))  # per device
+
+    # API settings
+    API_PAGE_SIZE: int = int(os.getenv("API_PAGE_SIZE", 100))  # devices per page
+    API_MAX_PAGE_SIZE: int = int(os.getenv("API_MAX_PAGE_SIZE", 1000))
+    API_MAX_BATCH_SIZE: int = int(os.getenv("API_MAX_BATCH_SIZE", 1000))  # operations per batch
+    CHANGE_LOG_SIZE: int = int(os.getenv("CHANGE_LOG_SIZE", 10000))  # changes kept for delta sync
+
+    # Event stream settings
+    EVENT_BUFFER_SIZE: int = int(os.getenv("EVENT_BUFFER_SIZE", 256))  # pending events per client
+    EVENT_METRICS_INTERVAL: float = float(os.getenv("EVENT_METRICS_INTERVAL", 5.0))  # in seconds
+    EVENT_KEEPALIVE_INTERVAL: float = float(os.getenv("EVENT_KEEPALIVE_INTERVAL", 15.0))  # in seconds
+
+    # Device history settings
+    HISTORY_BUFFER_SIZE: int = int(os.getenv("HISTORY_BUFFER_SIZE", 50))  # entries kept in memory per device
+    HISTORY_PERSIST: bool = os.getenv("HISTORY_PERSIST", "False").lower() in ("true", "1", "t")
+    HISTORY_SEGMENT_INTERVAL: int = int(os.getenv("HISTORY_SEGMENT_INTERVAL", 3600))  # seconds per file
+    HISTORY_RETENTION_DAYS: float = float(os.getenv("HISTORY_RETENTION_DAYS", 7.0))
+    HISTORY_FLUSH_INTERVAL: float = float(os.getenv("HISTORY_FLUSH_INTERVAL", 1.0))  # in seconds
+    HISTORY_MAX_PENDING: int = int(os.getenv("HISTORY_MAX_PENDING", 100000))  # entries waiting for disk
+
+    # Telemetry settings, points kept per numeric property
+    TELEMETRY_SAMPLES: int = int(os.getenv("TELEMETRY_SAMPLES", 360))  # raw samples
+    TELEMETRY_MINUTES: int = int(os.getenv("TELEMETRY_MINUTES", 1440))  # 1 minute rollups
+    TELEMETRY_HOURS: int = int(os.getenv("TELEMETRY_HOURS", 720))  # 1 hour rollups
+    TELEMETRY_DAYS: int = int(os.getenv("TELEMETRY_DAYS", 365))  # 1 day rollups
+    TELEMETRY_MAX_SERIES: int = int(os.getenv("TELEMETRY_MAX_SERIES", 16))  # per device
+
+    # Metrics settings
+    METRICS_LOOP_LAG_INTERVAL: float = float(os.getenv("METRICS_LOOP_LAG_INTERVAL", 0.5))  # in seconds
+
+    # Profiling settings, for the admin endpoints under /api/system/profile
+    PROFILE_MAX_SECONDS: int = int(os.getenv("PROFILE_MAX_SECONDS", 120))
+    PROFILE_SAMPLE_INTERVAL: float = float(os.getenv("PROFILE_SAMPLE_INTERVAL", 0.005))  # in seconds
+    PROFILE_MEMORY_FRAMES: int = int(os.getenv("PROFILE_MEMORY_FRAMES", 1))  # frames kept per allocation
+
     # Security settings
     API_KEY: str = os.getenv("API_KEY", "")
     API_KEY_ENABLED: bool = os.getenv("API_KEY_ENABLED", "False").lower() in (
@@ -7,15 +7,23 @@ It initializes the FastAPI app, sets up routes, and starts the server.
 """
 
 import os
+from contextlib import asynccontextmanager
+
 import uvicorn
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
 from loguru import logger
 
 # Import application modules
-from app.api import devices, system
+from app.api import devices, events, metrics, system
+from app.api.metrics import MetricsMiddleware
 from app.web.routes import router as web_router
 from app.core.bluetooth import BluetoothManager
+from app.core.mqtt import MQTTClient
+from app.services.device_service import DeviceService
+from app.services.event_stream import EventBroker
+from app.services.metrics import EVENT_LOOP_LAG, EventLoopMonitor
+from app.services.profiling import Profiler
 from config import settings
 
 # Configure logger
@@ -28,19 +36,71 @@ logger.add(
     diagnose=True,
 )
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Build the shared services on startup and clean them up on shutdown"""
+    logger.info("Starting SmartHomeLite...")
+
+    # Initialize core components, shared by all routers through app.state
+    bluetooth_manager = BluetoothManager()
+    mqtt_client = MQTTClient()
+    event_broker = EventBroker(settings.EVENT_BUFFER_SIZE)
+    device_service = DeviceService(
+        bluetooth_manager=bluetooth_manager,
+        mqtt_client=mqtt_client,
+        event_broker=event_broker,
+        background_load=True,
+    )
+    app.state.bluetooth_manager = bluetooth_manager
+    app.state.mqtt_client = mqtt_client
+    app.state.event_broker = event_broker
+    app.state.device_service = device_service
+    app.state.profiler = Profiler(settings.PROFILE_SAMPLE_INTERVAL, settings.PROFILE_MEMORY_FRAMES)
+    loop_monitor = EventLoopMonitor(EVENT_LOOP_LAG)
+
+    # Measure event loop lag
+    loop_monitor.start(settings.METRICS_LOOP_LAG_INTERVAL)
+    # Start device persistence
+    await device_service.start()
+    # Push system metrics to connected dashboards
+    await event_broker.start(system.collect_system_metrics, settings.EVENT_METRICS_INTERVAL)
+    # Connect to the MQTT broker (if enabled)
+    await mqtt_client.start()
+    # Initialize Bluetooth discovery
+    await bluetooth_manager.start_discovery()
+    logger.info(f"Server running at http://{settings.HOST}:{settings.PORT}")
+
+    yield
+
+    logger.info("Shutting down SmartHomeLite...")
+    # Stop Bluetooth discovery
+    await bluetooth_manager.stop_discovery()
+    # Disconnect from the MQTT broker
+    await mqtt_client.stop()
+    # Stop pushing system metrics
+    await event_broker.stop()
+    # Flush pending device changes
+    await device_service.stop()
+    await loop_monitor.stop()
+
+
 # Create FastAPI app
 app = FastAPI(
     title="SmartHomeLite",
     description="A Python-based local smart home hub for Android (Termux)",
     version="0.1.0",
+    lifespan=lifespan,
 )
 
-# Initialize core components
-bluetooth_manager = BluetoothManager()
-
 # Include API routers
 app.include_router(devices.router, prefix="/api/devices", tags=["devices"])
 app.include_router(system.router, prefix="/api/system", tags=["system"])
+app.include_router(events.router, prefix="/api/events", tags=["events"])
+app.include_router(metrics.router, tags=["metrics"])
+
+# Record request latency per route
+app.add_middleware(MetricsMiddleware)
 
 # Include web routes
 app.include_router(web_router)
@@ -53,23 +113,6 @@ app.mount(
 )
 
 
-@app.on_event("startup")
-async def startup_event():
-    """Initialize services on startup"""
-    logger.info("Starting SmartHomeLite...")
-    # Initialize Bluetooth discovery
-    await bluetooth_manager.start_discovery()
-    logger.info(f"Server running at http://{settings.HOST}:{settings.PORT}")
-
-
-@app.on_event("shutdown")
-async def shutdown_event():
-    """Clean up resources on shutdown"""
-    logger.info("Shutting down SmartHomeLite...")
-    # Stop Bluetooth discovery
-    await bluetooth_manager.stop_discovery()
-
-
 if __name__ == "__main__":
     # Create logs directory if it doesn't exist
     os.makedirs("logs", exist_ok=True)
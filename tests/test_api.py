@@ -1,9 +1,13 @@
+import asyncio
 import pytest
 from fastapi.testclient import TestClient
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, AsyncMock, MagicMock
 
 from main import app
+from app.dependencies import get_bluetooth_manager
 from app.models.device import Device, DeviceType, DeviceAction
+from app.models.record import DeviceRecord
+from app.services.device_service import DeviceService
 
 
 @pytest.fixture
@@ -165,22 +169,322 @@ def test_execute_action(client, mock_device_service):
 
 
 def test_discover_devices(client):
-    """Test POST /api/devices/discover endpoint"""
-    with patch('app.api.devices.bluetooth_manager') as mock_bluetooth:
-        # Configure mock
-        mock_instance = MagicMock()
-        mock_bluetooth.return_value = mock_instance
-        mock_instance.discover_devices.return_value = [
-            {"address": "00:11:22:33:44:55", "name": "Test Device"}
-        ]
-        
-        response = client.post("/api/devices/discover")
-        
-        # Verify the response
+    """Test GET /api/devices/discover endpoint"""
+    mock_bluetooth = MagicMock()
+    mock_bluetooth.discover_devices = AsyncMock(return_value=[
+        DeviceRecord("test-device-1", "Test Device", DeviceType.BLUETOOTH, address="00:11:22:33:44:55")
+    ])
+    app.dependency_overrides[get_bluetooth_manager] = lambda: mock_bluetooth
+    try:
+        response = client.get("/api/devices/discover")
+    finally:
+        app.dependency_overrides.pop(get_bluetooth_manager)
+
+    # Verify the response
+    assert response.status_code == 200
+    data = response.json()
+    assert len(data) == 1
+    assert data[0]["address"] == "00:11:22:33:44:55"
+
+    # Verify the bluetooth manager method was called
+    mock_bluetooth.discover_devices.assert_awaited_once()
+
+
+@pytest.fixture
+def app_client(tmp_path):
+    """Create a test client that runs the app lifespan against a temporary data directory"""
+    with patch('app.services.device_service.DATA_DIR', str(tmp_path)), \
+            patch('app.core.bluetooth.settings.BLUETOOTH_ENABLED', False):
+        with TestClient(app) as test_client:
+            yield test_client
+
+
+def test_routers_share_one_registry(app_client):
+    """Test that the API, dashboard and Bluetooth manager share the device registry"""
+    response = app_client.post("/api/devices/", json={
+        "name": "Speaker",
+        "type": "bluetooth",
+        "address": "00:11:22:33:44:55",
+    })
+    assert response.status_code == 201
+    device_id = response.json()["id"]
+
+    # Verify the dashboard sees the device created through the API
+    response = app_client.get("/")
+    assert response.status_code == 200
+    assert "Speaker" in response.text
+
+    # Verify the Bluetooth manager resolves registered devices
+    state = app_client.app.state
+    assert state.device_service.bluetooth_manager is state.bluetooth_manager
+    assert state.bluetooth_manager._find_device(device_id).name == "Speaker"
+
+
+def test_discovery_updates_registered_devices(app_client):
+    """Test that Bluetooth scan results reach the shared registry"""
+    response = app_client.post("/api/devices/", json={
+        "name": "Speaker",
+        "type": "bluetooth",
+        "address": "00:11:22:33:44:55",
+    })
+    device_id = response.json()["id"]
+
+    found = Device(
+        id="001122334455",
+        name="Speaker",
+        type=DeviceType.BLUETOOTH,
+        address="00:11:22:33:44:55",
+        status="online",
+    )
+    bluetooth_manager = app_client.app.state.bluetooth_manager
+    with patch.object(bluetooth_manager, '_discover_with_bluetoothctl', return_value=[found]), \
+            patch('app.core.bluetooth.PYBLUEZ_AVAILABLE', False):
+        asyncio.run(bluetooth_manager.discover_devices())
+
+    # Verify the registered device was marked online
+    response = app_client.get(f"/api/devices/{device_id}")
+    assert response.json()["status"] == "online"
+
+
+def test_device_listing_is_cursor_paginated(app_client):
+    """Test walking the device list page by page with a stable order"""
+    created = []
+    for i in range(5):
+        response = app_client.post("/api/devices/", json={"name": f"Lamp {i}", "type": "virtual"})
+        created.append(response.json()["id"])
+
+    seen = []
+    cursor = None
+    while True:
+        params = {"limit": 2}
+        if cursor:
+            params["cursor"] = cursor
+        response = app_client.get("/api/devices/", params=params)
         assert response.status_code == 200
-        data = response.json()
-        assert len(data) == 1
-        assert data[0]["address"] == "00:11:22:33:44:55"
-        
-        # Verify the bluetooth manager method was called
-        mock_instance.discover_devices.assert_called_once()
\ No newline at end of file
+        assert len(response.json()) <= 2
+        seen.extend(d["id"] for d in response.json())
+        cursor = response.headers.get("X-Next-Cursor")
+        if not cursor:
+            break
+
+    # Verify every device was returned exactly once, ordered by ID
+    assert seen == sorted(created)
+
+    # Verify a bad cursor and an oversized page are rejected
+    assert app_client.get("/api/devices/", params={"cursor": "%%%"}).status_code == 400
+    assert app_client.get("/api/devices/", params={"limit": 100000}).status_code == 422
+
+
+def test_device_listing_filters_and_projection(app_client):
+    """Test filtering the device list and projecting fields"""
+    lamp = app_client.post("/api/devices/", json={"name": "Lamp", "type": "virtual"}).json()
+    app_client.post("/api/devices/", json={"name": "Fan", "type": "virtual"})
+    app_client.post("/api/devices/", json={"name": "Sensor", "type": "mqtt"})
+    app_client.post(f"/api/devices/{lamp['id']}/action", json={"action_type": "on"})
+
+    response = app_client.get("/api/devices/", params={"status": "on", "fields": "id,status"})
+    assert response.json() == [{"id": lamp["id"], "status": "on"}]
+
+    response = app_client.get("/api/devices/", params={"device_type": "virtual", "fields": "name"})
+    assert sorted(d["name"] for d in response.json()) == ["Fan", "Lamp"]
+
+    response = app_client.get("/api/devices/", params={"last_seen_from": "2999-01-01T00:00:00"})
+    assert response.json() == []
+    response = app_client.get("/api/devices/", params={"last_seen_to": "2999-01-01T00:00:00Z"})
+    assert len(response.json()) == 3
+    response = app_client.get("/api/devices/", params={"last_seen_from": "2000-01-01 00:00:00+02:00"})
+    assert len(response.json()) == 3
+    for bad_time in ("yesterday", "2000-01-01"):
+        response = app_client.get("/api/devices/", params={"last_seen_from": bad_time})
+        assert response.status_code == 422
+
+    # Verify no cursor is handed out when no further device matches
+    response = app_client.get("/api/devices/", params={"device_type": "virtual", "limit": 2})
+    assert len(response.json()) == 2
+    assert "X-Next-Cursor" not in response.headers
+
+    response = app_client.get("/api/devices/", params={"fields": "id,secret"})
+    assert response.status_code == 400
+
+
+def test_batch_applies_all_operations_with_one_write(app_client):
+    """Test a mixed batch of creates, updates and deletes"""
+    fan = app_client.post("/api/devices/", json={"name": "Fan", "type": "virtual"}).json()
+    lamp = app_client.post("/api/devices/", json={"name": "Lamp", "type": "virtual"}).json()
+    device_service = app_client.app.state.device_service
+    writes = device_service.persistence_stats["writes"]
+
+    response = app_client.post("/api/devices/batch", json=[
+        {"op": "create", "data": {"name": "Sensor", "type": "mqtt"}},
+        {"op": "create", "data": {"name": "Speaker", "type": "bluetooth"}},
+        {"op": "update", "device_id": lamp["id"], "data": {"name": "Desk Lamp"}},
+        {"op": "delete", "device_id": fan["id"]},
+    ])
+
+    # Verify per-item results
+    assert response.status_code == 200
+    results = response.json()
+    assert [r["success"] for r in results] == [True] * 4
+    assert results[0]["device"]["name"] == "Sensor"
+    assert results[2]["device"]["name"] == "Desk Lamp"
+    assert results[3]["device_id"] == fan["id"]
+
+    # Verify the batch was persisted once
+    assert device_service.persistence_stats["writes"] == writes + 1
+    names = sorted(d["name"] for d in app_client.get("/api/devices/").json())
+    assert names == ["Desk Lamp", "Sensor", "Speaker"]
+
+
+def test_batch_with_invalid_operation_changes_nothing(app_client):
+    """Test that one invalid operation rejects the whole batch"""
+    lamp = app_client.post("/api/devices/", json={"name": "Lamp", "type": "virtual"}).json()
+
+    response = app_client.post("/api/devices/batch", json=[
+        {"op": "create", "data": {"name": "Sensor", "type": "mqtt"}},
+        {"op": "delete", "device_id": lamp["id"]},
+        {"op": "update", "device_id": lamp["id"], "data": {"name": "Gone"}},
+        {"op": "create", "data": {"name": "Broken", "type": "toaster"}},
+    ])
+
+    # Verify the errors point at the bad operations
+    assert response.status_code == 422
+    results = response.json()["detail"]
+    assert [r["success"] for r in results] == [False] * 4
+    assert "not found" in results[2]["error"]
+    assert results[3]["error"].startswith("type:")
+
+    # Verify nothing was applied
+    devices = app_client.get("/api/devices/").json()
+    assert [d["name"] for d in devices] == ["Lamp"]
+
+
+def test_fan_out_action_by_selector(app_client):
+    """Test running one action on every device matching a selector"""
+    lamps = [
+        app_client.post("/api/devices/", json={"name": f"Lamp {i}", "type": "virtual"}).json()
+        for i in range(3)
+    ]
+    app_client.post("/api/devices/", json={"name": "Sensor", "type": "mqtt"})
+    device_service = app_client.app.state.device_service
+    writes = device_service.persistence_stats["writes"]
+
+    response = app_client.post("/api/devices/actions", json={
+        "device_type": "virtual",
+        "action": {"action_type": "on"},
+    })
+
+    # Verify every matching device was switched on and timed
+    assert response.status_code == 200
+    results = response.json()
+    assert sorted(r["device_id"] for r in results) == sorted(d["id"] for d in lamps)
+    assert all(r["success"] and r["status"] == "on" and r["duration"] >= 0 for r in results)
+
+    # Verify the changes were persisted once
+    assert device_service.persistence_stats["writes"] == writes + 1
+
+
+def test_fan_out_action_by_ids(app_client):
+    """Test running one action on a list of devices, including unknown ones"""
+    lamp = app_client.post("/api/devices/", json={"name": "Lamp", "type": "virtual"}).json()
+
+    response = app_client.post("/api/devices/actions", json={
+        "device_ids": [lamp["id"], "missing"],
+        "action": {"action_type": "off"},
+    })
+    results = {r["device_id"]: r for r in response.json()}
+    assert results[lamp["id"]]["status"] == "off"
+    assert not results["missing"]["success"]
+
+    # Verify a request without targets is rejected
+    response = app_client.post("/api/devices/actions", json={"action": {"action_type": "off"}})
+    assert response.status_code == 400
+
+
+def test_device_queue_stats(app_client):
+    """Test reading the action queue statistics of a device"""
+    lamp = app_client.post("/api/devices/", json={"name": "Lamp", "type": "virtual"}).json()
+    app_client.post(f"/api/devices/{lamp['id']}/action", json={"action_type": "on"})
+
+    response = app_client.get(f"/api/devices/{lamp['id']}/queue")
+
+    # Verify
+    assert response.status_code == 200
+    assert response.json()["executed"] == 1
+    assert response.json()["depth"] == 0
+    assert app_client.get("/api/devices/missing/queue").status_code == 404
+
+
+def test_conditional_get_returns_not_modified(app_client):
+    """Test that If-None-Match answers 304 until the device or registry changes"""
+    lamp = app_client.post("/api/devices/", json={"name": "Lamp", "type": "virtual"}).json()
+    fan = app_client.post("/api/devices/", json={"name": "Fan", "type": "virtual"}).json()
+
+    listing = app_client.get("/api/devices/")
+    device = app_client.get(f"/api/devices/{lamp['id']}")
+    list_etag = listing.headers["ETag"]
+    device_etag = device.headers["ETag"]
+
+    # Verify unchanged resources are not sent again
+    response = app_client.get("/api/devices/", headers={"If-None-Match": list_etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    response = app_client.get(f"/api/devices/{lamp['id']}", headers={"If-None-Match": device_etag})
+    assert response.status_code == 304
+
+    # Verify a change to another device invalidates the listing but not the lamp
+    app_client.put(f"/api/devices/{fan['id']}", json={"name": "Ceiling Fan"})
+    assert app_client.get("/api/devices/", headers={"If-None-Match": list_etag}).status_code == 200
+    response = app_client.get(f"/api/devices/{lamp['id']}", headers={"If-None-Match": device_etag})
+    assert response.status_code == 304
+
+    app_client.post(f"/api/devices/{lamp['id']}/action", json={"action_type": "on"})
+    response = app_client.get(f"/api/devices/{lamp['id']}", headers={"If-None-Match": device_etag})
+    assert response.status_code == 200
+    assert response.json()["status"] == "on"
+    assert response.headers["ETag"] != device_etag
+
+
+def test_device_changes_since_version(app_client):
+    """Test syncing only the devices changed since the last listing"""
+    lamp = app_client.post("/api/devices/", json={"name": "Lamp", "type": "virtual"}).json()
+    fan = app_client.post("/api/devices/", json={"name": "Fan", "type": "virtual"}).json()
+    version = int(app_client.get("/api/devices/").headers["X-Registry-Version"])
+
+    app_client.post(f"/api/devices/{lamp['id']}/action", json={"action_type": "on"})
+    app_client.delete(f"/api/devices/{fan['id']}")
+
+    response = app_client.get(f"/api/devices/changes?since={version}")
+
+    # Verify
+    assert response.status_code == 200
+    changes = response.json()
+    assert changes["full"] is False
+    assert [d["id"] for d in changes["devices"]] == [lamp["id"]]
+    assert changes["deleted"] == [fan["id"]]
+
+    # Verify an unknown version falls back to a full resync
+    changes = app_client.get("/api/devices/changes?since=0").json()
+    assert changes["full"] is True
+    assert changes["devices"] == []
+    assert changes["version"] == app_client.app.state.device_service.get_version()
+    assert changes["version"] > version
+
+
+def test_restart_flushes_pending_changes(tmp_path):
+    """Test that restarting writes changes still waiting in the write-behind window"""
+    with patch('app.services.device_service.DATA_DIR', str(tmp_path)), \
+            patch('app.services.device_service.settings.PERSISTENCE_MODE', "write_behind"), \
+            patch('app.services.device_service.settings.PERSISTENCE_FLUSH_INTERVAL', 3600), \
+            patch('app.core.bluetooth.settings.BLUETOOTH_ENABLED', False), \
+            patch('app.api.system.os._exit') as mock_exit:
+        with TestClient(app) as test_client:
+            response = test_client.post("/api/devices/", json={"name": "Lamp", "type": "virtual"})
+            device_id = response.json()["id"]
+            assert test_client.app.state.device_service.persistence_stats["writes"] == 0
+
+            response = test_client.post("/api/system/restart")
+            assert response.status_code == 202
+
+            # Verify the change was on disk before the process exited
+            mock_exit.assert_called_once_with(0)
+            assert device_id in DeviceService().devices
@@ -1,9 +1,12 @@
 import os
 import json
+import asyncio
 import pytest
 from unittest.mock import patch, MagicMock
 from app.services.device_service import DeviceService
-from app.models.device import Device, DeviceType, DeviceAction
+from app.services.action_queue import DeviceQueueFullError
+from app.models.device import Device, DeviceType, DeviceAction, DeviceCreate, DeviceUpdate
+from app.models.record import DEFAULT_ACTIONS, DeviceRecord
 
 
 @pytest.fixture
@@ -169,4 +172,199 @@ def test_execute_action_mqtt(mock_mqtt, device_service):
     assert result is True
     mock_instance.publish_action.assert_called_once_with(
         mqtt_device.address, "power", {"value": "on"}
-    )
\ No newline at end of file
+    )
+
+
+def _create_devices(device_service, *devices):
+    """Create devices from DeviceCreate models and return their records"""
+
+    async def create():
+        return [await device_service.create_device(device) for device in devices]
+
+    return asyncio.run(create())
+
+
+def test_indexes_and_stats_follow_changes(device_service):
+    """Test that secondary indexes and device counts are updated on every change"""
+    lamp, fan, speaker = _create_devices(
+        device_service,
+        DeviceCreate(name="Lamp", type=DeviceType.VIRTUAL, address="lamp-1"),
+        DeviceCreate(name="Fan", type=DeviceType.VIRTUAL),
+        DeviceCreate(name="Speaker", type=DeviceType.MQTT, address="home/speaker"),
+    )
+    asyncio.run(device_service.execute_action(lamp.id, DeviceAction(action_type="on")))
+    asyncio.run(device_service.update_device(speaker.id, DeviceUpdate(address="home/kitchen")))
+    asyncio.run(device_service.delete_device(fan.id))
+
+    # Verify filtered listings come from the indexes
+    assert [d.id for d in asyncio.run(device_service.get_devices(device_type="virtual"))] == [lamp.id]
+    assert [d.id for d in asyncio.run(device_service.get_devices(status="on"))] == [lamp.id]
+    assert asyncio.run(device_service.get_devices(device_type="mqtt", status="on")) == []
+    assert asyncio.run(device_service.get_device_by_address("home/kitchen")).id == speaker.id
+    assert asyncio.run(device_service.get_device_by_address("home/speaker")) is None
+
+    # Verify the counters
+    stats = device_service.get_stats()
+    assert stats["total"] == 2
+    assert stats["virtual"] == 1
+    assert stats["mqtt"] == 1
+    assert stats["bluetooth"] == 0
+    assert stats["online"] == 1
+    assert stats["offline"] == 1
+    assert stats["by_status"] == {"on": 1, "offline": 1}
+
+
+def test_execute_actions_respects_backend_concurrency(device_service):
+    """Test that fan-out actions run concurrently up to the backend limit"""
+    devices = _create_devices(
+        device_service,
+        *(DeviceCreate(name=f"Lamp {i}", type=DeviceType.VIRTUAL) for i in range(10)),
+    )
+    running = 0
+    peak = 0
+
+    async def slow_action(device, action):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    async def scenario():
+        device_service._action_limits[DeviceType.VIRTUAL] = asyncio.Semaphore(3)
+        return await device_service.execute_actions(
+            [d.id for d in devices], DeviceAction(action_type="on")
+        )
+
+    with patch.object(device_service, '_execute_virtual_action', side_effect=slow_action):
+        results = asyncio.run(scenario())
+
+    # Verify all actions ran, never more than three at a time
+    assert len(results) == 10
+    assert all(r.success for r in results)
+    assert peak == 3
+
+
+def test_actions_are_serialized_per_device(device_service):
+    """Test that actions on one device run in order while other devices run in parallel"""
+    lamp, fan = _create_devices(
+        device_service,
+        DeviceCreate(name="Lamp", type=DeviceType.VIRTUAL),
+        DeviceCreate(name="Fan", type=DeviceType.VIRTUAL),
+    )
+    device_service.action_queues.max_depth = 3
+    running = {}
+    order = []
+    overlapped = []
+
+    async def slow_action(device, action):
+        running[device.id] = running.get(device.id, 0) + 1
+        overlapped.append(len([n for n in running.values() if n]))
+        assert running[device.id] == 1
+        await asyncio.sleep(0.01)
+        order.append((device.id, action.action_type))
+        running[device.id] -= 1
+
+    async def scenario():
+        return await asyncio.gather(
+            *(device_service.execute_action(lamp.id, DeviceAction(action_type=str(i))) for i in range(4)),
+            device_service.execute_action(fan.id, DeviceAction(action_type="on")),
+            return_exceptions=True,
+        )
+
+    with patch.object(device_service, '_execute_virtual_action', side_effect=slow_action):
+        results = asyncio.run(scenario())
+
+    # Verify the fourth action for the lamp was rejected and the rest ran in order
+    assert isinstance(results[3], DeviceQueueFullError)
+    assert [a for d, a in order if d == lamp.id] == ["0", "1", "2"]
+    assert (fan.id, "on") in order
+    assert max(overlapped) == 2
+
+    stats = device_service.action_queues.get_stats(lamp.id)
+    assert stats["depth"] == 0
+    assert stats["executed"] == 3
+    assert stats["rejected"] == 1
+    assert stats["max_wait"] >= stats["avg_wait"] > 0
+
+
+def test_versions_bump_on_change(device_service):
+    """Test that the registry and device versions increase on every change"""
+    before = device_service.get_version()
+    lamp, fan = _create_devices(
+        device_service,
+        DeviceCreate(name="Lamp", type=DeviceType.VIRTUAL),
+        DeviceCreate(name="Fan", type=DeviceType.VIRTUAL),
+    )
+    lamp_version = device_service.get_version(lamp.id)
+    asyncio.run(device_service.update_device(fan.id, DeviceUpdate(name="Ceiling Fan")))
+
+    # Verify only the changed device moved, while the registry moved on every change
+    assert device_service.get_version() == before + 3
+    assert device_service.get_version(lamp.id) == lamp_version
+    assert device_service.get_version(fan.id) > lamp_version
+
+    asyncio.run(device_service.delete_device(lamp.id))
+    assert device_service.get_version(lamp.id) is None
+    assert device_service.get_version() == before + 4
+
+
+def test_get_changes_since_version(device_service):
+    """Test that changes since a version list changed devices and tombstones"""
+    lamp, fan = _create_devices(
+        device_service,
+        DeviceCreate(name="Lamp", type=DeviceType.VIRTUAL),
+        DeviceCreate(name="Fan", type=DeviceType.VIRTUAL),
+    )
+    since = device_service.get_version()
+    asyncio.run(device_service.update_device(lamp.id, DeviceUpdate(name="Desk Lamp")))
+    asyncio.run(device_service.execute_action(lamp.id, DeviceAction(action_type="on")))
+    asyncio.run(device_service.delete_device(fan.id))
+
+    # Verify
+    devices, deleted = device_service.get_changes(since)
+    assert [d.id for d in devices] == [lamp.id]
+    assert deleted == [fan.id]
+    assert device_service.get_changes(device_service.get_version()) == ([], [])
+
+    # Verify versions from before a restart or beyond the log ask for a resync
+    assert device_service.get_changes(device_service.start_version - 1) is None
+    assert device_service.get_changes(device_service.get_version() + 1) is None
+    with patch('app.services.device_service.settings.CHANGE_LOG_SIZE', 2):
+        asyncio.run(device_service.update_device(lamp.id, DeviceUpdate(name="Lamp")))
+    assert device_service.get_changes(since) is None
+
+
+def test_device_json_is_cached_until_changed(device_service):
+    """Test that a device is encoded once per change and shared with persistence"""
+    lamp = _create_devices(device_service, DeviceCreate(name="Lamp", type=DeviceType.VIRTUAL))[0]
+    first = device_service.get_device_json(lamp)
+    second = device_service.get_device_json(lamp)
+    asyncio.run(device_service.update_device(lamp.id, DeviceUpdate(name="Desk Lamp")))
+    third = device_service.get_device_json(lamp)
+
+    # Verify the snapshot write encoded the device, later reads reused it
+    assert first is second
+    assert json.loads(third)["name"] == "Desk Lamp"
+    assert device_service.json_cache.misses == 2
+    with open(device_service.store.path) as f:
+        assert json.load(f) == [json.loads(third)]
+
+    asyncio.run(device_service.delete_device(lamp.id))
+    assert len(device_service.json_cache) == 0
+
+
+def test_records_share_interned_values(device_service):
+    """Test that records share default actions and statuses and convert to API models"""
+    first, second = _create_devices(
+        device_service,
+        *(DeviceCreate(name=f"Lamp {i}", type=DeviceType.VIRTUAL) for i in range(2)),
+    )
+    loaded = DeviceRecord(**{**first.dict(), "status": "".join(["off", "line"]), "actions": ["on", "off"]})
+
+    # Verify
+    assert first.actions is second.actions is loaded.actions is DEFAULT_ACTIONS[DeviceType.VIRTUAL]
+    assert loaded.status is first.status
+    model = first.to_model()
+    assert isinstance(model, Device)
+    assert model.dict() == first.dict()
@@ -0,0 +1,76 @@
+import asyncio
+import json
+import pytest
+from unittest.mock import patch
+
+from app.api.events import format_event
+from app.services.device_service import DeviceService
+from app.services.event_stream import EventBroker
+from app.models.device import DeviceAction, DeviceCreate, DeviceType
+
+
+@pytest.fixture
+def device_service(tmp_path):
+    """Create a device service with a temporary data directory"""
+    with patch('app.services.device_service.DATA_DIR', str(tmp_path)):
+        yield DeviceService(event_broker=EventBroker(buffer_size=4))
+
+
+def test_subscriber_coalesces_events_per_key():
+    """Test that a newer event for the same key replaces the pending one"""
+    broker = EventBroker(buffer_size=4)
+    subscriber = broker.subscribe()
+
+    broker.publish(("device", "lamp"), "device", {"status": "on"})
+    broker.publish("system", "system", {"cpu_usage": 10})
+    broker.publish(("device", "lamp"), "device", {"status": "off"})
+
+    events = asyncio.run(subscriber.get())
+
+    # Verify only the latest lamp state is delivered, after the system sample
+    assert events == [("system", {"cpu_usage": 10}), ("device", {"status": "off"})]
+    assert asyncio.run(subscriber.get(timeout=0.01)) == []
+
+
+def test_subscriber_overflow_asks_for_resync():
+    """Test that a full buffer drops pending events and asks the client to resync"""
+    broker = EventBroker(buffer_size=2)
+    subscriber = broker.subscribe()
+
+    for i in range(3):
+        broker.publish(("device", str(i)), "device", {"id": str(i)})
+
+    events = asyncio.run(subscriber.get())
+
+    # Verify
+    assert events == [("resync", None), ("device", {"id": "2"})]
+    assert subscriber.dropped == 2
+
+    broker.unsubscribe(subscriber)
+    broker.publish(("device", "3"), "device", {"id": "3"})
+    assert subscriber.pending == {}
+
+
+def test_device_changes_are_published(device_service):
+    """Test that device changes reach subscribers with the registry version"""
+    subscriber = device_service.event_broker.subscribe()
+
+    async def scenario():
+        lamp = await device_service.create_device(DeviceCreate(name="Lamp", type=DeviceType.VIRTUAL))
+        await device_service.execute_action(lamp.id, DeviceAction(action_type="on"))
+        return lamp, await subscriber.get()
+
+    lamp, events = asyncio.run(scenario())
+
+    # Verify the create and action coalesced into one device event plus counts
+    assert [event for event, _ in events] == ["device", "stats"]
+    change = events[0][1]
+    assert change["op"] == "action"
+    assert change["version"] == device_service.get_version(lamp.id)
+    assert change["device"].status == "on"
+    assert events[1][1]()["total"] == 1
+
+    # Verify the device is serialized only when the event is formatted
+    message = format_event(*events[0])
+    assert message.startswith("event: device\ndata: ")
+    assert json.loads(message.split("data: ", 1)[1])["device"]["status"] == "on"
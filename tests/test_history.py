@@ -0,0 +1,177 @@
+import asyncio
+import errno
+import pytest
+from unittest.mock import patch
+
+from app.services.device_service import DeviceService
+from app.services.history import DeviceHistory, HistoryBuffer, HistoryEntry, HistorySegments
+from app.models.device import DeviceAction, DeviceCreate, DeviceType, DeviceUpdate
+from app.models.record import DeviceRecord
+
+
+@pytest.fixture
+def device_service(tmp_path):
+    """Create a device service with a small history buffer"""
+    with patch('app.services.device_service.DATA_DIR', str(tmp_path)), \
+            patch('app.services.device_service.settings.HISTORY_BUFFER_SIZE', 3):
+        yield DeviceService()
+
+
+def _entry(timestamp, version, status="on"):
+    """Build a history entry"""
+    return HistoryEntry(timestamp, version, "update", status, {})
+
+
+def test_buffer_wraps_and_bisects():
+    """Test that the ring buffer keeps the newest entries in time order"""
+    buffer = HistoryBuffer(3)
+    for i in range(5):
+        buffer.append(_entry(float(i), i))
+
+    # Verify
+    assert [buffer[i].version for i in range(len(buffer))] == [2, 3, 4]
+    assert buffer[-1].version == 4
+    assert buffer.bisect(3.0) == 2
+    assert buffer.bisect(10.0) == 3
+
+
+def test_service_records_status_changes(device_service):
+    """Test that changes are recorded newest first and unchanged states are skipped"""
+
+    async def scenario():
+        lamp = await device_service.create_device(DeviceCreate(name="Lamp", type=DeviceType.VIRTUAL))
+        await device_service.execute_action(lamp.id, DeviceAction(action_type="on"))
+        # Renaming leaves the status and properties as they were
+        await device_service.update_device(lamp.id, DeviceUpdate(name="Desk lamp"))
+        await device_service.execute_action(lamp.id, DeviceAction(action_type="off"))
+        return lamp, await device_service.get_history(lamp.id, 0.0, float("inf"), 10)
+
+    lamp, entries = asyncio.run(scenario())
+
+    # Verify
+    assert [(entry.op, entry.status) for entry in entries] == [
+        ("action", "off"), ("action", "on"), ("create", "offline")
+    ]
+    assert entries[0].properties == {"state": "off"}
+    assert entries[1].properties == {"state": "on"}
+    assert asyncio.run(device_service.get_history("missing", 0.0, float("inf"), 10)) is None
+
+
+def test_segments_serve_entries_evicted_from_memory(tmp_path):
+    """Test that older entries are read from the segment files through their index"""
+    segments = HistorySegments(str(tmp_path), interval=10, retention=3600)
+    history = DeviceHistory(buffer_size=2, segments=segments)
+    lamp = DeviceRecord("lamp", "Lamp", DeviceType.VIRTUAL)
+    fan = DeviceRecord("fan", "Fan", DeviceType.VIRTUAL)
+
+    async def scenario():
+        for version, now in enumerate([5.0, 8.0, 12.0, 25.0], start=1):
+            with patch('app.services.history.time.time', return_value=now):
+                lamp.status = f"s{version}"
+                history.record("update", lamp, version)
+                fan.status = f"s{version}"
+                history.record("update", fan, version + 100)
+        with patch('app.services.history.time.time', return_value=30.0):
+            await history.flush()
+        segments.close()
+        return (
+            await history.query("lamp", 0.0, float("inf"), 10),
+            await history.query("lamp", 6.0, 20.0, 10),
+            await history.query("lamp", 0.0, float("inf"), 3),
+        )
+
+    everything, window, limited = asyncio.run(scenario())
+
+    # Verify memory and disk entries are merged without duplicates
+    assert [entry.version for entry in everything] == [4, 3, 2, 1]
+    assert [entry.version for entry in window] == [3, 2]
+    assert [entry.version for entry in limited] == [4, 3, 2]
+    assert sorted(segments.segments) == [0, 10, 20]
+
+    # Verify an index reloaded from disk finds the same lines
+    reopened = HistorySegments(str(tmp_path), interval=10, retention=3600)
+    assert [entry.version for entry in reopened.query("fan", 0.0, 30.0, 10, None)] == [104, 103, 102, 101]
+
+
+def test_segments_expire_after_retention(tmp_path):
+    """Test that segments older than the retention period are deleted"""
+    segments = HistorySegments(str(tmp_path), interval=10, retention=15)
+    segments.write([("lamp", _entry(5.0, 1)), ("lamp", _entry(25.0, 2))])
+
+    # Verify
+    assert segments.expire(now=30.0) == 1
+    assert segments.segments == [20]
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["20.log"]
+    assert [entry.version for entry in segments.query("lamp", 0.0, 30.0, 10, None)] == [2]
+
+
+class _FullDisk:
+    """Segment file that runs out of space partway through a write"""
+
+    def __init__(self, file):
+        """Wrap an open segment file"""
+        self.file = file
+
+    def tell(self):
+        """Get the position in the wrapped file"""
+        return self.file.tell()
+
+    def write(self, data):
+        """Write part of the data, then fail"""
+        self.file.write(data[:10])
+        self.file.flush()
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    def close(self):
+        """Close the wrapped file"""
+        self.file.close()
+
+
+def test_failed_write_keeps_entries_pending(tmp_path):
+    """Test that entries not written are kept, and a partial write is cut off the segment"""
+    segments = HistorySegments(str(tmp_path), interval=10, retention=3600)
+    history = DeviceHistory(buffer_size=10, segments=segments)
+    lamp = DeviceRecord("lamp", "Lamp", DeviceType.VIRTUAL)
+    open_segment = segments._open_segment
+
+    def open_full_segment(start):
+        open_segment(start)
+        if start == 10:
+            segments._file = _FullDisk(segments._file)
+
+    async def scenario():
+        for version, now in enumerate([5.0, 12.0, 15.0], start=1):
+            with patch('app.services.history.time.time', return_value=now):
+                lamp.status = f"s{version}"
+                history.record("update", lamp, version)
+        with patch('app.services.history.time.time', return_value=30.0):
+            with patch.object(segments, '_open_segment', open_full_segment):
+                await history.flush()
+            failed = [entry.version for _, entry in history._pending]
+            await history.flush()
+        segments.close()
+        return failed
+
+    # Verify the first segment was written and the second kept for the next flush
+    assert asyncio.run(scenario()) == [2, 3]
+    assert history.stats["errors"] == 1
+    assert history._pending == []
+    reopened = HistorySegments(str(tmp_path), interval=10, retention=3600)
+    assert [entry.version for entry in reopened.query("lamp", 0.0, 30.0, 10, None)] == [3, 2, 1]
+
+
+def test_pending_entries_are_capped(tmp_path):
+    """Test that the oldest unwritten entries are dropped while writes keep failing"""
+    segments = HistorySegments(str(tmp_path), interval=10, retention=3600)
+    history = DeviceHistory(buffer_size=10, segments=segments, max_pending=2)
+    lamp = DeviceRecord("lamp", "Lamp", DeviceType.VIRTUAL)
+
+    for version in range(1, 5):
+        lamp.status = f"s{version}"
+        history.record("update", lamp, version)
+    with patch.object(segments, 'write', side_effect=OSError(errno.EIO, "I/O error")):
+        asyncio.run(history.flush())
+
+    # Verify
+    assert [entry.version for _, entry in history._pending] == [3, 4]
+    assert history.stats["dropped"] == 2
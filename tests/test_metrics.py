@@ -0,0 +1,53 @@
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.api.metrics import MetricsMiddleware
+from app.services.metrics import Counter, Histogram, HTTP_REQUEST_DURATION, MetricsRegistry
+
+
+def test_histogram_renders_cumulative_buckets():
+    """Test that a histogram renders cumulative buckets, sum and count"""
+    registry = MetricsRegistry()
+    histogram = registry.register(Histogram("latency_seconds", "Latency", ("route",), buckets=(0.1, 1.0)))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.labels("/a").observe(value)
+
+    # Verify a value on a bound counts in that bucket
+    assert registry.render().splitlines() == [
+        "# HELP latency_seconds Latency",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{route="/a",le="0.1"} 2',
+        'latency_seconds_bucket{route="/a",le="1"} 3',
+        'latency_seconds_bucket{route="/a",le="+Inf"} 4',
+        'latency_seconds_sum{route="/a"} 3.65',
+        'latency_seconds_count{route="/a"} 4',
+    ]
+
+
+def test_counter_escapes_label_values():
+    """Test that label values are escaped"""
+    counter = Counter("messages_total", "Messages", ("topic",))
+    counter.labels('a"b\\c').inc(2)
+
+    # Verify
+    assert counter.render()[2] == 'messages_total{topic="a\\"b\\\\c"} 2'
+
+
+def test_middleware_records_route_templates():
+    """Test that requests are recorded by route template and unmatched paths are skipped"""
+    app = FastAPI()
+    app.add_middleware(MetricsMiddleware)
+
+    @app.get("/things/{thing_id}")
+    async def get_thing(thing_id: str):
+        return {"id": thing_id}
+
+    client = TestClient(app)
+    client.get("/things/1")
+    client.get("/things/2")
+    client.get("/missing")
+
+    # Verify
+    series = HTTP_REQUEST_DURATION.series
+    assert sum(series[("GET", "/things/{thing_id}", "200")].counts) == 2
+    assert not any(route == "/missing" for _, route, _ in series)
@@ -0,0 +1,234 @@
+import asyncio
+import json
+import queue
+import threading
+import pytest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from app.core.mqtt import MQTTClient
+from app.core.mqtt_commands import MQTTCommandError, MQTTCommandTimeoutError
+from app.core.mqtt_ingest import MQTTIngestQueue
+from app.core.topic_router import TopicRouter
+from app.models.device import DeviceAction, DeviceCreate, DeviceType
+from app.services.device_service import DeviceService
+
+
+class LocalBroker:
+    """In-process stand-in for an MQTT broker
+
+    Messages are delivered to subscribers from the broker's own thread, the
+    way paho calls on_message from its network thread.
+    """
+
+    def __init__(self):
+        """Initialize the broker"""
+        self.router = TopicRouter()
+        self.messages = queue.Queue()
+        self.thread = threading.Thread(target=self._deliver, daemon=True)
+        self.thread.start()
+
+    def subscribe(self, pattern, on_message):
+        """Deliver messages matching a pattern to on_message(message)"""
+        self.router.add(pattern, on_message)
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        """Queue a message for delivery, returning a paho-like result"""
+        self.messages.put((topic, payload))
+        return SimpleNamespace(rc=0)
+
+    def close(self):
+        """Stop delivering messages"""
+        self.messages.put(None)
+        self.thread.join()
+
+    def _deliver(self):
+        """Deliver queued messages until closed"""
+        while True:
+            item = self.messages.get()
+            if item is None:
+                return
+            topic, payload = item
+            for on_message in self.router.match(topic):
+                on_message(SimpleNamespace(topic=topic, payload=payload))
+
+
+class SimulatedDevice:
+    """An MQTT device acknowledging commands once it holds `batch` of them"""
+
+    def __init__(self, broker, device_id, reply="ack", batch=1):
+        """Subscribe to the device's command topics"""
+        self.broker = broker
+        self.reply = reply
+        self.batch = batch
+        self.unacknowledged = []
+        self.max_unacknowledged = 0
+        broker.subscribe(f"smarthomelite/{device_id}/+", self.on_command)
+
+    def on_command(self, message):
+        """Handle a command, runs on the broker thread"""
+        if message.topic.endswith("/ack"):
+            return
+        command = json.loads(message.payload)
+        self.unacknowledged.append(command)
+        self.max_unacknowledged = max(self.max_unacknowledged, len(self.unacknowledged))
+        if self.reply == "silent" or len(self.unacknowledged) < self.batch:
+            return
+        for command in self.unacknowledged:
+            acknowledgement = {"correlation_id": command["correlation_id"], "status": command["value"]}
+            if self.reply == "reject":
+                acknowledgement.update(success=False, error="Out of range", status="error")
+            self.broker.publish(command["reply_to"], json.dumps(acknowledgement).encode())
+        self.unacknowledged = []
+
+
+@pytest.fixture
+def broker():
+    """Start an in-process broker"""
+    broker = LocalBroker()
+    yield broker
+    broker.close()
+
+
+@pytest.fixture
+def hub(broker, tmp_path):
+    """Create a device service whose MQTT client is connected to the local broker"""
+    client = MQTTClient()
+    client.client = broker
+    client.connected = True
+    client.commands.timeout = 1.0
+    broker.subscribe("smarthomelite/+/ack", lambda message: client._on_message(None, None, message))
+    with patch('app.services.device_service.DATA_DIR', str(tmp_path)), \
+            patch('app.core.mqtt.mqtt', SimpleNamespace(MQTT_ERR_SUCCESS=0), create=True):
+        yield DeviceService(mqtt_client=client)
+
+
+def _run(hub, scenario):
+    """Run a scenario with the MQTT client receiving messages, returning its result"""
+
+    async def run():
+        hub.mqtt_client.ingest.start(hub.mqtt_client._handle_message)
+        try:
+            device = await hub.create_device(DeviceCreate(name="Plug", type=DeviceType.MQTT))
+            return device, await scenario(device)
+        finally:
+            await hub.mqtt_client.ingest.stop()
+
+    return asyncio.run(run())
+
+
+def test_action_is_acknowledged_and_updates_status(hub, broker):
+    """Test that an MQTT action waits for the device's acknowledgement and takes its status"""
+
+    async def scenario(device):
+        SimulatedDevice(broker, device.id)
+        return await hub.execute_action(device.id, DeviceAction(action_type="power", value="on"))
+
+    device, result = _run(hub, scenario)
+
+    # Verify
+    assert result.status == "on"
+    assert hub.mqtt_client.commands.get_stats()["acknowledged"] == 1
+    assert hub.mqtt_client.commands.get_stats()["in_flight"] == 0
+
+
+def test_actions_are_pipelined_up_to_the_window(hub, broker):
+    """Test that several actions are in flight at once, but never more than the window"""
+    hub.mqtt_client.commands.window = 3
+    devices = []
+
+    async def scenario(device):
+        # The device only answers once it holds three commands
+        devices.append(SimulatedDevice(broker, device.id, batch=3))
+        return await hub.execute_actions(
+            [device.id] * 6, DeviceAction(action_type="level", value="50")
+        )
+
+    _, results = _run(hub, scenario)
+
+    # Verify
+    assert all(result.success for result in results)
+    assert devices[0].max_unacknowledged == 3
+    assert hub.mqtt_client.commands.get_stats()["acknowledged"] == 6
+
+
+def test_pipelined_acknowledgements_are_not_coalesced(hub, broker):
+    """Test that acknowledgements sharing a topic all arrive when the ingest queue coalesces"""
+    hub.mqtt_client.commands.window = 5
+    hub.mqtt_client.ingest = MQTTIngestQueue(100, "coalesce")
+
+    async def scenario(device):
+        # The device answers all five commands at once, on its one ack topic
+        SimulatedDevice(broker, device.id, batch=5)
+        return await hub.execute_actions(
+            [device.id] * 5, DeviceAction(action_type="level", value="50")
+        )
+
+    _, results = _run(hub, scenario)
+
+    # Verify
+    assert all(result.success for result in results)
+    assert hub.mqtt_client.commands.get_stats()["acknowledged"] == 5
+    assert hub.mqtt_client.ingest.stats["coalesced"] == 0
+
+
+def test_unacknowledged_action_times_out(hub, broker):
+    """Test that an action fails if the device never acknowledges it"""
+    hub.mqtt_client.commands.timeout = 0.05
+
+    async def scenario(device):
+        SimulatedDevice(broker, device.id, reply="silent")
+        with pytest.raises(MQTTCommandTimeoutError):
+            await hub.execute_action(device.id, DeviceAction(action_type="power", value="on"))
+
+    device, _ = _run(hub, scenario)
+
+    # Verify
+    stats = hub.mqtt_client.commands.get_stats()
+    assert stats["timeouts"] == 1
+    assert stats["in_flight"] == 0
+    assert device.status == "offline"
+
+
+def test_rejected_action_fails_with_reported_status(hub, broker):
+    """Test that a rejected action fails, and the device's reported status is kept"""
+
+    async def scenario(device):
+        SimulatedDevice(broker, device.id, reply="reject")
+        version = hub.get_version(device.id)
+        with pytest.raises(MQTTCommandError, match="Out of range"):
+            await hub.execute_action(device.id, DeviceAction(action_type="level", value="500"))
+        return version
+
+    device, version = _run(hub, scenario)
+
+    # Verify
+    assert device.status == "error"
+    assert hub.get_version(device.id) > version
+    assert hub.mqtt_client.commands.get_stats()["rejected"] == 1
+
+
+def test_unknown_acknowledgements_are_ignored(hub):
+    """Test that acknowledgements for commands not in flight are only counted"""
+    commands = hub.mqtt_client.commands
+
+    asyncio.run(commands.handle_ack("plug", {"correlation_id": "late"}))
+    asyncio.run(commands.handle_ack("plug", "not json"))
+
+    # Verify
+    assert commands.get_stats()["unmatched"] == 2
+
+
+def test_action_fails_when_disconnected(hub):
+    """Test that an action on an MQTT device fails if the client is not connected"""
+    hub.mqtt_client.connected = False
+
+    async def scenario(device):
+        with pytest.raises(MQTTCommandError):
+            await hub.execute_action(device.id, DeviceAction(action_type="power", value="on"))
+
+    _run(hub, scenario)
+
+    # Verify
+    assert hub.mqtt_client.commands.get_stats()["in_flight"] == 0
+    assert hub.mqtt_client.commands._windows == {}
@@ -0,0 +1,156 @@
+import asyncio
+import threading
+import pytest
+from types import SimpleNamespace
+
+from app.core.mqtt import MQTTClient
+from app.core.mqtt_ingest import MQTTIngestQueue
+
+
+async def _collect(queue, put_messages, expected):
+    """Start the queue, put messages from another thread and collect what is dispatched"""
+    handled = []
+    done = asyncio.Event()
+
+    async def dispatch(topic, payload):
+        handled.append((topic, payload))
+        if len(handled) >= expected:
+            done.set()
+
+    queue.start(dispatch)
+    thread = threading.Thread(target=put_messages)
+    thread.start()
+    await asyncio.get_running_loop().run_in_executor(None, thread.join)
+    await asyncio.wait_for(done.wait(), 1.0)
+    await queue.stop()
+    return handled
+
+
+def test_messages_from_another_thread_are_dispatched_in_order():
+    """Test that messages put on a network thread reach the consumer in order, in batches"""
+    queue = MQTTIngestQueue(maxsize=100, batch_size=10)
+
+    def put_messages():
+        for i in range(25):
+            queue.put("hub/lamp/state", str(i).encode())
+
+    handled = asyncio.run(_collect(queue, put_messages, 25))
+
+    # Verify
+    assert [payload for _, payload in handled] == [str(i).encode() for i in range(25)]
+    assert queue.stats["dispatched"] == 25
+    assert queue.stats["dropped"] == 0
+
+
+def test_drop_oldest_when_full():
+    """Test that a full queue drops its oldest messages"""
+    queue = MQTTIngestQueue(maxsize=3, policy="drop_oldest")
+
+    async def scenario():
+        # Hold the consumer back until everything is queued
+        queue.start(lambda topic, payload: asyncio.sleep(0))
+        queue.task.cancel()
+        for i in range(5):
+            queue.put("hub/lamp/state", str(i).encode())
+        pending = [payload for _, payload, _ in queue._messages.values()]
+        await queue.stop()
+        return pending
+
+    # Verify
+    assert asyncio.run(scenario()) == [b"2", b"3", b"4"]
+    assert queue.stats["dropped"] == 2
+    assert queue.stats["max_depth"] == 3
+
+
+def test_coalesce_keeps_latest_payload_per_topic():
+    """Test that coalescing replaces the pending message on the same topic"""
+    queue = MQTTIngestQueue(maxsize=10, policy="coalesce")
+
+    def put_messages():
+        queue.put("hub/lamp/state", b"1")
+        queue.put("hub/fan/state", b"1")
+        queue.put("hub/lamp/state", b"2")
+
+    async def scenario():
+        # Hold the consumer back until everything is queued
+        queue.start(lambda topic, payload: asyncio.sleep(0))
+        queue.task.cancel()
+        put_messages()
+        pending = [(topic, payload) for topic, payload, _ in queue._messages.values()]
+        await queue.stop()
+        return pending
+
+    # Verify the lamp keeps its place in line with the newer payload
+    assert asyncio.run(scenario()) == [("hub/lamp/state", b"2"), ("hub/fan/state", b"1")]
+    assert queue.stats["coalesced"] == 1
+
+
+def test_uncoalesced_messages_keep_their_place():
+    """Test that messages put with coalesce=False are never replaced"""
+    queue = MQTTIngestQueue(maxsize=10, policy="coalesce")
+
+    async def scenario():
+        queue.start(lambda topic, payload: asyncio.sleep(0))
+        queue.task.cancel()
+        queue.put("hub/lamp/ack", b"1", coalesce=False)
+        queue.put("hub/lamp/ack", b"2", coalesce=False)
+        queue.put("hub/lamp/state", b"on")
+        queue.put("hub/lamp/state", b"off")
+        pending = [payload for _, payload, _ in queue._messages.values()]
+        await queue.stop()
+        return pending
+
+    # Verify
+    assert asyncio.run(scenario()) == [b"1", b"2", b"off"]
+    assert queue.stats["coalesced"] == 1
+
+
+def test_block_waits_for_room():
+    """Test that the blocking policy holds the network thread until the consumer catches up"""
+    queue = MQTTIngestQueue(maxsize=2, policy="block", batch_size=1)
+
+    def put_messages():
+        for i in range(10):
+            assert queue.put("hub/lamp/state", str(i).encode())
+
+    handled = asyncio.run(_collect(queue, put_messages, 10))
+
+    # Verify nothing was dropped and the queue never grew past its size
+    assert len(handled) == 10
+    assert queue.stats["dropped"] == 0
+    assert queue.stats["max_depth"] <= 2
+
+
+def test_unknown_policy_is_rejected():
+    """Test that a misspelled overflow policy fails early"""
+    with pytest.raises(ValueError):
+        MQTTIngestQueue(maxsize=10, policy="drop_newest")
+
+
+def test_client_dispatches_to_callbacks():
+    """Test that paho's message callback reaches the registered callback on the event loop"""
+    client = MQTTClient()
+    received = []
+
+    async def on_state(device_id, payload):
+        received.append((device_id, payload, asyncio.get_running_loop()))
+
+    client.register_callback("state", on_state)
+
+    async def scenario():
+        client.ingest.start(client._handle_message)
+        message = SimpleNamespace(topic="smarthomelite/lamp/state", payload=b'{"status": "on"}')
+        thread = threading.Thread(target=client._on_message, args=(None, None, message))
+        thread.start()
+        thread.join()
+        for _ in range(100):
+            if received:
+                break
+            await asyncio.sleep(0.01)
+        await client.ingest.stop()
+        return asyncio.get_running_loop()
+
+    loop = asyncio.run(scenario())
+
+    # Verify
+    assert received == [("lamp", {"status": "on"}, loop)]
@@ -0,0 +1,200 @@
+import asyncio
+import json
+import pytest
+from unittest.mock import patch
+
+from app.core.mqtt import MQTTClient
+from app.core.mqtt_publisher import MQTTStatePublisher
+from app.models.device import DeviceCreate, DeviceType, DeviceUpdate
+from app.models.record import DeviceRecord
+from app.services.device_service import DeviceService
+
+
+def _make_publisher(sent, **options):
+    """Create a running publisher recording what it sends, without its task"""
+    publisher = MQTTStatePublisher(
+        lambda topic, payload, retain: sent.append((topic, payload, retain)) or True,
+        lambda device: json.dumps({"id": device.id, "status": device.status}).encode(),
+        "hub",
+        window=0.01,
+        **options,
+    )
+    publisher.running = True
+    return publisher
+
+
+@pytest.fixture
+def lamp():
+    """Create a device record"""
+    return DeviceRecord("lamp", "Lamp", DeviceType.VIRTUAL, status="off", properties={"level": 1})
+
+
+def test_changes_to_a_device_are_coalesced(lamp):
+    """Test that many changes within a window are published once, with the latest state"""
+    sent = []
+    publisher = _make_publisher(sent)
+    publisher.running = False
+
+    async def scenario():
+        publisher.start()
+        for i in range(20):
+            lamp.status = "on" if i % 2 else "off"
+            publisher.submit(lamp.id, lamp)
+        await asyncio.sleep(0.05)
+        await publisher.stop()
+
+    asyncio.run(scenario())
+
+    # Verify
+    assert sent == [("hub/lamp/state", b'{"id": "lamp", "status": "on"}', True)]
+    assert publisher.stats["coalesced"] == 19
+    assert publisher.stats["published"] == 1
+
+
+def test_device_rate_limit_defers_changes(lamp):
+    """Test that a device is not published more often than its rate limit allows"""
+    sent = []
+    publisher = _make_publisher(sent, device_rate_limit=2)
+
+    publisher.submit(lamp.id, lamp)
+    publisher._publish_pending(100.0)
+    publisher.submit(lamp.id, lamp)
+    publisher._publish_pending(100.2)
+
+    # Verify
+    assert len(sent) == 1
+    assert publisher.get_stats()["pending"] == 1
+    assert publisher.stats["deferred"] == 1
+    publisher._publish_pending(100.5)
+    assert len(sent) == 2
+
+
+def test_global_rate_limit_defers_changes():
+    """Test that the hub publishes no more than its rate limit, oldest changes first"""
+    sent = []
+    publisher = _make_publisher(sent, rate_limit=3)
+    publisher._refilled_at = 100.0
+    for i in range(5):
+        publisher.submit(str(i), DeviceRecord(str(i), "Lamp", DeviceType.VIRTUAL))
+
+    publisher._publish_pending(100.0)
+
+    # Verify
+    assert [topic for topic, _, _ in sent] == ["hub/0/state", "hub/1/state", "hub/2/state"]
+    assert publisher.stats["deferred"] == 2
+    publisher._publish_pending(101.0)
+    assert len(sent) == 5
+
+
+def test_delta_mode_publishes_changed_fields(lamp):
+    """Test that after the retained state only changed fields and properties are published"""
+    sent = []
+    publisher = _make_publisher(sent, mode="delta")
+
+    publisher.submit(lamp.id, lamp)
+    publisher._publish_pending(100.0)
+    lamp.status = "on"
+    lamp.properties = {"color": "red"}
+    publisher.submit(lamp.id, lamp)
+    publisher._publish_pending(101.0)
+    publisher.submit(lamp.id, lamp)
+    publisher._publish_pending(102.0)
+
+    # Verify
+    assert [(topic, retain) for topic, _, retain in sent] == [
+        ("hub/lamp/state", True),
+        ("hub/lamp/delta", False),
+    ]
+    assert json.loads(sent[1][1]) == {
+        "status": "on",
+        "properties": {"color": "red"},
+        "removed_properties": ["level"],
+    }
+    assert publisher.stats["unchanged"] == 1
+
+
+def test_delta_mode_retries_full_state_after_failed_publish(lamp):
+    """Test that deltas are not sent until the retained state was published"""
+    sent = []
+    results = iter([False, True])
+    publisher = MQTTStatePublisher(
+        lambda topic, payload, retain: sent.append(topic) or next(results),
+        lambda device: b"{}",
+        "hub",
+        window=0.01,
+        mode="delta",
+    )
+    publisher.running = True
+
+    publisher.submit(lamp.id, lamp)
+    publisher._publish_pending(100.0)
+    lamp.status = "on"
+    publisher.submit(lamp.id, lamp)
+    publisher._publish_pending(101.0)
+
+    # Verify
+    assert sent == ["hub/lamp/state", "hub/lamp/state"]
+    assert publisher.stats["errors"] == 1
+
+
+def test_deleted_device_clears_retained_state(lamp):
+    """Test that deleting a device publishes an empty retained state"""
+    sent = []
+    publisher = _make_publisher(sent)
+
+    publisher.submit(lamp.id, lamp)
+    publisher.submit(lamp.id, None)
+    publisher._publish_pending(100.0)
+
+    # Verify
+    assert sent == [("hub/lamp/state", b"", True)]
+
+
+def test_failed_publishes_stay_pending(lamp):
+    """Test that states and deletions that could not be sent are tried again"""
+    sent = []
+    results = iter([False, True, True])
+
+    def send(topic, payload, retain):
+        if topic == "hub/fan/state":
+            raise ConnectionError("Broker unreachable")
+        sent.append((topic, payload))
+        return next(results)
+
+    publisher = MQTTStatePublisher(send, lambda device: b"{}", "hub", window=0.01)
+    publisher.running = True
+
+    publisher.submit(lamp.id, None)
+    publisher.submit("fan", DeviceRecord("fan", "Fan", DeviceType.VIRTUAL))
+    publisher._publish_pending(100.0)
+
+    # Verify both are still pending, in their order
+    assert list(publisher._pending) == [lamp.id, "fan"]
+    assert publisher.stats["errors"] == 2
+
+    # A newer change replaces the failed one
+    publisher.submit(lamp.id, lamp)
+    publisher._publish_pending(101.0)
+    assert sent == [("hub/lamp/state", b""), ("hub/lamp/state", b"{}")]
+    assert list(publisher._pending) == ["fan"]
+
+
+def test_device_changes_are_queued_for_publishing(tmp_path):
+    """Test that the device service hands every change to the MQTT publisher"""
+    client = MQTTClient()
+    client.publisher.running = True
+    with patch('app.services.device_service.DATA_DIR', str(tmp_path)):
+        service = DeviceService(mqtt_client=client)
+
+    async def scenario():
+        device = await service.create_device(DeviceCreate(name="Lamp", type=DeviceType.VIRTUAL))
+        await service.update_device(device.id, DeviceUpdate(status="on"))
+        await service.delete_device(device.id)
+        return device.id
+
+    device_id = asyncio.run(scenario())
+
+    # Verify
+    assert client.publisher.stats["submitted"] == 3
+    assert client.publisher.stats["coalesced"] == 2
+    assert client.publisher._pending == {device_id: None}
@@ -0,0 +1,178 @@
+import asyncio
+import pytest
+from unittest.mock import patch
+
+from app.core.mqtt import MQTTClient
+from app.models.device import DeviceCreate, DeviceType
+from app.services.device_service import DeviceService
+
+
+@pytest.fixture
+def device_service(tmp_path):
+    """Create a device service with an MQTT client and a temporary data directory"""
+    with patch('app.services.device_service.DATA_DIR', str(tmp_path)):
+        yield DeviceService(mqtt_client=MQTTClient())
+
+
+def _create_devices(device_service, count):
+    """Create MQTT devices and return their IDs"""
+
+    async def create():
+        return [
+            (await device_service.create_device(
+                DeviceCreate(name=f"Sensor {i}", type=DeviceType.MQTT, properties={"power": 1.0})
+            )).id
+            for i in range(count)
+        ]
+
+    return asyncio.run(create())
+
+
+def _receive(device_service, messages):
+    """Pass (topic, payload) messages through the MQTT client's dispatch"""
+
+    async def receive():
+        for topic, payload in messages:
+            await device_service.mqtt_client._handle_message(topic, payload)
+
+    asyncio.run(receive())
+
+
+def test_reports_for_a_device_are_merged(device_service):
+    """Test that several reports for a device are applied as one change"""
+    device_id = _create_devices(device_service, 1)[0]
+    version = device_service.get_version(device_id)
+
+    _receive(device_service, [
+        (f"smarthomelite/{device_id}/state", b'{"status": "on", "temperature": 20.5}'),
+        (f"smarthomelite/{device_id}/state", b'{"properties": {"humidity": 40}}'),
+        (f"smarthomelite/{device_id}/state", b'{"temperature": 21.0}'),
+    ])
+    device_service._apply_state_reports()
+
+    # Verify
+    device = device_service.devices[device_id]
+    assert device.status == "on"
+    assert device.properties == {"power": 1.0, "temperature": 21.0, "humidity": 40}
+    assert device_service.get_version(device_id) == version + 1
+    stats = device_service.get_mqtt_state_stats()
+    assert (stats["received"], stats["coalesced"], stats["applied"]) == (3, 2, 1)
+
+
+def test_reports_that_change_nothing_are_skipped(device_service):
+    """Test that a report matching the current state is not persisted"""
+    device_id = _create_devices(device_service, 1)[0]
+    version = device_service.version
+
+    _receive(device_service, [
+        (f"smarthomelite/{device_id}/state", b"offline"),
+        (f"smarthomelite/{device_id}/state", b'{"status": "offline", "properties": {"power": 1.0}}'),
+    ])
+    device_service._apply_state_reports()
+
+    # Verify
+    assert device_service.version == version
+    assert device_service.get_mqtt_state_stats()["unchanged"] == 1
+
+
+def test_own_state_and_unknown_devices_are_ignored(device_service):
+    """Test that the hub's own published state and reports for unknown devices are dropped"""
+    device_id = _create_devices(device_service, 1)[0]
+    own_state = device_service.mqtt_client._encode_state(device_service.devices[device_id])
+
+    _receive(device_service, [
+        (f"smarthomelite/{device_id}/state", own_state),
+        ("smarthomelite/missing/state", b'{"status": "on"}'),
+    ])
+
+    # Verify
+    stats = device_service.get_mqtt_state_stats()
+    assert (stats["echoes"], stats["unknown"], stats["pending"]) == (1, 1, 0)
+
+
+def test_reports_for_many_devices_are_written_once(device_service):
+    """Test that reports applied together are persisted with a single write"""
+    device_ids = _create_devices(device_service, 50)
+    writes = device_service.persistence_stats["writes"]
+
+    _receive(device_service, [
+        (f"smarthomelite/{device_id}/state", b'{"status": "on", "power": 3.5}')
+        for device_id in device_ids
+    ])
+    device_service._apply_state_reports()
+
+    # Verify
+    assert device_service.persistence_stats["writes"] == writes + 1
+    assert all(device.status == "on" for device in device_service.devices.values())
+    assert device_service.telemetry.query(device_ids[0], "power", "raw", 0, 2**32, 10)
+
+
+def test_reports_are_applied_in_the_background(device_service):
+    """Test that the service applies buffered reports after the ingest window"""
+    device_id = _create_devices(device_service, 1)[0]
+
+    async def scenario():
+        await device_service.start()
+        await device_service.mqtt_client._handle_message(
+            f"smarthomelite/{device_id}/state", b'{"status": "off"}'
+        )
+        await asyncio.sleep(0.05)
+        await device_service.stop()
+
+    with patch('app.services.device_service.settings.MQTT_STATE_INGEST_WINDOW', 0.01):
+        asyncio.run(scenario())
+
+    # Verify
+    assert device_service.devices[device_id].status == "off"
+    assert device_service.get_mqtt_state_stats()["batches"] == 1
+
+
+def test_reports_with_device_fields_are_applied(device_service):
+    """Test that a device's own report is not taken for the hub's state because of its fields"""
+    device_id = _create_devices(device_service, 1)[0]
+
+    _receive(device_service, [
+        (f"smarthomelite/{device_id}/state", f'{{"id": "{device_id}", "type": "plug", "status": "on"}}'.encode()),
+    ])
+    device_service._apply_state_reports()
+
+    # Verify
+    assert device_service.devices[device_id].status == "on"
+    assert device_service.get_mqtt_state_stats()["echoes"] == 0
+
+
+def test_reports_while_loading_are_capped(tmp_path):
+    """Test that reports for devices not loaded yet are kept for a limited number of devices"""
+    with patch('app.services.device_service.DATA_DIR', str(tmp_path)), \
+            patch('app.services.device_service.settings.MQTT_STATE_MAX_PENDING', 2):
+        device_service = DeviceService(mqtt_client=MQTTClient(), background_load=True)
+        _receive(device_service, [
+            (f"smarthomelite/sensor-{i}/state", b'{"status": "on"}')
+            for i in [1, 2, 3, 1]
+        ])
+
+    # Verify
+    stats = device_service.get_mqtt_state_stats()
+    assert (stats["received"], stats["dropped"], stats["pending"]) == (3, 1, 2)
+
+
+def test_reports_while_loading_are_applied_once_loaded(device_service, tmp_path):
+    """Test that reports received before the devices are loaded are applied after loading"""
+    device_id = _create_devices(device_service, 1)[0]
+
+    async def scenario(loading_service):
+        await loading_service.mqtt_client._handle_message(
+            f"smarthomelite/{device_id}/state", b'{"status": "on"}'
+        )
+        await loading_service.start()
+        await asyncio.sleep(0.05)
+        await loading_service.stop()
+
+    with patch('app.services.device_service.DATA_DIR', str(tmp_path)), \
+            patch('app.services.device_service.settings.MQTT_STATE_INGEST_WINDOW', 0.01):
+        loading_service = DeviceService(mqtt_client=MQTTClient(), background_load=True)
+        asyncio.run(scenario(loading_service))
+
+    # Verify
+    assert loading_service.devices[device_id].status == "on"
+    assert loading_service.get_mqtt_state_stats()["applied"] == 1
@@ -0,0 +1,363 @@
+import asyncio
+import json
+import os
+import pytest
+from unittest.mock import patch
+
+from app.services.device_service import DeviceService
+from app.models.device import Device, DeviceAction, DeviceCreate, DeviceType, DeviceUpdate
+
+
+@pytest.fixture
+def mock_data_dir(tmp_path):
+    """Create a temporary directory for test data"""
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    return str(data_dir)
+
+
+@pytest.fixture
+def write_behind_service(mock_data_dir):
+    """Create a device service with write-behind persistence enabled"""
+    with patch('app.services.device_service.DATA_DIR', mock_data_dir), \
+            patch('app.services.device_service.settings.PERSISTENCE_MODE', "write_behind"), \
+            patch('app.services.device_service.settings.PERSISTENCE_FLUSH_INTERVAL', 0.05), \
+            patch('app.services.device_service.settings.PERSISTENCE_FLUSH_THRESHOLD', 1000):
+        yield DeviceService()
+
+
+def _read_devices_file(service):
+    """Read the persisted device list"""
+    with open(service.store.path) as f:
+        return json.load(f)
+
+
+def test_sync_mode_writes_every_change(mock_data_dir):
+    """Test that sync mode writes the devices file on every change"""
+    with patch('app.services.device_service.DATA_DIR', mock_data_dir):
+        service = DeviceService()
+
+        async def scenario():
+            await service.create_device(DeviceCreate(name="Lamp", type=DeviceType.VIRTUAL))
+            await service.create_device(DeviceCreate(name="Fan", type=DeviceType.VIRTUAL))
+
+        asyncio.run(scenario())
+
+    # Verify each change was written straight away
+    assert service.persistence_stats["writes"] == 2
+    assert len(_read_devices_file(service)) == 2
+    assert not os.path.exists(f"{service.store.path}.tmp")
+
+
+def test_write_behind_coalesces_changes(write_behind_service):
+    """Test that write-behind mode coalesces changes into one flush"""
+    service = write_behind_service
+
+    async def scenario():
+        await service.start()
+        for i in range(10):
+            await service.create_device(DeviceCreate(name=f"Lamp {i}", type=DeviceType.VIRTUAL))
+
+        # Nothing is written until the debounce window elapses
+        assert service.persistence_stats["writes"] == 0
+        assert service.get_persistence_stats()["pending_changes"] == 10
+
+        await asyncio.sleep(0.2)
+        await service.stop()
+
+    asyncio.run(scenario())
+
+    # Verify all changes landed in a single write
+    stats = service.get_persistence_stats()
+    assert stats["writes"] == 1
+    assert stats["changes_written"] == 10
+    assert stats["pending_changes"] == 0
+    assert len(_read_devices_file(service)) == 10
+
+
+def test_write_behind_flushes_on_threshold(write_behind_service):
+    """Test that reaching the change threshold flushes before the window elapses"""
+    service = write_behind_service
+
+    async def scenario():
+        with patch('app.services.device_service.settings.PERSISTENCE_FLUSH_INTERVAL', 60), \
+                patch('app.services.device_service.settings.PERSISTENCE_FLUSH_THRESHOLD', 3):
+            await service.start()
+            for i in range(3):
+                await service.create_device(DeviceCreate(name=f"Lamp {i}", type=DeviceType.VIRTUAL))
+            await asyncio.sleep(0.1)
+            assert service.persistence_stats["writes"] == 1
+            await service.stop()
+
+    asyncio.run(scenario())
+
+
+def test_write_behind_final_flush_on_stop(write_behind_service):
+    """Test that stopping the service writes pending changes"""
+    service = write_behind_service
+
+    async def scenario():
+        with patch('app.services.device_service.settings.PERSISTENCE_FLUSH_INTERVAL', 60):
+            await service.start()
+            device = await service.create_device(DeviceCreate(name="Lamp", type=DeviceType.VIRTUAL))
+            assert service.get_persistence_stats()["flush_lag"] >= 0
+            await service.stop()
+            return device
+
+    device = asyncio.run(scenario())
+
+    # Verify the pending change was written on shutdown
+    assert service.persistence_stats["writes"] == 1
+    assert _read_devices_file(service)[0]["id"] == device.id
+
+
+@pytest.fixture
+def journal_service_factory(mock_data_dir):
+    """Create device services with journal persistence enabled"""
+    with patch('app.services.device_service.DATA_DIR', mock_data_dir), \
+            patch('app.services.device_service.settings.PERSISTENCE_MODE', "journal"), \
+            patch('app.services.device_service.settings.JOURNAL_COMPACT_INTERVAL', 60), \
+            patch('app.services.device_service.settings.JOURNAL_COMPACT_SIZE', 1048576):
+        yield DeviceService
+
+
+def test_journal_appends_one_record_per_change(journal_service_factory):
+    """Test that each change appends one record instead of rewriting the snapshot"""
+    service = journal_service_factory()
+
+    async def scenario():
+        device = await service.create_device(DeviceCreate(name="Lamp", type=DeviceType.VIRTUAL))
+        await service.execute_action(device.id, DeviceAction(action_type="on"))
+        await service.update_device(device.id, DeviceUpdate(name="Desk Lamp"))
+        return device
+
+    device = asyncio.run(scenario())
+    service.journal.close()
+
+    # Verify no snapshot was written and the journal holds three records
+    assert service.persistence_stats["writes"] == 0
+    assert not os.path.exists(service.store.path)
+    assert service.get_persistence_stats()["journal_records"] == 3
+
+    # Verify a new service rebuilds the state from the journal
+    restored = journal_service_factory()
+    assert restored.devices[device.id].name == "Desk Lamp"
+    assert restored.devices[device.id].status == "on"
+    restored.journal.close()
+
+
+def test_journal_compaction_folds_into_snapshot(journal_service_factory):
+    """Test that compaction writes a snapshot and empties the journal"""
+    service = journal_service_factory()
+
+    async def scenario():
+        await service.start()
+        keep = await service.create_device(DeviceCreate(name="Lamp", type=DeviceType.VIRTUAL))
+        gone = await service.create_device(DeviceCreate(name="Fan", type=DeviceType.VIRTUAL))
+        await service.delete_device(gone.id)
+        await service.stop()
+        return keep
+
+    keep = asyncio.run(scenario())
+
+    # Verify the snapshot holds the compacted state and the journal is empty
+    assert [d["id"] for d in _read_devices_file(service)] == [keep.id]
+    assert os.path.getsize(service.journal.path) == 0
+    assert not os.path.exists(service.journal.rotated_path)
+
+    restored = journal_service_factory()
+    assert list(restored.devices) == [keep.id]
+    restored.journal.close()
+
+
+def test_journal_skips_torn_final_record(journal_service_factory):
+    """Test that a torn final record is detected by checksum and skipped"""
+    service = journal_service_factory()
+
+    async def scenario():
+        first = await service.create_device(DeviceCreate(name="Lamp", type=DeviceType.VIRTUAL))
+        await service.update_device(first.id, DeviceUpdate(name="Desk Lamp"))
+        return first
+
+    first = asyncio.run(scenario())
+    service.journal.close()
+
+    # Simulate a crash halfway through writing the last record
+    with open(service.journal.path, "rb+") as f:
+        f.truncate(os.path.getsize(service.journal.path) - 5)
+
+    restored = journal_service_factory()
+    assert restored.devices[first.id].name == "Lamp"
+    assert restored.journal.records == 1
+    restored.journal.close()
+
+    # Verify a record with a bad checksum is rejected as well
+    with open(service.journal.path, "ab") as f:
+        f.write(b'00000000 {"op":"delete","id":"%s","data":null}\n' % first.id.encode())
+
+    restored = journal_service_factory()
+    assert first.id in restored.devices
+    restored.journal.close()
+
+
+@pytest.fixture
+def sqlite_service_factory(mock_data_dir):
+    """Create device services backed by the SQLite storage engine"""
+    with patch('app.services.device_service.DATA_DIR', mock_data_dir), \
+            patch('app.services.storage.settings.STORAGE_ENGINE', "sqlite"):
+        yield DeviceService
+
+
+def test_sqlite_migrates_json_file(mock_data_dir, sqlite_service_factory):
+    """Test that the SQLite engine imports an existing devices.json once"""
+    devices_file = os.path.join(mock_data_dir, "devices.json")
+    with open(devices_file, "w") as f:
+        json.dump([{"id": "lamp-1", "name": "Lamp", "type": "virtual", "status": "on",
+                    "properties": {"state": "on"}, "actions": ["on", "off"]}], f)
+
+    service = sqlite_service_factory()
+
+    # Verify the device was imported and the JSON file set aside
+    assert service.devices["lamp-1"].properties == {"state": "on"}
+    assert not os.path.exists(devices_file)
+    assert os.path.exists(f"{devices_file}.migrated")
+    service.store.close()
+
+    restored = sqlite_service_factory()
+    assert list(restored.devices) == ["lamp-1"]
+    restored.store.close()
+
+
+def test_sqlite_filters(sqlite_service_factory):
+    """Test filtering devices by type and status with the SQLite engine"""
+    service = sqlite_service_factory()
+
+    async def scenario():
+        lamp = await service.create_device(DeviceCreate(name="Lamp", type=DeviceType.VIRTUAL))
+        await service.create_device(DeviceCreate(name="Fan", type=DeviceType.VIRTUAL))
+        await service.create_device(DeviceCreate(name="Speaker", type=DeviceType.MQTT))
+        await service.execute_action(lamp.id, DeviceAction(action_type="on"))
+
+        virtual = await service.get_devices(device_type="virtual")
+        lamps = await service.get_devices(device_type="virtual", status="on")
+        return lamp, virtual, lamps
+
+    lamp, virtual, lamps = asyncio.run(scenario())
+
+    assert sorted(d.name for d in virtual) == ["Fan", "Lamp"]
+    assert [d.id for d in lamps] == [lamp.id]
+    service.store.close()
+
+
+def test_sqlite_write_behind_batches_changes(sqlite_service_factory):
+    """Test that write-behind changes are committed in one transaction"""
+    service = None
+
+    async def scenario():
+        nonlocal service
+        with patch('app.services.device_service.settings.PERSISTENCE_MODE', "write_behind"), \
+                patch('app.services.device_service.settings.PERSISTENCE_FLUSH_INTERVAL', 60):
+            service = sqlite_service_factory()
+            await service.start()
+            lamp = await service.create_device(DeviceCreate(name="Lamp", type=DeviceType.VIRTUAL))
+            fan = await service.create_device(DeviceCreate(name="Fan", type=DeviceType.VIRTUAL))
+            await service.execute_action(lamp.id, DeviceAction(action_type="on"))
+
+            # Unwritten changes are still visible to indexed lookups
+            assert [d.id for d in await service.get_devices(status="on")] == [lamp.id]
+
+            await service.delete_device(fan.id)
+            await service.stop()
+            return lamp
+
+    lamp = asyncio.run(scenario())
+
+    assert service.persistence_stats["writes"] == 1
+    assert service.persistence_stats["changes_written"] == 4
+
+    restored = sqlite_service_factory()
+    assert list(restored.devices) == [lamp.id]
+    assert restored.devices[lamp.id].status == "on"
+    restored.store.close()
+
+
+def test_load_validates_only_foreign_records(mock_data_dir):
+    """Test that stored records load on the trusted path and others are validated"""
+    with open(os.path.join(mock_data_dir, "devices.json"), "w") as f:
+        json.dump([
+            {"id": "lamp-1", "name": "Lamp", "type": "virtual", "status": "on",
+             "properties": {}, "last_seen": None, "actions": ["on", "off"]},
+            # Hand-written, with a numeric name and no status
+            {"id": "fan-1", "name": 42, "type": "mqtt"},
+        ], f)
+
+    with patch('app.services.device_service.DATA_DIR', mock_data_dir), \
+            patch('app.services.device_service.Device', wraps=Device) as validated:
+        service = DeviceService()
+
+    # Verify only the hand-written record went through pydantic
+    assert validated.call_count == 1
+    assert service.devices["lamp-1"].status == "on"
+    assert service.devices["fan-1"].name == "42"
+    assert service.devices["fan-1"].status == "unknown"
+
+
+def test_snapshot_streams_one_device_per_line(mock_data_dir):
+    """Test that the snapshot is a JSON array with one device per line"""
+    with patch('app.services.device_service.DATA_DIR', mock_data_dir):
+        service = DeviceService()
+        for name in ("Lamp", "Fan"):
+            asyncio.run(service.create_device(DeviceCreate(name=name, type=DeviceType.VIRTUAL)))
+
+        restored = DeviceService()
+
+    # Verify the file stays valid JSON and loads back line by line
+    with open(service.store.path) as f:
+        lines = f.read().splitlines()
+    assert lines[0] == "[" and lines[-1] == "]"
+    assert len(lines) == 4
+    assert len(_read_devices_file(service)) == 2
+    assert set(restored.devices) == set(service.devices)
+    assert restored.store.load_fraction == 1.0
+
+
+def test_loads_compact_snapshot_files(mock_data_dir):
+    """Test that snapshots written on a single line still load"""
+    with open(os.path.join(mock_data_dir, "devices.json"), "w") as f:
+        json.dump([{"id": "lamp-1", "name": "Lamp", "type": "virtual"}], f)
+
+    with patch('app.services.device_service.DATA_DIR', mock_data_dir):
+        service = DeviceService()
+
+    # Verify
+    assert list(service.devices) == ["lamp-1"]
+
+
+def test_background_load_reports_progress(mock_data_dir):
+    """Test that a background load fills the registry in batches and then becomes ready"""
+    with open(os.path.join(mock_data_dir, "devices.json"), "w") as f:
+        json.dump([{"id": f"lamp-{i}", "name": "Lamp", "type": "virtual"} for i in range(5)], f)
+
+    async def scenario(service):
+        before = service.get_load_progress()
+        await service.start()
+        await service.load_task
+        await service.stop()
+        return before
+
+    with patch('app.services.device_service.DATA_DIR', mock_data_dir), \
+            patch('app.services.device_service.LOAD_BATCH_SIZE', 2):
+        service = DeviceService(background_load=True)
+        before = asyncio.run(scenario(service))
+
+    # Verify nothing is loaded until the service starts
+    assert before["ready"] is False
+    assert before["loaded"] == 0
+
+    # Verify each batch and the end of the load bumped the version
+    progress = service.get_load_progress()
+    assert progress["ready"] is True
+    assert progress["loaded"] == 5
+    assert progress["progress"] == 1.0
+    assert service.get_version() == service.start_version + 4
+    assert service.get_changes(service.start_version) is None
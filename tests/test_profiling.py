@@ -0,0 +1,94 @@
+import asyncio
+import threading
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from unittest.mock import patch
+
+from app.api import system
+from app.services.profiling import Profiler, ProfilerBusyError
+
+
+@pytest.fixture
+def profiler():
+    """Create a profiler that samples often"""
+    profiler = Profiler(sample_interval=0.001, memory_frames=1)
+    yield profiler
+    profiler.stop_memory()
+
+
+@pytest.fixture
+def client(profiler):
+    """Create a test client for the system endpoints with an API key set"""
+    app = FastAPI()
+    app.include_router(system.router, prefix="/api/system")
+    app.state.profiler = profiler
+    with patch('app.dependencies.settings.API_KEY', "secret"):
+        yield TestClient(app)
+
+
+def _spin(stop):
+    """Keep a thread busy until stopped"""
+    while not stop.is_set():
+        sum(range(100))
+
+
+def test_sampler_collects_collapsed_stacks(profiler):
+    """Test that the sampling profiler reports the stacks of other threads"""
+    stop = threading.Event()
+    worker = threading.Thread(target=_spin, args=(stop,), name="spinner")
+    worker.start()
+    try:
+        output = asyncio.run(profiler.profile_cpu(0.1, "collapsed"))
+    finally:
+        stop.set()
+        worker.join()
+
+    # Verify each line is a root-first stack and a count
+    spinner = [line for line in output.splitlines() if line.startswith("spinner;")]
+    assert spinner
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in spinner)
+    assert any("_spin (test_profiling.py)" in line for line in spinner)
+
+
+def test_cpu_profiles_do_not_overlap(profiler):
+    """Test that a second CPU profile is refused while one runs"""
+
+    async def scenario():
+        first = asyncio.create_task(profiler.profile_cpu(0.05, "pstats"))
+        await asyncio.sleep(0)
+        with pytest.raises(ProfilerBusyError):
+            await profiler.profile_cpu(0.05, "pstats")
+        return await first
+
+    # Verify
+    assert "function calls" in asyncio.run(scenario())
+    assert profiler.cpu_running is False
+
+
+def test_memory_diff_finds_growth(client):
+    """Test that a memory diff shows allocations made after the baseline"""
+    headers = {"X-API-Key": "secret"}
+    assert client.get("/api/system/profile/memory/diff", headers=headers).status_code == 409
+
+    response = client.post("/api/system/profile/memory/snapshot", headers=headers)
+    assert response.json()["tracing"] is True
+    retained = [bytearray(1024) for _ in range(1000)]
+    differences = client.get("/api/system/profile/memory/diff", headers=headers).json()
+
+    # Verify the largest growth is the allocation above
+    assert differences[0]["size_diff"] >= 1024 * 1000
+    assert "test_profiling.py" in differences[0]["location"]
+    del retained
+
+    assert client.delete("/api/system/profile/memory", headers=headers).status_code == 204
+    assert client.get("/api/system/profile/memory", headers=headers).json()["tracing"] is False
+
+
+def test_profiling_requires_api_key(client):
+    """Test that profiling endpoints need the configured API key"""
+    # Verify
+    assert client.get("/api/system/profile/memory").status_code == 401
+    assert client.get("/api/system/profile/memory", headers={"X-API-Key": "wrong"}).status_code == 401
+    with patch('app.dependencies.settings.API_KEY', ""):
+        assert client.get("/api/system/profile/memory", headers={"X-API-Key": ""}).status_code == 403
@@ -0,0 +1,86 @@
+import asyncio
+import pytest
+from unittest.mock import patch
+
+from app.services.device_service import DeviceService
+from app.services.telemetry import Telemetry
+from app.models.device import DeviceAction, DeviceCreate, DeviceType, DeviceUpdate
+
+
+@pytest.fixture
+def telemetry():
+    """Create a telemetry store with small buffers"""
+    return Telemetry(sample_size=4, rollup_sizes={"1m": 3, "1h": 2}, max_series=2)
+
+
+def test_rollups_per_bucket(telemetry):
+    """Test that readings are folded into min, max, mean and count per minute"""
+    for timestamp, value in [(0, 20.0), (30, 22.0), (59, 21.0), (60, 25), (130, 19.5)]:
+        telemetry.record("sensor", {"temperature": value}, timestamp=timestamp)
+
+    points = telemetry.query("sensor", "temperature", "1m", 0.0, float("inf"), 10)["temperature"]
+
+    # Verify
+    assert points == [
+        (0.0, 20.0, 22.0, 21.0, 3),
+        (60.0, 25.0, 25.0, 25.0, 1),
+        (120.0, 19.5, 19.5, 19.5, 1),
+    ]
+    assert telemetry.query("sensor", None, "1h", 0.0, float("inf"), 10)["temperature"] == [
+        (0.0, 19.5, 25.0, 21.5, 5)
+    ]
+
+    # Verify a range keeps the buckets it overlaps, and the limit keeps the newest
+    assert [p[0] for p in telemetry.query("sensor", None, "1m", 90.0, 125.0, 10)["temperature"]] == [60.0, 120.0]
+    assert [p[0] for p in telemetry.query("sensor", None, "1m", 0.0, float("inf"), 1)["temperature"]] == [120.0]
+
+
+def test_buffers_are_bounded(telemetry):
+    """Test that old samples and buckets are overwritten at any ingest rate"""
+    for i in range(1000):
+        telemetry.record("sensor", {"power": i}, timestamp=i * 30.0)
+
+    series = telemetry.series["sensor"]["power"]
+
+    # Verify
+    assert len(series.samples) == 4
+    assert len(series.rollups["1m"]) == 3
+    assert [p[1] for p in telemetry.query("sensor", None, "raw", 0.0, float("inf"), 10)["power"]] == [
+        996.0, 997.0, 998.0, 999.0
+    ]
+    assert [p[0] for p in telemetry.query("sensor", None, "1m", 0.0, float("inf"), 10)["power"]] == [
+        29820.0, 29880.0, 29940.0
+    ]
+
+
+def test_only_numeric_readings_are_recorded(telemetry):
+    """Test that non-numeric values, late readings and extra series are skipped"""
+    recorded = telemetry.record(
+        "sensor", {"state": "on", "enabled": True, "temperature": 21, "humidity": 40.5}, timestamp=100.0
+    )
+    telemetry.record("sensor", {"temperature": 18}, timestamp=50.0)
+    telemetry.record("sensor", {"power": 3.5}, timestamp=120.0)
+
+    # Verify
+    assert recorded == 2
+    assert sorted(telemetry.series["sensor"]) == ["humidity", "temperature"]
+    assert telemetry.stats == {"samples": 2, "late": 1, "rejected": 1}
+
+
+def test_service_records_property_updates(tmp_path):
+    """Test that numeric property updates reach the telemetry of the device"""
+    with patch('app.services.device_service.DATA_DIR', str(tmp_path)):
+        service = DeviceService()
+
+    async def scenario():
+        sensor = await service.create_device(DeviceCreate(name="Sensor", type=DeviceType.VIRTUAL))
+        await service.update_device(sensor.id, DeviceUpdate(properties={"temperature": 21.5}))
+        await service.execute_action(sensor.id, DeviceAction(action_type="temperature", value=22.5))
+        return sensor, await service.get_telemetry(sensor.id, None, "raw", 0.0, float("inf"), 10)
+
+    sensor, series = asyncio.run(scenario())
+
+    # Verify
+    assert [point[1] for point in series["temperature"]] == [21.5, 22.5]
+    asyncio.run(service.delete_device(sensor.id))
+    assert sensor.id not in service.telemetry.series
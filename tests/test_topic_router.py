@@ -0,0 +1,85 @@
+import asyncio
+import pytest
+
+from app.core.mqtt import MQTTClient
+from app.core.topic_router import TopicRouter
+
+
+@pytest.fixture
+def router():
+    """Create a router with a few overlapping patterns"""
+    router = TopicRouter()
+    for pattern in ("home/+/state", "home/lamp/state", "home/#", "#", "home/+/+/battery"):
+        router.add(pattern, pattern)
+    return router
+
+
+def test_wildcards_match(router):
+    """Test that + matches one level and # matches any remaining levels"""
+    # Verify
+    assert sorted(router.match("home/lamp/state")) == ["#", "home/#", "home/+/state", "home/lamp/state"]
+    assert sorted(router.match("home/fan/state")) == ["#", "home/#", "home/+/state"]
+    assert sorted(router.match("home/hall/sensor/battery")) == ["#", "home/#", "home/+/+/battery"]
+    # "home/#" includes its parent level
+    assert sorted(router.match("home")) == ["#", "home/#"]
+    assert router.match("garden/pump") == ["#"]
+    # Wildcards at the first level skip $ topics
+    assert router.match("$SYS/broker/uptime") == []
+
+
+def test_many_handlers_per_pattern_and_removal(router):
+    """Test that patterns keep several handlers and removal prunes empty levels"""
+    router.add("home/lamp/state", "second")
+
+    # Verify
+    assert router.match("home/lamp/state").count("home/lamp/state") == 1
+    assert "second" in router.match("home/lamp/state")
+    assert router.remove("home/lamp/state", "home/lamp/state")
+    assert router.remove("home/lamp/state", "second")
+    assert not router.remove("home/lamp/state", "second")
+    assert "lamp" not in router._root.children["home"].children
+    assert "home/lamp/state" not in router.patterns()
+    assert len(router) == 4
+
+
+@pytest.mark.parametrize("pattern", ["", "home/#/state", "home/la+mp", "home/#x"])
+def test_invalid_patterns_are_rejected(pattern):
+    """Test that patterns that are not valid MQTT subscriptions fail early"""
+    with pytest.raises(ValueError):
+        TopicRouter().add(pattern, None)
+
+
+def test_client_routes_action_types_devices_and_patterns():
+    """Test that callbacks registered by action type, device and pattern all receive messages"""
+    client = MQTTClient()
+    calls = []
+
+    async def every_lamp_state(device_id, payload):
+        calls.append(("state", device_id, payload))
+
+    async def one_lamp_state(device_id, payload):
+        calls.append(("lamp-1", device_id, payload))
+
+    async def anything(topic, payload):
+        calls.append(("pattern", topic, payload))
+
+    client.register_callback("state", every_lamp_state)
+    client.register_callback("state", one_lamp_state, device_id="lamp-1")
+    client.register_callback("zigbee/#", anything)
+
+    async def scenario():
+        await client._handle_message("smarthomelite/lamp-1/state", b'{"status": "on"}')
+        await client._handle_message("smarthomelite/lamp-2/state", b"off")
+        await client._handle_message("zigbee/bridge/state", b"online")
+
+    asyncio.run(scenario())
+
+    # Verify
+    assert sorted(calls, key=str) == sorted([
+        ("state", "lamp-1", {"status": "on"}),
+        ("lamp-1", "lamp-1", {"status": "on"}),
+        ("state", "lamp-2", {"value": "off"}),
+        ("pattern", "zigbee/bridge/state", {"value": "online"}),
+    ], key=str)
+    assert client.subscriptions == ["zigbee/#"]
+    assert client.unregister_callback("state", one_lamp_state, device_id="lamp-1")